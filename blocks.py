@@ -0,0 +1,295 @@
+''' Helpers to process datasets block by block.
+
+Large datasets are never read as a whole. Instead they are split into
+blocks of at most BLOCK_SIZE elements, aligned to the HDF5 chunks of the
+dataset where possible, so that the memory needed does not depend on the
+size of the dataset.
+
+'''
+from itertools import product
+import cPickle as pickle
+import logging
+import h5py
+import numpy
+from labels import fragment_names, RESERVED_PREFIX
+
+# Default number of elements of one block
+BLOCK_SIZE = 2 ** 20
+
+# Number of elements of automatically shaped HDF5 chunks
+CHUNK_SIZE = 2 ** 16
+
+# Storage options of a cube, passed on to h5py create_dataset
+STORAGE_OPTIONS = ('chunks', 'compression', 'compression_opts', 'shuffle',
+        'scaleoffset', 'dtype')
+COMPRESSIONS = ('gzip', 'lzf')
+
+# Maximum number of mappings of a virtual selection, above it data is copied
+MAX_MAPPINGS = 2 ** 10
+
+def block_shape(shape, block_size=BLOCK_SIZE, chunks=None):
+    ''' Return the shape of the blocks of a dataset with the shape shape.
+    A block holds at most block_size elements (but at least one element per
+    dimension) and, if possible, a multiple of the chunk shape chunks.
+    Trailing dimensions are kept whole as long as possible, so that blocks
+    are contiguous in C order.
+
+    '''
+    block = [max(1, length) for length in shape]
+    for dim_index in xrange(len(block)):
+        rest = 1
+        for length in block[dim_index + 1:]:
+            rest *= length
+        if rest * block[dim_index] <= block_size:
+            break
+        block[dim_index] = max(1, block_size // rest)
+        if chunks and block[dim_index] > chunks[dim_index]:
+            block[dim_index] -= block[dim_index] % chunks[dim_index]
+    return tuple(block)
+
+def iter_blocks(shape, block):
+    ''' Yield the selections (tuples of slices) of all blocks with the shape
+    block that cover a dataset with the shape shape.
+
+    '''
+    starts = [xrange(0, length, size) for length, size in zip(shape, block)]
+    for start in product(*starts):
+        yield tuple(slice(first, min(first + size, length)) for first, size,
+                length in zip(start, block, shape))
+
+def check_storage_options(options):
+    ''' Raise a ValueError if the dictionary options is no valid set of
+    storage options.
+    'chunks' is a chunk shape or True/'auto' to derive it from the dataset
+    shape, 'compression' is 'gzip' or 'lzf' (with the level in
+    'compression_opts' for gzip), 'shuffle' and 'scaleoffset' enable the
+    HDF5 filters of the same name and 'dtype' is the type of new datasets.
+
+    '''
+    for key in options:
+        if not key in STORAGE_OPTIONS:
+            logging.error('Unknown storage option: %s' % key)
+            raise ValueError('Unknown storage option: %s' % key)
+    if options.get('compression') not in COMPRESSIONS + (None,):
+        logging.error('Unknown compression: %s' % options['compression'])
+        raise ValueError('Unknown compression: %s' % options['compression'])
+
+def storage_options(grp):
+    ''' Return the storage options of the cube grp.
+
+    '''
+    if not 'storage' in grp.attrs:
+        return {}
+    return pickle.loads(str(grp.attrs['storage']))
+
+def dataset_options(grp, shape, dtype=None):
+    ''' Return the keyword arguments for creating a dataset with the shape
+    shape in the cube grp according to the storage options of the cube.
+    dtype is the type of the data. The type of the cube is used if it holds
+    data of the kind of dtype (e.g. float32 for float64 data), otherwise it
+    is promoted to a type that does (e.g. float64 instead of int32).
+
+    '''
+    options = storage_options(grp)
+    kwargs = dict((key, value) for key, value in options.iteritems() if
+            value is not None)
+    if dtype is not None:
+        if not 'dtype' in kwargs:
+            kwargs['dtype'] = dtype
+        elif not numpy.can_cast(dtype, kwargs['dtype'], 'same_kind'):
+            kwargs['dtype'] = numpy.promote_types(kwargs['dtype'], dtype)
+            if kwargs['dtype'].kind == 'f' and kwargs.get('scaleoffset') is \
+                    True:
+                # the lossless integer filter has no float counterpart
+                del kwargs['scaleoffset']
+    chunks = kwargs.pop('chunks', None)
+    filters = [key for key in ('compression', 'shuffle', 'scaleoffset') if
+            kwargs.get(key)]
+    if not shape or 0 in shape:
+        # HDF5 can't chunk (and thus can't filter) empty or scalar datasets
+        for key in filters + ['compression_opts']:
+            kwargs.pop(key, None)
+        return kwargs
+    if chunks in (True, 'auto') or (chunks is None and filters) or (chunks
+            and len(chunks) != len(shape)):
+        chunks = block_shape(shape, CHUNK_SIZE)
+    if chunks:
+        kwargs['chunks'] = tuple(min(size, length) for size, length in
+                zip(chunks, shape))
+    return kwargs
+
+def copy_blocks(source, destination, offset=None, block_size=BLOCK_SIZE):
+    ''' Copy the dataset source block by block into the dataset (or array)
+    destination, starting at the position offset (default: the origin).
+
+    '''
+    if offset is None:
+        offset = (0,) * len(source.shape)
+    for selection in iter_blocks(source.shape, block_shape(source.shape,
+        block_size, source.chunks)):
+        target = tuple(slice(part.start + start, part.stop + start) for part,
+                start in zip(selection, offset))
+        destination[target] = source[selection]
+
+def _positions_index(positions):
+    ''' Return a slice equivalent to the array of positions if they are
+    consecutive, otherwise the array itself.
+
+    '''
+    if len(positions) and (positions == numpy.arange(positions[0],
+        positions[0] + len(positions))).all():
+        return slice(positions[0], positions[0] + len(positions))
+    return positions
+
+def scatter_blocks(source, destination, positions, selection=None,
+        block_size=BLOCK_SIZE):
+    ''' Copy the dataset source block by block into the array destination.
+    positions holds one array per dimension with the position within
+    destination of every index along that dimension of source, or of the
+    hyperslab selection (a tuple of slices) of source if given.
+    Every element of source is read at most once.
+
+    '''
+    if selection is None:
+        selection = tuple(slice(0, length) for length in source.shape)
+    shape = tuple(part.stop - part.start for part in selection)
+    for block in iter_blocks(shape, block_shape(shape, block_size,
+        source.chunks)):
+        data = source[tuple(slice(part.start + outer.start, part.stop +
+            outer.start) for part, outer in zip(block, selection))]
+        target = [_positions_index(dim_positions[part]) for dim_positions,
+                part in zip(positions, block)]
+        if all(isinstance(part, slice) for part in target):
+            destination[tuple(target)] = data
+        else:
+            target = [numpy.arange(part.start, part.stop) if isinstance(part,
+                slice) else part for part in target]
+            destination[numpy.ix_(*target)] = data
+
+def gather_blocks(source, destination, positions, block_size=BLOCK_SIZE):
+    ''' Copy the elements of the dataset source selected by positions (one
+    sorted array of positions per dimension) block by block into the dataset
+    (or array) destination of the shape of the selection. Only blocks of the
+    bounding box of the selection that hold selected elements are read.
+
+    '''
+    box = tuple(slice(dim_positions[0], dim_positions[-1] + 1) for
+            dim_positions in positions)
+    shape = tuple(part.stop - part.start for part in box)
+    for block in iter_blocks(shape, block_shape(shape, block_size,
+        source.chunks)):
+        target = list()
+        for dim_positions, part, outer in zip(positions, block, box):
+            first, last = numpy.searchsorted(dim_positions, [part.start +
+                outer.start, part.stop + outer.start])
+            if first == last:
+                break
+            target.append(slice(first, last))
+        else:
+            selected = [dim_positions[part] for dim_positions, part in
+                    zip(positions, target)]
+            data = source[tuple(slice(dim_positions[0], dim_positions[-1] +
+                1) for dim_positions in selected)]
+            local = [_positions_index(dim_positions - dim_positions[0]) for
+                    dim_positions in selected]
+            if not all(isinstance(part, slice) for part in local):
+                local = [numpy.arange(part.start, part.stop) if
+                        isinstance(part, slice) else part for part in local]
+                local = numpy.ix_(*local)
+            destination[tuple(target)] = data[tuple(local)]
+
+def dense_blocks(shape, flat, values, fill=numpy.nan, block_size=BLOCK_SIZE):
+    ''' Yield the selections (tuples of slices) and the data of the blocks
+    of an array of the shape shape holding values at the positions flat
+    (indices into the flattened array in C order, sorted ascending) and fill
+    everywhere else. The blocks are whole in all but their first dimensions,
+    so every block covers a contiguous range of flat positions.
+
+    '''
+    for selection in iter_blocks(shape, block_shape(shape, block_size)):
+        block = tuple(part.stop - part.start for part in selection)
+        start = numpy.ravel_multi_index([part.start for part in selection],
+                shape)
+        stop = start + int(numpy.prod(block))
+        first, last = numpy.searchsorted(flat, [start, stop])
+        data = numpy.empty(int(numpy.prod(block)), dtype=values.dtype)
+        if last - first < len(data):
+            data.fill(fill)
+        data[flat[first:last] - start] = values[first:last]
+        yield selection, data.reshape(block)
+
+def virtual_source(source, grp):
+    ''' Return a h5py.VirtualSource of the whole dataset source for a
+    virtual dataset created in the group grp.
+
+    '''
+    filename = '.' if source.file == grp.file else source.file.filename
+    return h5py.VirtualSource(filename, source.name, shape=source.shape,
+            dtype=source.dtype)
+
+def _progressions(positions):
+    ''' Return the arithmetic progressions the sorted array positions is made
+    of (each as long as possible, from the start) as (position within the
+    array, strided slice of values) pairs.
+
+    '''
+    positions = list(positions)
+    progressions = list()
+    start = 0
+    while start < len(positions):
+        stop = start + 1
+        step = 1
+        if stop < len(positions):
+            step = positions[stop] - positions[start]
+            while stop < len(positions) and positions[stop] - positions[stop
+                    - 1] == step:
+                stop += 1
+        progressions.append((slice(start, stop), slice(positions[start],
+            positions[stop - 1] + 1, step)))
+        start = stop
+    return progressions
+
+def virtual_selection(source, grp, name, positions, block_size=BLOCK_SIZE,
+        max_mappings=MAX_MAPPINGS):
+    ''' Create the dataset name in the group grp holding the elements of the
+    dataset source selected by positions (one sorted array of positions per
+    dimension). Each dimension is split into arithmetic progressions of
+    positions and every combination of them becomes one strided hyperslab
+    mapping of a virtual dataset, no data is copied. If this takes more than
+    max_mappings mappings (e.g. for scattered positions) the elements are
+    copied block by block into a real dataset instead.
+
+    '''
+    shape = tuple(len(dim_positions) for dim_positions in positions)
+    progressions = [_progressions(dim_positions) for dim_positions in
+            positions]
+    if numpy.prod([len(dim_progressions) for dim_progressions in
+            progressions]) > max_mappings:
+        dset = grp.create_dataset(name, shape=shape, **dataset_options(grp,
+            shape, source.dtype))
+        gather_blocks(source, dset, positions, block_size)
+        return dset
+    layout = h5py.VirtualLayout(shape=shape, dtype=source.dtype)
+    vsource = virtual_source(source, grp)
+    for mapping in product(*progressions):
+        target, selection = zip(*mapping)
+        layout[target] = vsource[selection]
+    return grp.create_virtual_dataset(name, layout)
+
+def materialize(grp, block_size=BLOCK_SIZE):
+    ''' Replace all virtual datasets of the cube grp by real datasets
+    holding a copy of the data. Names, attributes and labels stay the same.
+
+    '''
+    for name in fragment_names(grp):
+        dset = grp[name]
+        if not dset.is_virtual:
+            continue
+        tmp_name = RESERVED_PREFIX + 'materialize_' + name
+        real = grp.create_dataset(tmp_name, shape=dset.shape,
+                **dataset_options(grp, dset.shape, dset.dtype))
+        copy_blocks(dset, real, block_size=block_size)
+        for key, value in dset.attrs.items():
+            real.attrs[key] = value
+        del grp[name]
+        grp.move(tmp_name, name)
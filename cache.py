@@ -0,0 +1,199 @@
+''' Memoization of function outputs.
+
+Every dataset of a cube carries a content hash in its 'content_hash'
+attribute. It is set when the dataset is created and chained with every
+block written through the SdCube methods. Datasets written otherwise (e.g.
+by functions) are hashed block by block when the hash is needed first. The
+hash of a cube combines the hashes of its datasets.
+
+The outputs of a function are kept under a key made of the function class,
+its params and the hashes of its input cubes: the member _cache/<key>/<i> of
+the project file is a hard link to the i-th output cube. Running the same
+function on the same content again links the cached cubes instead of
+computing them. A cached cube is linked only under the name it was computed
+for, under another name it is copied, so that both can change on their own.
+An output cube changed afterwards is dropped from the cache.
+The least recently used entries are evicted once the cached data exceeds
+the cache limit of the file.
+
+'''
+import cPickle as pickle
+import hashlib
+import logging
+import time
+from blocks import block_shape, iter_blocks
+from labels import label_index, fragments
+
+CACHE = '_cache'
+
+# Default number of bytes of cached output data
+CACHE_LIMIT = 2 ** 30
+
+HASH = 'content_hash'
+KEY = 'cache_key'
+COPY = 'cache_copy'
+
+def init_hash(dset, mapping):
+    ''' Set the content hash of the new (unwritten) dataset dset with the
+    dataset mapping.
+
+    '''
+    digest = hashlib.sha1(pickle.dumps((sorted(mapping.iteritems()),
+        dset.shape, dset.dtype.str), 2))
+    dset.attrs[HASH] = digest.hexdigest()
+
+def update_hash(dset, selection, data):
+    ''' Chain the content hash of the dataset dset with the data written to
+    the selection (a tuple of slices) of dset. Datasets without a hash keep
+    none, it is computed from the content once needed.
+
+    '''
+    if not HASH in dset.attrs:
+        return
+    digest = hashlib.sha1(str(dset.attrs[HASH]))
+    digest.update(pickle.dumps([(part.start, part.stop) for part in
+        selection], 2))
+    digest.update(data.dtype.str)
+    digest.update(data.tostring())
+    dset.attrs[HASH] = digest.hexdigest()
+
+def content_hash(dset):
+    ''' Return the content hash of the dataset dset.
+    The hash of a dataset without one is computed from the labels and the
+    data, and stored unless the file is read-only. Virtual datasets change
+    with their sources, so their hash is never stored.
+
+    '''
+    if HASH in dset.attrs and not dset.is_virtual:
+        return str(dset.attrs[HASH])
+    digest = hashlib.sha1(pickle.dumps((sorted(label_index(
+        dset).mapping.iteritems()), dset.shape, dset.dtype.str), 2))
+    for selection in iter_blocks(dset.shape, block_shape(dset.shape,
+        chunks=dset.chunks)):
+        digest.update(dset[selection].tostring())
+    if not dset.is_virtual and not dset.file.mode == 'r':
+        dset.attrs[HASH] = digest.hexdigest()
+    return digest.hexdigest()
+
+def cube_hash(grp):
+    ''' Return the content hash of the cube grp.
+
+    '''
+    digest = hashlib.sha1(str(grp.attrs['mapping']))
+    for dset in fragments(grp):
+        digest.update(dset.name.split('/')[-1])
+        digest.update(content_hash(dset))
+    return digest.hexdigest()
+
+def function_key(func, input_cubes):
+    ''' Return the cache key of the function func applied to the cubes
+    input_cubes.
+
+    '''
+    digest = hashlib.sha1('%s.%s' % (func.__class__.__module__,
+        func.__class__.__name__))
+    digest.update(pickle.dumps(func.params, 2))
+    for grp in input_cubes:
+        digest.update(cube_hash(grp))
+    return digest.hexdigest()
+
+def clear_hashes(grp):
+    ''' Remove the content hashes and the cache key the cube grp copied from
+    the cubes it was computed from.
+
+    '''
+    for attr in (KEY, COPY):
+        if attr in grp.attrs:
+            del grp.attrs[attr]
+    for dset in fragments(grp):
+        if HASH in dset.attrs:
+            del dset.attrs[HASH]
+
+def lookup(h5_file, key):
+    ''' Return the cache entry (a group holding the output cubes) with the
+    key or None.
+
+    '''
+    entry = h5_file.get(CACHE + '/' + key)
+    if entry is not None:
+        entry.attrs['used'] = time.time()
+    return entry
+
+def store(h5_file, key, output_cubes, limit=CACHE_LIMIT):
+    ''' Keep the cubes output_cubes in the cache under the key and evict
+    the least recently used entries above the limit.
+
+    '''
+    cache = h5_file.require_group(CACHE)
+    if key in cache:
+        del cache[key]
+    entry = cache.create_group(key)
+    entry.attrs['names'] = pickle.dumps([grp.name for grp in output_cubes])
+    size = 0
+    for index, grp in enumerate(output_cubes):
+        entry[str(index)] = grp
+        grp.attrs[KEY] = key
+        size += sum(dset.id.get_storage_size() for dset in fragments(grp))
+    entry.attrs['size'] = size
+    entry.attrs['used'] = time.time()
+    evict(h5_file, limit)
+
+def is_cached(grp, key):
+    ''' Return whether the cube grp is the cached output with the key or an
+    unchanged copy of it.
+
+    '''
+    return key in (grp.attrs.get(KEY), grp.attrs.get(COPY))
+
+def install(h5_file, entry, index, name):
+    ''' Install the index-th cube of the cache entry as the cube name. It is
+    linked if it was computed under this name and copied otherwise.
+
+    '''
+    cached = entry[str(index)]
+    if 'names' in entry.attrs and pickle.loads(str(entry.attrs['names']))[
+            index] == '/' + name:
+        h5_file[name] = cached
+        return
+    h5_file.copy(cached, name)
+    grp = h5_file[name]
+    if KEY in grp.attrs:
+        del grp.attrs[KEY]
+    grp.attrs[COPY] = entry.name.rsplit('/', 1)[-1]
+
+def invalidate(grp):
+    ''' Drop the cube grp from the cache because it is about to change.
+
+    '''
+    if COPY in grp.attrs:
+        del grp.attrs[COPY]
+    if not KEY in grp.attrs:
+        return
+    key = str(grp.attrs[KEY])
+    del grp.attrs[KEY]
+    cache = grp.file.get(CACHE)
+    if cache is not None and key in cache:
+        logging.info('Removing changed cube %s from the cache' % grp.name)
+        del cache[key]
+
+def evict(h5_file, limit=CACHE_LIMIT):
+    ''' Remove the least recently used cache entries until the cached data
+    takes at most limit bytes. The cubes of an evicted entry stay in the
+    project as long as they are outputs of a function.
+
+    '''
+    cache = h5_file.get(CACHE)
+    if cache is None:
+        return
+    entries = sorted((entry.attrs['used'], key, entry.attrs['size']) for key,
+            entry in cache.iteritems())
+    total = sum(size for used, key, size in entries)
+    for used, key, size in entries:
+        if total <= limit:
+            break
+        logging.info('Evicting %s from the cache' % key)
+        for grp in cache[key].values():
+            if KEY in grp.attrs and grp.attrs[KEY] == key:
+                del grp.attrs[KEY]
+        del cache[key]
+        total -= size
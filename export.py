@@ -0,0 +1,176 @@
+''' Streaming export of cubes to CSV, NPY/NPZ and memory-mapped files.
+
+Every exporter reads the datasets of a cube block by block (at most
+block_size elements at once) and writes each block before reading the next,
+so the memory needed does not depend on the size of the cube. As with
+SdCube.get_data, items {dimension_label: index_label} restricts the export
+to the datasets holding these labels and to the labels themselves.
+
+The binary formats carry no index labels. They are written to a sidecar
+file (the filename with .labels appended), a pickled dictionary holding the
+'dimensions' of the cube in order and either their 'labels' (a dense array)
+or the labels of every exported dataset in 'fragments'. read_labels loads
+it.
+
+'''
+import os
+import csv
+import zipfile
+import tempfile
+import cPickle as pickle
+import numpy
+from itertools import product
+from blocks import BLOCK_SIZE, block_shape, iter_blocks
+from labels import extent_index, label_index
+from hdf import load_mapping
+
+LABELS_SUFFIX = '.labels'
+
+def _dimensions(grp):
+    ''' Return the dimension labels of the cube grp in order.
+
+    '''
+    group_mapping = load_mapping(grp)
+    return sorted(group_mapping, key=group_mapping.get)
+
+def _fragments(grp, items):
+    ''' Yield the name, the dataset, the selection (a tuple of slices) and
+    the index labels of every dimension (a list of lists) of the parts of
+    the datasets of the cube grp matching items.
+
+    '''
+    group_mapping = load_mapping(grp)
+    point = dict((group_mapping[dim_label], index_label) for dim_label,
+            index_label in items.iteritems())
+    for name in sorted(extent_index(grp).locate(point), key=int):
+        dataset = grp[name]
+        dset_index = label_index(dataset)
+        selection = [slice(0, length) for length in dataset.shape]
+        labels = [list(dset_index.mapping[dim_index]) for dim_index in
+                xrange(len(dataset.shape))]
+        for dim_index, index_label in point.iteritems():
+            position = dset_index.position(dim_index, index_label)
+            selection[dim_index] = slice(position, position + 1)
+            labels[dim_index] = [index_label]
+        yield name, dataset, tuple(selection), labels
+
+def _write_labels(filename, labels):
+    with open(filename + LABELS_SUFFIX, 'wb') as labels_file:
+        pickle.dump(labels, labels_file, 2)
+
+def read_labels(filename):
+    ''' Return the dictionary of the sidecar label file of the exported
+    file filename.
+
+    '''
+    with open(filename + LABELS_SUFFIX, 'rb') as labels_file:
+        return pickle.load(labels_file)
+
+def _cell(value):
+    ''' Return value the way the csv module writes it.
+
+    '''
+    if isinstance(value, unicode):
+        return value.encode('utf8')
+    return value
+
+def to_csv(sdcube, filename, items={}, value='value',
+        block_size=BLOCK_SIZE):
+    ''' Write the data of the SdCube matching items to the CSV file filename
+    in long format: a header with the dimension labels and value, then one
+    row per data point with its index labels and its value.
+    Return the number of data points written.
+
+    '''
+    count = 0
+    with sdcube.session('r'):
+        grp = sdcube.group
+        with open(filename, 'wb') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow([_cell(dim_label) for dim_label in
+                _dimensions(grp)] + [value])
+            for name, dataset, selection, labels in _fragments(grp, items):
+                shape = tuple(part.stop - part.start for part in selection)
+                for block in iter_blocks(shape, block_shape(shape,
+                    block_size, dataset.chunks)):
+                    data = dataset[tuple(slice(part.start + outer.start,
+                        part.stop + outer.start) for part, outer in
+                        zip(block, selection))]
+                    block_labels = [[_cell(label) for label in
+                        dim_labels[part]] for dim_labels, part in
+                        zip(labels, block)]
+                    writer.writerows(list(point) + [cell] for point, cell in
+                            zip(product(*block_labels), data.flat))
+                    count += data.size
+    return count
+
+def to_memmap(sdcube, filename, items={}, fill=numpy.nan,
+        block_size=BLOCK_SIZE):
+    ''' Write the data of the SdCube matching items as one dense array (see
+    SdCube.to_dense) to the raw memory-mapped file filename. The sidecar
+    label file also holds the 'shape' and 'dtype' needed to map the file.
+    A filename ending with .npy gets the header of the NPY format instead.
+    Return the array, a numpy.memmap.
+
+    '''
+    data, labels = sdcube.to_dense(items, memmap=filename, fill=fill,
+            block_size=block_size)
+    with sdcube.session('r'):
+        dimensions = _dimensions(sdcube.group)
+    _write_labels(filename, {'dimensions':dimensions, 'labels':labels,
+        'shape':data.shape, 'dtype':data.dtype.str})
+    return data
+
+def to_npy(sdcube, filename, items={}, fill=numpy.nan,
+        block_size=BLOCK_SIZE):
+    ''' Write the data of the SdCube matching items as one dense array to
+    the NPY file filename (see to_memmap).
+    Return the array, a numpy.memmap.
+
+    '''
+    if not filename.endswith('.npy'):
+        filename += '.npy'
+    return to_memmap(sdcube, filename, items, fill, block_size)
+
+def to_npz(sdcube, filename, items={}, compress=False,
+        block_size=BLOCK_SIZE):
+    ''' Write the parts of the datasets of the SdCube matching items to the
+    NPZ file filename, one array per dataset named like the dataset. Every
+    array is copied block by block into a temporary NPY file, which is then
+    added to the archive.
+    Return the names of the arrays.
+
+    '''
+    names = list()
+    fragment_labels = dict()
+    handle, tmp_name = tempfile.mkstemp(suffix='.npy',
+            dir=os.path.dirname(os.path.abspath(filename)))
+    os.close(handle)
+    try:
+        with sdcube.session('r'):
+            grp = sdcube.group
+            dimensions = _dimensions(grp)
+            with zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED if
+                    compress else zipfile.ZIP_STORED, allowZip64=True) as \
+                            archive:
+                for name, dataset, selection, labels in _fragments(grp,
+                        items):
+                    shape = tuple(part.stop - part.start for part in
+                            selection)
+                    array = numpy.lib.format.open_memmap(tmp_name,
+                            mode='w+', dtype=dataset.dtype, shape=shape)
+                    for block in iter_blocks(shape, block_shape(shape,
+                        block_size, dataset.chunks)):
+                        array[block] = dataset[tuple(slice(part.start +
+                            outer.start, part.stop + outer.start) for part,
+                            outer in zip(block, selection))]
+                    array.flush()
+                    del array
+                    archive.write(tmp_name, name + '.npy')
+                    names.append(name)
+                    fragment_labels[name] = dict(zip(dimensions, labels))
+    finally:
+        os.remove(tmp_name)
+    _write_labels(filename, {'dimensions':dimensions,
+        'fragments':fragment_labels})
+    return names
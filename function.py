@@ -3,6 +3,9 @@
 
 '''
 import pickle
+import numpy
+from labels import label_index, extent_index, fragments, fragment_names, \
+        dataset_labels, load_labels, store_labels, copy_labels, delete_labels
 
 def get_first_index_labels(dset, items):
     ''' Get the 'first' index_labels of a given dataset (index 0 for every
@@ -11,7 +14,7 @@ def get_first_index_labels(dset, items):
 
     '''
     index_labels = {}
-    mapping = get_mapping(dset)
+    mapping = dataset_labels(dset)
     group_mapping = get_mapping(dset.parent)
     for key, value in items.items():
         mapping[group_mapping[key]] = [value]
@@ -25,17 +28,14 @@ def get_index(dimension_index, index_label, dset):
     data cube and the index of the value within that.
     
     '''
-    mapping = get_mapping(dset)
-    if index_label in mapping[dimension_index]:
-        return mapping[dimension_index].index(index_label)
-    return -1
+    return label_index(dset).position(dimension_index, index_label)
 
 def get_index_label(dimension_index, index, dset):
     ''' Load the mapping for the dataset and return the index_label
     of the dataset mapping.
     
     '''
-    return get_mapping(dset)[dimension_index][index]
+    return label_index(dset).label(dimension_index, index)
 
 def get_combinations(to_be_combined):
     '''Returns all possible combinations of the elments in the 
@@ -52,6 +52,8 @@ def get_mapping(h5_elem):
     '''Get and return the mapping of the h5 element
 
     '''
+    if not 'mapping' in h5_elem.attrs:
+        return load_labels(h5_elem)
     return pickle.loads(str(h5_elem.attrs['mapping']))
 
 def compare(dict1, dict2):
@@ -66,6 +68,7 @@ def get_indices_and_labels(grp_map, dataset, items):
     '''
     inds = list()
     dim_labels = list()
+    index = label_index(dataset)
     for combination in get_combinations(items):
         #TODO Check for multiple used indices (how are we treating those?)
         inds.append(list())
@@ -77,54 +80,92 @@ def get_indices_and_labels(grp_map, dataset, items):
             dim_index = grp_map[key]
             dim_labels[-1][dim_index] = list()
             if type(value) == tuple and len(value) == 2: # range of index_labels
-                start = get_index(dim_index, value[0], dataset)
-                end = get_index(dim_index, value[1], dataset)
+                start = index.position(dim_index, value[0])
+                end = index.position(dim_index, value[1])
                 if start != -1 and end != -1:
                     inds[-1][-1][dim_index] = slice(start, end +
                             1, None)
-                    for index in xrange(start, end + 1):
-                        dim_labels[-1][dim_index].append(
-                                get_index_label(dim_index, index, dataset))
+                    dim_labels[-1][dim_index].extend(
+                            index.mapping[dim_index][start:end + 1])
                 else:
                     inds.pop()
                     dim_labels.pop()
                     break
             else:
-                ind = get_index(dim_index, value, dataset)
+                ind = index.position(dim_index, value)
                 if ind != -1:
                     inds[-1][-1][dim_index] = ind
                     dim_labels[-1][dim_index].append(
-                            get_index_label(dim_index, ind, dataset))
+                            index.label(dim_index, ind))
                 else:
                     inds.pop()
                     dim_labels.pop()
                     break
     return inds, dim_labels
 
+def overlapping_names(group, items):
+    ''' Return the sorted names of the datasets of the group that share a
+    label with items in every dimension of items.
+
+    '''
+    grp_map = get_mapping(group)
+    # datasets that share no label with items in any dimension are skipped
+    # before anything is read
+    requested = dict()
+    for dim_label, values in items.iteritems():
+        requested[grp_map[dim_label]] = [value[0] if type(value) == tuple and
+                len(value) == 2 else value for value in values]
+    names = extent_index(group).overlapping(requested) if requested else \
+            fragment_names(group)
+    return sorted(names)
+
+def get_selection(grp_map, dataset, items):
+    ''' Return the orthogonal selection of items within the dataset: one
+    sorted array of positions per dimension and the labels at these
+    positions, keyed by the dimension index. Every value of items is an index
+    label or a (first, last) range of index labels. Labels the dataset does
+    not contain are ignored. Return None if the selection is empty.
+
+    '''
+    index = label_index(dataset)
+    selection = [numpy.arange(length) for length in dataset.shape]
+    for key, values in items.iteritems():
+        dim_index = grp_map[key]
+        positions = list()
+        for value in values:
+            if type(value) == tuple and len(value) == 2: # range of labels
+                start = index.position(dim_index, value[0])
+                end = index.position(dim_index, value[1])
+                if start != -1 and end != -1:
+                    positions.extend(xrange(start, end + 1))
+            else:
+                position = index.position(dim_index, value)
+                if position != -1:
+                    positions.append(position)
+        if not positions:
+            return None
+        selection[dim_index] = numpy.unique(positions)
+    dim_labels = dict((dim_index, [index.label(dim_index, position) for
+        position in positions]) for dim_index, positions in
+        enumerate(selection))
+    return selection, dim_labels
+
 def get_data_and_indices(group, items):
     ''' Gathers and return the data of the group.
     The data is stored in a list of numpy ndarrays.
 
     '''
-    data = list()
-    inds = list()
-    dim_labels = list()
     grp_map = get_mapping(group)
-    for dataset in group.values():
-        data.append(dataset[...])
-        one, two = get_indices_and_labels(grp_map, dataset, items)
-        inds.append(one)
-        dim_labels.append(two)
-
     ret_data = list()
     ret_labels = list()
-
-    for i, indices in enumerate(inds):
-        for indices2 in indices:
-            for index in indices2:
-                ret_data.append(data[i][index])
-        for dim_label in dim_labels[i]:
-            ret_labels.append(dim_label)
+    for name in overlapping_names(group, items):
+        dataset = group[name]
+        inds, dim_labels = get_indices_and_labels(grp_map, dataset, items)
+        for indices in inds:
+            for index in indices:
+                # hyperslab read of the selection only
+                ret_data.append(dataset[tuple(index)])
+        ret_labels.extend(dim_labels)
 
     return ret_data, ret_labels
 
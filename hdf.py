@@ -6,10 +6,22 @@ It also contains the classes Hdf5 and sdcube
 '''
 
 from __future__ import with_statement
+from contextlib import contextmanager
 import h5py
+import numpy
 import cPickle as pickle
 import os
 import logging
+from blocks import BLOCK_SIZE, materialize, check_storage_options, \
+        storage_options, dataset_options, scatter_blocks, dense_blocks
+from labels import ExtentIndex, label_index, extent_index, record_extent, \
+        record_extents, dataset_labels, store_labels, delete_labels, \
+        init_format, RESERVED_PREFIX
+from scheduler import dependencies, downstream, topological_order, \
+        run_parallel
+import registry
+from cache import CACHE_LIMIT, init_hash, update_hash, function_key, \
+        clear_hashes, lookup, store, invalidate, evict, is_cached, install
 
 def is_sequential(elements):
     ''' Return whether a list or a tuple is sequential
@@ -39,12 +51,62 @@ def load_mapping(h5_elem):
     '''
     return load_attribute(h5_elem, 'mapping')
 
+def cube_mapping(h5_file, name):
+    ''' Return the mapping of the cube name of the file h5_file or None if
+    there is no such cube.
+
+    '''
+    grp = h5_file.get(name)
+    if grp is None:
+        return None
+    return load_mapping(grp)
+
 def load_attribute(h5_elem, attribute_name):
     ''' Loads an attribute from the h5 element.
 
     '''
     return pickle.loads(str(h5_elem.attrs[attribute_name]))
 
+def cube_version(grp):
+    ''' Return the version of the cube grp, 0 if it never changed.
+
+    '''
+    return int(grp.attrs.get('version', 0))
+
+def touch(grp):
+    ''' Mark the cube grp as changed: drop it from the function output
+    cache (see cache) and give it a new version.
+
+    '''
+    invalidate(grp)
+    bump_version(grp)
+
+def bump_version(grp):
+    ''' Set the dirty status of the cube grp and give it a new version.
+    Versions are taken from a counter of the file, so a cube that is deleted
+    and created again never gets a version it had before.
+
+    '''
+    counter = int(grp.file.attrs.get('version_counter', 0)) + 1
+    grp.file.attrs['version_counter'] = counter
+    grp.attrs['version'] = counter
+    grp.attrs['dirty'] = True
+
+@contextmanager
+def open_file(filename, mode='r', h5_file=None):
+    ''' Yield h5_file if it is an open session handle, otherwise open the
+    file filename with mode for the duration of the with block.
+
+    '''
+    if h5_file:
+        if mode != 'r' and h5_file.mode == 'r':
+            logging.error('The session is read-only.')
+            raise IOError('The session is read-only.')
+        yield h5_file
+    else:
+        with h5py.File(filename, mode) as h5_file:
+            yield h5_file
+
 class Hdf5:
     ''' Class for creating a hdf5 datacube with associated metadata.
     The metadata is referred to as mapping and is used to map the 
@@ -54,36 +116,129 @@ class Hdf5:
     def __init__(self, projectname):
         self.name = projectname
         self.filename = projectname + '.hdf5'
+        self._h5_file = None
+        self._catalog = None
         logging.basicConfig( format='%(asctime)s %(levelname)s\
                 %(message)s', level=logging.ERROR)
         logging.info('Try using an existing: %s' % self.filename)
         if not os.path.exists(self.filename):
             logging.info('Creating file: %s' % self.filename)
             with h5py.File(self.filename, 'w') as h5_file:
+                init_format(h5_file)
                 # No functions yet
-                h5_file.attrs['functions'] = pickle.dumps([])
+                registry.init_registry(h5_file)
                 h5_file.attrs['sdcubes'] = pickle.dumps({})
                 logging.info('Created file:' + self.filename)
 
+    @contextmanager
+    def session(self, mode='r'):
+        ''' Keep the project file open for the duration of the with block.
+        All project methods and all SdCubes returned by get_sdcube or
+        add_sdcube within the block use this one handle instead of opening
+        the file on every call. mode is 'r' for reading or 'a' for appending.
+        Nested sessions reuse the outer handle.
+
+        '''
+        if self._h5_file:
+            with self._open(mode):
+                yield self
+            return
+        with h5py.File(self.filename, mode) as h5_file:
+            self._h5_file = h5_file
+            try:
+                yield self
+            finally:
+                self._h5_file = None
+
+    def _open(self, mode='r'):
+        ''' Return a context manager for the project file that reuses the
+        session handle if there is one.
+
+        '''
+        return open_file(self.filename, mode, self._h5_file)
+
+    def _file_stamp(self):
+        ''' Return a stamp of the project file that changes whenever the
+        file is modified.
+
+        '''
+        stat = os.stat(self.filename)
+        return stat.st_ino, stat.st_size, stat.st_mtime
+
+    def _store_sdcubes(self, h5_file, sdcubes):
+        ''' Store the dictionary {cube name: filename} of the project and
+        drop the catalog.
+
+        '''
+        store_attribute(h5_file, 'sdcubes', sdcubes)
+        self._catalog = None
+
+    def get_catalog(self):
+        ''' Return a dictionary {cube name: (filename, mapping)} of all cubes
+        of the project.
+        The catalog is kept in memory and only read again if the project file
+        was modified in the meantime (or the project changed it itself).
+        Registered cubes whose group is missing are left out.
+
+        '''
+        # within a session the file is not flushed, rely on invalidation
+        stamp = None if self._h5_file else self._file_stamp()
+        if self._catalog is not None and (stamp is None or
+                self._catalog[0] == stamp):
+            return self._catalog[1]
+        catalog = dict()
+        with self._open('r') as h5_file:
+            sdcubes = load_attribute(h5_file, 'sdcubes')
+            for name, filename in sdcubes.iteritems():
+                if filename == self.filename:
+                    mapping = cube_mapping(h5_file, name)
+                elif os.path.exists(filename):
+                    with h5py.File(filename, 'r') as cube_file:
+                        mapping = cube_mapping(cube_file, name)
+                else:
+                    mapping = None
+                if mapping is None:
+                    # e.g. left behind by an older delete_cube
+                    logging.warning('The registered cube %s is missing in %s'
+                            % (name, filename))
+                    continue
+                catalog[name] = (filename, mapping)
+        if stamp is None:
+            stamp = self._file_stamp()
+        self._catalog = (stamp, catalog)
+        return catalog
+
     def get_sdcube(self, name):
         ''' Load the sdcube with the name name. 
         If filename is not given assume the sdcube is in the project file.
+        The cube is looked up in the catalog, the file is not opened.
 
         '''
-        with h5py.File(self.filename, 'r') as h5_file:
-            sdcubes = load_attribute(h5_file, 'sdcubes')
-        return SdCube.load(sdcubes[name], name)
+        catalog = self.get_catalog()
+        if not name in catalog:
+            logging.error('No sdcube with the name %s' % name)
+            raise KeyError('No sdcube with the name %s' % name)
+        filename, mapping = catalog[name]
+        if filename == self.filename:
+            return SdCube.attach(filename, name, h5_file=self._h5_file)
+        return SdCube.attach(filename, name)
     
-    def add_sdcube(self, mapping, name=None):
+    def add_sdcube(self, mapping, name=None, storage=None):
         ''' Add an sd cube to the project. Return the created name and the
         filename.
+        storage are the storage options of the cube (see SdCube).
 
         '''
-        with h5py.File(self.filename, 'r') as h5_file:
+        with self._open('r') as h5_file:
             sdcubes = load_attribute(h5_file, 'sdcubes')
             if name in sdcubes:
                 logging.error('A group with the name %s alread exists' % name)
                 raise KeyError('A group with the name %s alread exists' % name)
+            if name and name.startswith(RESERVED_PREFIX):
+                logging.error('Names starting with %s are reserved' %
+                        RESERVED_PREFIX)
+                raise ValueError('Names starting with %s are reserved' %
+                        RESERVED_PREFIX)
             for key in sdcubes:
                 if name.lower() == key:
                     raise Warning('%s looks like %s!' % (name, key))
@@ -93,12 +248,13 @@ class Hdf5:
         filename = self.filename
 
 
-        SdCube(name, filename, mapping)
-        with h5py.File(self.filename, 'a') as h5_file:
+        SdCube(name, filename, mapping, h5_file=self._h5_file,
+                storage=storage)
+        with self._open('a') as h5_file:
             sdcubes = load_attribute(h5_file, 'sdcubes')
             sdcubes[name] = filename
-            store_attribute(h5_file, 'sdcubes', sdcubes)
-            store_attribute(h5_file[name], 'dirty', True)
+            self._store_sdcubes(h5_file, sdcubes)
+            touch(h5_file[name])
         return name
 
     def delete_cube(self, group_name):
@@ -106,17 +262,18 @@ class Hdf5:
 
         '''
         logging.info('Try to delete: %s' % group_name)
-        with h5py.File(self.filename, 'a') as h5_file:
+        with self._open('a') as h5_file:
             try:
                 sdcubes = load_attribute(h5_file, 'sdcubes')
                 del sdcubes[group_name]
+                self._store_sdcubes(h5_file, sdcubes)
                 del h5_file[group_name]
                 logging.info('Deleted: %s' % group_name)
             except KeyError: #change the error text and log
                 logging.error('Unable to delete the group %s' % group_name)
                 raise KeyError('Unable to delete the group %s' % group_name)
     def add_function(self, func):
-        ''' Add a function to the project
+        ''' Add a function to the project. Return the id of the function.
 
         '''
         if func.name == "" or \
@@ -124,73 +281,266 @@ class Hdf5:
                 not func.output_cube_names:
             raise ValueError('name, input_dsets and output_dsets must not be'
                     'empty')
-        with h5py.File(self.filename,'a') as hdf5_file:
-            functions = pickle.loads(str(hdf5_file.attrs['functions']))
-            functions.append(func)
-            hdf5_file.attrs['functions'] = pickle.dumps(functions)
+        with self._open('a') as hdf5_file:
+            return registry.add(hdf5_file, func)
 
     def del_function(self, function):
         ''' Remove a function <-> cube mapping from the project.
+        function is a function or the id of a function.
 
         '''
-        with h5py.File(self.filename,'a') as hdf5_file:
-            functions = pickle.loads(str(hdf5_file.attrs['functions']))
-            # can't test for object equality so iterate over all functions
-            for func in functions:
+        with self._open('a') as hdf5_file:
+            if isinstance(function, (int, long)):
+                registry.delete(hdf5_file, function)
+                return
+            # can't test for object equality so compare the functions
+            # producing the same output
+            func_ids = registry.producers(hdf5_file,
+                    function.output_cube_names[0])
+            for func_id, func in zip(func_ids, registry.get_many(hdf5_file,
+                    func_ids)):
                 if str(func) == str(function):
-                    functions.remove(func)
-            hdf5_file.attrs['functions'] = pickle.dumps(functions)
+                    registry.delete(hdf5_file, func_id)
 
     def get_functions(self):
         ''' Returns all function <-> cube mappings from the project
 
         '''
-        with h5py.File(self.filename, 'r') as hdf5_file:
-            return pickle.loads(str(hdf5_file.attrs['functions']))
+        with self._open('r') as hdf5_file:
+            return [func for func_id, func in registry.functions(hdf5_file)]
+
+    def get_function(self, func_id):
+        ''' Return the function with the id func_id.
+
+        '''
+        with self._open('r') as hdf5_file:
+            return registry.get(hdf5_file, func_id)
+
+    def get_function_ids(self, cube_name, role='consumers'):
+        ''' Return the ids of the functions with the cube cube_name as input
+        (role 'consumers') or as output (role 'producers').
+
+        '''
+        if not role in ('consumers', 'producers'):
+            logging.error('Unknown role: %s' % role)
+            raise ValueError('Unknown role: %s' % role)
+        with self._open('r') as hdf5_file:
+            return getattr(registry, role)(hdf5_file, cube_name)
+
+    def get_cache_limit(self):
+        ''' Return the number of bytes of function outputs kept in the cache
+        (see cache).
+
+        '''
+        with self._open('r') as h5_file:
+            return int(h5_file.attrs.get('cache_limit', CACHE_LIMIT))
+
+    def set_cache_limit(self, value):
+        ''' Set the size limit of the cache and evict entries above it. A
+        limit of 0 disables the cache.
+
+        '''
+        with self._open('a') as h5_file:
+            h5_file.attrs['cache_limit'] = value
+            evict(h5_file, value)
 
     def execute_function(self, func):
         ''' Executes a function and set the output dataset status to dirty.
+        Output cubes of an earlier run are replaced, or left as they were if
+        the function raises an exception. If the function already ran with
+        the same params on inputs with the same content the cached output
+        cubes are linked (or copied) instead.
 
         '''
 #TODO make me work for non python functions
         logging.info('Importing the function: %s' % func)
-        with h5py.File(self.filename, 'a') as h5_file:
+        with self._open('a') as h5_file:
             input_cubes = []
             for input_cube_name in func.input_cube_names:
                 input_cubes.append(h5_file[input_cube_name])
-            logging.info('Executing the function: %s' % func)
-            func.__call__(input_cubes, func.output_cube_names,
-                    func.params)
-            sdcubes = load_attribute(h5_file, 'sdcubes')
+            consumed = self.__input_versions(h5_file, func)
+            key = function_key(func, input_cubes)
+            if self.__link_cached(h5_file, func, key, consumed):
+                return
+            # the outputs of an earlier run are kept until the function
+            # succeeded
+            previous = dict()
             for output_cube_name in func.output_cube_names:
-                sdcubes[output_cube_name] = self.filename
-                logging.info('Set the dirty status for the output datasets')
-                h5_file[output_cube_name].attrs['dirty'] = True
-            store_attribute(h5_file, 'sdcubes', sdcubes)
-
-    def recompute(self):
-        ''' Look for all functions with dirty(changed) datasets.
-        Then execute those functions and remove the dirty state.
-
-        '''
-        dirty_funcs = []
-        with h5py.File(self.filename, 'r') as hdf5_file:
-            logging.info('Collecting all functions containing dirty datasets')
-            for func in self.get_functions():
-                for dset in func.input_cube_names:
-                    if hdf5_file[dset].attrs['dirty']:
-                        dirty_funcs.append(func)
-        for func in set(dirty_funcs):
-            logging.info('Execute all functions with dirty datasets')
-            self.execute_function(func)
-        with h5py.File(self.filename, 'a') as hdf5_file:
+                if output_cube_name in h5_file:
+                    previous[output_cube_name] = RESERVED_PREFIX + \
+                            'previous_' + output_cube_name
+                    if previous[output_cube_name] in h5_file:
+                        del h5_file[previous[output_cube_name]]
+                    h5_file.move(output_cube_name,
+                            previous[output_cube_name])
+            logging.info('Executing the function: %s' % func)
+            try:
+                func.__call__(input_cubes, func.output_cube_names,
+                        func.params)
+            except:
+                logging.error('The function %s failed, restoring its outputs'
+                        % func)
+                for output_cube_name in func.output_cube_names:
+                    if output_cube_name in h5_file:
+                        del h5_file[output_cube_name]
+                    if output_cube_name in previous:
+                        h5_file.move(previous[output_cube_name],
+                                output_cube_name)
+                raise
+            for previous_name in previous.values():
+                del h5_file[previous_name]
+            self.__register_outputs(h5_file, func, consumed, key)
+
+    def __link_cached(self, h5_file, func, key, consumed):
+        ''' Link (or copy, see cache.install) the cached output cubes of the
+        function func with the key. Output cubes that are the cached ones (or
+        unchanged copies) already are left alone.
+        Return False if there are no cached output cubes.
+
+        '''
+        entry = lookup(h5_file, key)
+        if entry is None:
+            return False
+        logging.info('Using the cached output of: %s' % func)
+        sdcubes = load_attribute(h5_file, 'sdcubes')
+        for index, output_cube_name in enumerate(func.output_cube_names):
+            if not output_cube_name in h5_file or not is_cached(h5_file[
+                    output_cube_name], key):
+                if output_cube_name in h5_file:
+                    del h5_file[output_cube_name]
+                install(h5_file, entry, index, output_cube_name)
+                bump_version(h5_file[output_cube_name])
+            sdcubes[output_cube_name] = self.filename
+            grp = h5_file[output_cube_name]
+            store_attribute(grp, 'produced_by', str(func))
+            store_attribute(grp, 'consumed', consumed)
+        self._store_sdcubes(h5_file, sdcubes)
+        return True
+
+    def __input_versions(self, h5_file, func):
+        ''' Return a dictionary {input cube name: version} of the function
+        func, the version is None for input cubes that don't exist.
+
+        '''
+        return dict((name, cube_version(h5_file[name]) if name in h5_file
+            else None) for name in func.input_cube_names)
+
+    def __register_outputs(self, h5_file, func, consumed, key):
+        ''' Add the output cubes of the function func to the project, give
+        them a new version and record the function and the versions of the
+        input cubes consumed (see is_stale). Keep them in the cache under
+        the key.
+
+        '''
+        sdcubes = load_attribute(h5_file, 'sdcubes')
+        for output_cube_name in func.output_cube_names:
+            sdcubes[output_cube_name] = self.filename
+            logging.info('Set the dirty status for the output datasets')
+            grp = h5_file[output_cube_name]
+            clear_hashes(grp)
+            bump_version(grp)
+            store_attribute(grp, 'produced_by', str(func))
+            store_attribute(grp, 'consumed', consumed)
+        self._store_sdcubes(h5_file, sdcubes)
+        store(h5_file, key, [h5_file[name] for name in
+            func.output_cube_names], int(h5_file.attrs.get('cache_limit',
+                CACHE_LIMIT)))
+
+    def is_stale(self, func):
+        ''' Return whether the output of the function func is out of date:
+        an output cube is missing, it was produced by another function or
+        from other versions of the input cubes than the current ones.
+
+        '''
+        with self._open('r') as h5_file:
+            consumed = self.__input_versions(h5_file, func)
+            for name in func.output_cube_names:
+                if not name in h5_file:
+                    return True
+                grp = h5_file[name]
+                if not 'consumed' in grp.attrs or not 'produced_by' in \
+                        grp.attrs:
+                    return True
+                if not load_attribute(grp, 'produced_by') == str(func) or \
+                        not load_attribute(grp, 'consumed') == consumed:
+                    return True
+            return False
+
+    def recompute(self, workers=1):
+        ''' Execute exactly the functions whose output is out of date (see
+        is_stale) and all functions depending on their output, each once,
+        in topological order, and remove the dirty state.
+        A function runs after the functions producing its inputs. With more
+        than one worker independent functions run concurrently in a pool of
+        workers processes (see scheduler).
+
+        '''
+        with self.session('r'):
+            functions = self.get_functions()
+            logging.info('Collecting all functions with changed inputs')
+            stale = [index for index, func in enumerate(functions) if
+                    self.is_stale(func)]
+        order = topological_order(functions, downstream(functions, stale))
+        if workers > 1 and len(order) > 1:
+            logging.info('Execute all functions with changed inputs in %d'
+                    ' processes' % workers)
+            self.__execute_parallel(functions, order, workers)
+        else:
+            for index in order:
+                logging.info('Execute all functions with changed inputs')
+                self.execute_function(functions[index])
+        with self._open('a') as hdf5_file:
             logging.info('Remove the dirty state from alle datasets')
-            for func in dirty_funcs:
-                for dset in func.input_cube_names:
+            for index in order:
+                for dset in functions[index].input_cube_names:
                     hdf5_file[dset].attrs['dirty'] = False
-                for dset in func.output_cube_names:
+                for dset in functions[index].output_cube_names:
                     hdf5_file[dset].attrs['dirty'] = False
 
+    def __execute_parallel(self, functions, order, workers):
+        ''' Run the functions with the indices order of the list functions
+        in scratch files and copy their output cubes into the project.
+        Functions not depending on other functions of order are looked up in
+        the cache first.
+
+        '''
+        depends = dependencies(functions)
+        with self._open('a') as h5_file:
+            cached = set()
+            for index in order:
+                func = functions[index]
+                if depends[index] & set(order) or not all(name in h5_file
+                        for name in func.input_cube_names):
+                    continue
+                key = function_key(func, [h5_file[name] for name in
+                    func.input_cube_names])
+                if self.__link_cached(h5_file, func, key,
+                        self.__input_versions(h5_file, func)):
+                    cached.add(index)
+            sdcubes = load_attribute(h5_file, 'sdcubes')
+        order = [index for index in order if not index in cached]
+        if not order:
+            return
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        outputs = run_parallel(functions, order, sdcubes, workers,
+                directory)
+        try:
+            with self._open('a') as h5_file:
+                for func in [functions[index] for index in order]:
+                    # upstream outputs are already installed
+                    consumed = self.__input_versions(h5_file, func)
+                    key = function_key(func, [h5_file[name] for name in
+                        func.input_cube_names])
+                    for name in func.output_cube_names:
+                        if name in h5_file:
+                            del h5_file[name]
+                        with h5py.File(outputs[name], 'r') as scratch:
+                            scratch.copy(scratch[name], h5_file, name=name)
+                    self.__register_outputs(h5_file, func, consumed, key)
+        finally:
+            for filename in set(outputs.values()):
+                os.remove(filename)
+
 class SdCube(object):
     ''' A SdCube is a h5py group with a mapping attached
     It has a list with the containing datasets and another list with the
@@ -198,9 +548,16 @@ class SdCube(object):
 
     '''
 
-    def __init__(self, name, filename, dim_labels, units=[]):
+    def __init__(self, name, filename, dim_labels, units=[], h5_file=None,
+            storage=None):
         ''' Create a group with the name in an hdf5 file.
         If the group existed in the file before delete it.
+        If h5_file is an open session handle of filename all operations of
+        the SdCube use it instead of opening the file themselves.
+        storage is a dictionary of options for the datasets of the cube,
+        e.g. {'chunks': 'auto', 'compression': 'gzip', 'shuffle': True,
+        'dtype': 'f8'} (see blocks.check_storage_options). Cubes derived by
+        functions inherit them.
 
         '''
         mapping = dict([dim, i] for i, dim in enumerate(dim_labels))
@@ -212,41 +569,177 @@ class SdCube(object):
                     ' dimensions.')
             raise ValueError('The number of units is not equal to the number'
             ' of dimensions.')
+        if storage:
+            check_storage_options(storage)
         self.name = name
         self.filename = filename
-        with h5py.File(self.filename, 'a') as h5_file:
+        self._h5_file = h5_file
+        if self._h5_file and name in self._h5_file:
+            # do not require a writable session for existing groups
+            logging.info('Group already exists.')
+            return
+        with self._open('a') as h5_file:
             try:
                 logging.info('Group created.')
+                init_format(h5_file)
                 self.grp = h5_file.create_group(name)
                 storeMapping(self.grp, mapping)
                 store_attribute(self.grp, 'units', units)
+                if storage:
+                    store_attribute(self.grp, 'storage', storage)
             except ValueError:
                 logging.info('Group already exists.')
     
     @classmethod
-    def load(cls, filename, group_name, units=[]):
+    def attach(cls, filename, group_name, h5_file=None):
+        ''' Return the SdCube of the existing group group_name of the file
+        filename without opening the file.
+
+        '''
+        sdcube = cls.__new__(cls)
+        sdcube.name = group_name
+        sdcube.filename = filename
+        sdcube._h5_file = h5_file
+        return sdcube
+
+    @classmethod
+    def load(cls, filename, group_name, units=[], h5_file=None):
         ''' Load an existing SdCube from an hdf5 file.
 
         '''
         if not os.path.exists(filename):
             logging.error('The SdCube does not exist.')
             raise ValueError('The SdCube does not exist.')
-        with h5py.File(filename, 'r') as h5_file:
+        with open_file(filename, 'r', h5_file) as opened_file:
             try:
                 # The first key should the name of the group
-                group = h5_file[group_name]
+                group = opened_file[group_name]
                 mapping = load_mapping(group)
             except KeyError:
                 logging.error('The file seems to be invalid.')
                 raise KeyError('The file seems to be invalid.')
-        return(cls(group_name, filename, mapping, units))
+        return(cls(group_name, filename, mapping, units, h5_file=h5_file))
+
+    @classmethod
+    def from_records(cls, project, records, dim_labels=None, value='value',
+            name=None, split=None, storage=None, block_size=BLOCK_SIZE):
+        ''' Create the cube name in the project from a long table records,
+        a numpy structured array or a dictionary of equally long columns,
+        with one row per data point: the index labels of the dimensions
+        dim_labels (default: all columns but value) and the value.
+        Every label column is factorized (sorted distinct labels and their
+        codes) and the values are scattered into place, block by block.
+        Without split the cube gets one dataset spanning all labels; with
+        split (a dimension label) it gets one dataset per label of that
+        dimension, spanning only the labels of the others occurring with it.
+        Missing data points are NaN. The values keep their type (or become
+        floats if some are missing) unless the 'dtype' storage option holds
+        them (see blocks.dataset_options). Return the SdCube.
+
+        '''
+        if isinstance(records, numpy.ndarray):
+            columns = records.dtype.names
+            column = lambda key: records[key]
+        else:
+            columns = records.keys()
+            column = lambda key: numpy.asarray(records[key])
+        if dim_labels is None:
+            dim_labels = [key for key in columns if key != value]
+        if not value in columns or not set(dim_labels) <= set(columns):
+            logging.error('The records lack a column')
+            raise KeyError('The records lack a column')
+        if split is not None and not split in dim_labels:
+            logging.error('Unknown dimension: %s' % split)
+            raise ValueError('Unknown dimension: %s' % split)
+        values = column(value)
+        labels = list()
+        codes = list()
+        for dim_label in dim_labels:
+            dim_values, dim_codes = numpy.unique(column(dim_label),
+                    return_inverse=True)
+            labels.append(dim_values.tolist())
+            codes.append(dim_codes)
+
+        # one group of rows per dataset
+        if split is None:
+            groups = [numpy.arange(len(values))]
+        else:
+            split_codes = codes[dim_labels.index(split)]
+            order = numpy.argsort(split_codes, kind='mergesort')
+            bounds = numpy.searchsorted(split_codes[order],
+                    numpy.arange(len(labels[dim_labels.index(split)]) + 1))
+            groups = [order[start:stop] for start, stop in zip(bounds[:-1],
+                bounds[1:])]
+        layouts = list()
+        dtype = values.dtype
+        for rows in groups:
+            dimensions = dict()
+            local_codes = list()
+            for dim_label, dim_values, dim_codes in zip(dim_labels, labels,
+                    codes):
+                used, local = numpy.unique(dim_codes[rows],
+                        return_inverse=True)
+                dimensions[dim_label] = [dim_values[code] for code in used]
+                local_codes.append(local)
+            shape = tuple(len(dimensions[dim_label]) for dim_label in
+                    dim_labels)
+            flat = numpy.ravel_multi_index(local_codes, shape)
+            order = numpy.argsort(flat, kind='mergesort')
+            flat = flat[order]
+            if len(flat) > 1 and not (flat[1:] > flat[:-1]).all():
+                logging.error('The records hold a data point twice')
+                raise ValueError('The records hold a data point twice')
+            if len(flat) < numpy.prod(shape):
+                dtype = numpy.promote_types(dtype, numpy.float64)
+            layouts.append((dimensions, shape, flat, rows[order]))
+
+        name = project.add_sdcube(dim_labels, name=name, storage=storage)
+        sdcube = project.get_sdcube(name)
+        with sdcube._open('a') as h5_file:
+            names = sdcube.create_datasets([dimensions for dimensions, shape,
+                flat, rows in layouts], dtype)
+            grp = h5_file[name]
+            for dset_name, (dimensions, shape, flat, rows) in zip(names,
+                    layouts):
+                dset = grp[dset_name]
+                for selection, data in dense_blocks(shape, flat,
+                        values[rows].astype(dtype), block_size=block_size):
+                    dset[selection] = data
+                    update_hash(dset, selection, data)
+            touch(grp)
+        return sdcube
+
+    @contextmanager
+    def session(self, mode='r'):
+        ''' Keep the file of the SdCube open for the duration of the with
+        block and route all operations through that handle.
+        mode is 'r' for reading or 'a' for appending.
+
+        '''
+        if self._h5_file:
+            with self._open(mode):
+                yield self
+            return
+        with h5py.File(self.filename, mode) as h5_file:
+            self._h5_file = h5_file
+            try:
+                yield self
+            finally:
+                self._h5_file = None
+
+    def _open(self, mode='r'):
+        ''' Return a context manager for the file of the SdCube that reuses
+        the session handle if there is one.
+
+        '''
+        return open_file(self.filename, mode, self._h5_file)
 
     @property
     def group(self):
         ''' Return the group.
 
         '''
-        with h5py.File(self.filename, 'r') as h5_file:
+        with self._open('r') as h5_file:
             return h5_file[self.name]
 
     @property
@@ -254,7 +747,7 @@ class SdCube(object):
         ''' Return the unit mapping for the group.
 
         '''
-        with h5py.File(self.filename, 'r') as h5_file:
+        with self._open('r') as h5_file:
             return load_attribute(h5_file[self.name], 'units')
 
     @unit_mapping.setter
@@ -268,15 +761,41 @@ class SdCube(object):
             ' dimensions')
             raise ValueError('The number of units must be equal to the number'
             ' of dimensions')
-        with h5py.File(self.filename, 'a') as h5_file:
+        with self._open('a') as h5_file:
             store_attribute(h5_file[self.name],'units',  value)
     
+    @property
+    def version(self):
+        ''' Return the version of the group. It changes whenever the data or
+        the datasets of the group change.
+
+        '''
+        with self._open('r') as h5_file:
+            return cube_version(h5_file[self.name])
+
+    @property
+    def storage_options(self):
+        ''' Return the storage options of the group.
+
+        '''
+        with self._open('r') as h5_file:
+            return storage_options(h5_file[self.name])
+
+    @storage_options.setter
+    def storage_options(self, value):
+        ''' Set the storage options used for new datasets of the group.
+
+        '''
+        check_storage_options(value)
+        with self._open('a') as h5_file:
+            store_attribute(h5_file[self.name], 'storage', value)
+
     @property
     def mapping(self):
         ''' Return the mapping for the group.
             
         '''
-        with h5py.File(self.filename, 'r') as h5_file:
+        with self._open('r') as h5_file:
             return load_mapping(h5_file[self.name])
 
     @mapping.setter
@@ -290,18 +809,83 @@ class SdCube(object):
         if not is_sequential(value.values()):
             logging.error('Dimensions must be sequently.')
             raise ValueError('Dimensions must be sequently.')
-        with h5py.File(self.filename, 'a') as h5_file:
+        with self._open('a') as h5_file:
             storeMapping(h5_file[self.name], value)
 
     def create_dataset(self, dimensions):
         ''' Create a dataset within the SdCube
 
+        '''
+        self.create_datasets([dimensions])
+
+    def create_datasets(self, dimensions_list, dtype=None):
+        ''' Create a dataset within the SdCube for every dimensions
+        dictionary of dimensions_list, holding data of the type dtype (see
+        blocks.dataset_options) if given.
+        All new datasets are checked against the existing ones and against
+        each other before the first one is created, so either all of them or
+        none are created.
+        Return the names of the new datasets.
+
+        '''
+        with self._open('a') as h5_file:
+            grp = h5_file[self.name]
+            group_mapping = load_mapping(grp)
+            index = extent_index(grp)
+            rank = len(next(index.mappings.itervalues())) if index.mappings \
+                    else None
+            new = ExtentIndex()
+            datasets = list()
+            for number, dimensions in enumerate(dimensions_list):
+                dset_mapping, dims = self.__dataset_mapping(group_mapping,
+                        dimensions)
+                # check if there already is a dataset and if the number 
+                # of dimensions is equal to the new one '''
+                if rank is not None and not rank == len(dims):
+                    logging.error('The new dataset has the wrong number of'
+                            'dimensions: %s' % self.filename)
+                    raise ValueError('The dataset has the wrong number of'
+                    'dimensions')
+                if index.overlapping(dset_mapping) or \
+                        new.overlapping(dset_mapping):
+                    logging.error('The new dataset shares some datapoints '
+                             ' with at least one existing dataset. Aborting'
+                             ' insert.')
+                    raise ValueError('The new dataset shares some datapoints'
+                            ' with an existing dataset')
+                new.add(number, dset_mapping)
+                datasets.append((dset_mapping, dims))
+
+            logging.info('Creating %d datasets: %s' % (len(datasets),
+                self.name))
+            # the dset names are just the next available numbers
+            number = int(index.next_name(grp))
+            records = list()
+            for dset_mapping, dims in datasets:
+                while str(number) in grp:
+                    number += 1
+                name = str(number)
+                dset = grp.create_dataset(name, dims, **dataset_options(grp,
+                    tuple(dims), dtype))
+                store_labels(dset, dset_mapping)
+                init_hash(dset, dset_mapping)
+                records.append((name, dset_mapping))
+            record_extents(grp, index, records)
+            if records:
+                touch(grp)
+            logging.info('Datasets created.')
+            return [name for name, dset_mapping in records]
+
+    def __dataset_mapping(self, group_mapping, dimensions):
+        ''' Return the dataset mapping {dimension_index: index_labels} and the
+        shape of a new dataset with the dimensions dictionary
+        {dimension_label: index_labels}.
+
         '''
         if not dimensions:
             logging.error('Dimension must not be empty')
             raise ValueError('Dimension must not be empty')
-        group_mapping = self.mapping
-        if not dimensions.keys() == self.mapping.keys():
+        if not sorted(dimensions.keys()) == sorted(group_mapping.keys()):
             logging.error('The dataset must have the same dimension labels as'
                     ' the old dataset.')
             raise ValueError('The dataset must have the same dimension labels'
@@ -311,42 +895,33 @@ class SdCube(object):
         for dim_label, dim_index in group_mapping.items():
             dset_mapping[dim_index] = dimensions[dim_label]
             dims[dim_index] = len(dimensions[dim_label])
-        #for dim_label, index_labels in dimensions.items():
-        #    dset_mapping[group_mapping[dim_label]] = index_labels
-        #dset_mapping = dict([i, v] for i, (k, v) in enumerate(dimensions))
-        #dims = [len(value) for value in dimensions.values()]
+        return dset_mapping, dims
 
-        with h5py.File(self.filename, 'a') as h5_file:
+    def delete_dataset(self, name):
+        ''' Delete the dataset with the name name from the SdCube.
+
+        '''
+        with self._open('a') as h5_file:
             grp = h5_file[self.name]
-            # check if there already is a dataset and if the number 
-            # of dimensions is equal to the new one '''
-            if grp.keys():
-                if not len(grp[grp.keys()[0]].shape) == len(dims):
-                    logging.error('The new dataset has the wrong number of'
-                            'dimensions: %s' % self.filename)
-                    raise ValueError('The dataset has the wrong number of'
-                    'dimensions')
-                for key in grp.keys():
-                    mapping = load_mapping(grp[key])
-                    share_points = True
-                    for key in mapping:
-                        if not [x for x in mapping[key] if x in
-                                dset_mapping[key]]:
-                            share_points = False
-                if share_points:
-                    logging.error('The new dataset shares some datapoints '
-                             ' with at least one existing dataset. Aborting'
-                             ' insert.')
-                    raise ValueError('The new dataset shares some datapoints'
-                            ' with an existing dataset')
-                    
-            logging.info('Creating dataset: ' + self.name)
-            # the dset name is just the next available number
-            dset = grp.create_dataset(str(len(grp.keys())), dims)
-            dset.attrs['mapping'] = pickle.dumps(dset_mapping)
-            grp.attrs['dirty'] = True
-            grp.attrs['mapping'] = pickle.dumps(group_mapping)
-            logging.info('Dataset created.')
+            if name.startswith(RESERVED_PREFIX) or not name in grp:
+                logging.error('Unable to delete the dataset %s' % name)
+                raise KeyError('Unable to delete the dataset %s' % name)
+            index = extent_index(grp)
+            del grp[name]
+            delete_labels(grp, name)
+            record_extent(grp, index, name)
+            touch(grp)
+            logging.info('Deleted dataset: %s' % name)
+
+    def materialize(self, block_size=BLOCK_SIZE):
+        ''' Replace the virtual datasets of the SdCube (e.g. created by a
+        virtual JoinCubes or a Create_subcube view) by real datasets holding
+        a copy of the data.
+
+        '''
+        with self._open('a') as h5_file:
+            materialize(h5_file[self.name], block_size)
+            h5_file[self.name].attrs['dirty'] = True
 
     def set_data(self, location, data):
         ''' Search for the right cube in the group and check if the
@@ -356,58 +931,124 @@ class SdCube(object):
         '''
         logging.info('Setting data in: ' + self.name)
 
-        with h5py.File(self.filename) as h5_file:
+        with self._open('a') as h5_file:
             grp = h5_file[self.name]
-            group_mapping = self.mapping
-            if not len(location) == len(group_mapping.keys()):
-                logging.error('Please specify a single point')
-                raise ValueError('Please specify a single point')
-
-            if not len(location) == len(data.shape):
-                logging.error('data should have as many dimensions as the '
-                        'dataset')
-                raise ValueError('data should have as many dimensions as the '
-                        'dataset')
-            for key in location.keys():
-                if not key in group_mapping.keys():
-                    logging.error('Index not in mapping.')
-                    raise ValueError('Index not in mapping.')
-            
+            group_mapping = load_mapping(grp)
             destination_dset, ind = self.__get_dataset_with_indices(grp,
-                    location, data)
-            if not destination_dset:
-                logging.error('No valid dataset found.')
-                raise ValueError('No valid dataset found.')
-
-            for dim_index, dim_length in enumerate(data.shape):
-                if dim_length > destination_dset.shape[dim_index]:
-                    logging.error('The given data is too big for the '
-                    'dataset.')
-                    raise ValueError('The given data is too big.')
+                    group_mapping, location, data)
             destination_dset[tuple(ind)] = data
-            grp.attrs['dirty'] = True
+            update_hash(destination_dset, ind, data)
+            touch(grp)
+            logging.info('Data set.')
+
+    def set_data_many(self, blocks):
+        ''' Set the data of many blocks, a list of (location, data) pairs as
+        passed to set_data.
+        The file is opened once, all destinations are resolved before the
+        first write and the writes are sorted by dataset and offset.
+        Nothing is written if any of the blocks does not fit.
+
+        '''
+        logging.info('Setting data of many blocks in: ' + self.name)
+
+        with self._open('a') as h5_file:
+            grp = h5_file[self.name]
+            self.__set_blocks(grp, load_mapping(grp), blocks)
+            touch(grp)
             logging.info('Data set.')
 
-    def __get_dataset_with_indices(self, grp, indices, data):
-        ''' Find the dataset within the group grp that contains the indices.
+    def set_data_iter(self, blocks, batch_size=1024):
+        ''' Set the data of the (location, data) pairs yielded by the iterable
+        blocks, e.g. a generator, without holding all of them in memory.
+        The blocks are written in batches of batch_size blocks, each sorted
+        like in set_data_many, within one session.
+        Return the number of blocks written.
+
         '''
+        logging.info('Setting data of many blocks in: ' + self.name)
+
+        count = 0
+        with self._open('a') as h5_file:
+            grp = h5_file[self.name]
+            group_mapping = load_mapping(grp)
+            batch = []
+            for block in blocks:
+                batch.append(block)
+                if len(batch) == batch_size:
+                    count += self.__set_blocks(grp, group_mapping, batch)
+                    batch = []
+            count += self.__set_blocks(grp, group_mapping, batch)
+            touch(grp)
+            logging.info('Data set.')
+        return count
+
+    def __set_blocks(self, grp, group_mapping, blocks):
+        ''' Write the (location, data) pairs blocks into the group grp.
+        Return the number of blocks written.
+
+        '''
+        index = extent_index(grp)
+        datasets = {}
+        writes = []
+        for location, data in blocks:
+            destination_dset, ind = self.__get_dataset_with_indices(grp,
+                    group_mapping, location, data, index, datasets)
+            writes.append((destination_dset.name, [part.start for part in
+                ind], destination_dset, tuple(ind), data))
+        writes.sort(key=lambda write: write[:2])
+        for name, offset, destination_dset, ind, data in writes:
+            destination_dset[ind] = data
+            update_hash(destination_dset, ind, data)
+        return len(writes)
+
+    def __get_dataset_with_indices(self, grp, group_mapping, location, data,
+            index=None, datasets=None):
+        ''' Find the dataset within the group grp that contains the location
+        and check that the data fits into it.
+        Return the dataset and the selection of the data within it.
+        index is the extent index of grp, datasets a dictionary
+        {name: (dataset, label index)} that caches the datasets found.
+
+        '''
+        if not len(location) == len(group_mapping.keys()):
+            logging.error('Please specify a single point')
+            raise ValueError('Please specify a single point')
+
+        if not len(location) == len(data.shape):
+            logging.error('data should have as many dimensions as the '
+                    'dataset')
+            raise ValueError('data should have as many dimensions as the '
+                    'dataset')
+        for key in location.keys():
+            if not key in group_mapping.keys():
+                logging.error('Index not in mapping.')
+                raise ValueError('Index not in mapping.')
 
-        group_mapping = pickle.loads(grp.attrs['mapping'])
         ind = [slice(0, dim_length, 1) for dim_length in data.shape]
-        destination_dset = None
-        for dset in grp.values():
-            dataset_valid = True
-            for key, value in indices.iteritems():
-                index = self.index(group_mapping[key], value, dset)
-                if index == -1:
-                    dataset_valid = False
-                    break 
-                ind[group_mapping[key]] = slice(index, index +
-                        data.shape[group_mapping[key]], 1)
-            if not dataset_valid:
-                continue 
-            destination_dset = dset
-            break #dataset found
+        point = dict((group_mapping[key], value) for key, value in
+                location.iteritems())
+        if index is None:
+            index = extent_index(grp)
+        names = index.locate(point)
+        if not names:
+            logging.error('No valid dataset found.')
+            raise ValueError('No valid dataset found.')
+        if datasets is None:
+            datasets = {}
+        name = min(names)
+        if not name in datasets:
+            dataset = grp[name]
+            datasets[name] = dataset, label_index(dataset)
+        destination_dset, dset_index = datasets[name]
+        for dim_index, value in point.iteritems():
+            index = dset_index.position(dim_index, value)
+            ind[dim_index] = slice(index, index + data.shape[dim_index], 1)
+        # the data has to fit from its location on, checked before any write
+        for dim_index, part in enumerate(ind):
+            if part.stop > destination_dset.shape[dim_index]:
+                logging.error('The given data is too big for the '
+                'dataset.')
+                raise ValueError('The given data is too big.')
         return destination_dset, ind
 
     def index(self, dimension_index, index_label, dset):
@@ -415,10 +1056,7 @@ class SdCube(object):
         data cube and the index of the value within that.
         
         '''
-        mapping = pickle.loads(str(dset.attrs['mapping']))
-        if index_label in mapping[dimension_index]:
-            return mapping[dimension_index].index(index_label)
-        return -1
+        return label_index(dset).position(dimension_index, index_label)
         
     def get_data(self, items={}):
         ''' Get the data that matches the items.
@@ -433,11 +1071,13 @@ class SdCube(object):
         '''
         first_index_labels = {}
         try:
-            mapping = pickle.loads(str(dset.attrs['mapping']))
+            mapping = dataset_labels(dset)
         except AttributeError:
-            with h5py.File(self.filename,'r') as h5_file:
-                mapping = pickle.loads(str(h5_file[dset].attrs['mapping']))
-        group_mapping = self.mapping
+            with self._open('r') as h5_file:
+                mapping = dataset_labels(h5_file[dset])
+                group_mapping = load_mapping(h5_file[self.name])
+        else:
+            group_mapping = load_mapping(dset.parent)
         for dim_label, index_label in items.items():
             mapping[group_mapping[dim_label]] = [index_label]
         reverse_grp_map = dict((v, k) for k, v in group_mapping.iteritems())
@@ -451,65 +1091,95 @@ class SdCube(object):
         Return the remaining datasets and their first indices.
 
         '''
-        with h5py.File(self.filename,'r') as hdf5_file:
+        with self._open('r') as hdf5_file:
             data = []
-            inds = []
             first_inds = []
 
             grp = hdf5_file[self.name]
-            for dataset in grp.values():
-                shape = dataset.shape
-                data.append(dataset[...])
-                inds.append([slice(None, None, None)] * len(shape))
+            group_mapping = load_mapping(grp)
+            point = dict((group_mapping[dim_label], index_label) for
+                    dim_label, index_label in items.iteritems())
+            # datasets that do not match items are never read
+            for name in sorted(extent_index(grp).locate(point)):
+                dataset = grp[name]
+                dset_index = label_index(dataset)
+                # read only the hyperslab of the items, keep all dimensions
+                selection = [slice(None, None, None)] * len(dataset.shape)
+                for dim_index, index_label in point.iteritems():
+                    position = dset_index.position(dim_index, index_label)
+                    selection[dim_index] = slice(position, position + 1)
+                data.append(dataset[tuple(selection)])
                 first_inds.append(self.first_index_labels(dataset, items))
-                for dim_label, index_label in items.iteritems():
-                    inds[-1][self.mapping[dim_label]] = \
-                            self.index(self.mapping[dim_label], index_label,
-                                    dataset)
-
-            #prevent interation over datasets that do not match items
-            data2 = list(data) 
-            for i in xrange(len(data2) - 1, -1, -1):
-                if -1 in inds[i]:
-                    del data[i]
-                    del inds[i]
-                    del(first_inds[i])
-
-            return_data = []
-            for i, value in enumerate(data):
-                shape = list(value.shape)
-                for j, dim in enumerate(inds[i]):
-                    if type(dim) == int:
-                        shape[j] = 1
-                return_data.append(value[tuple(inds[i])].reshape(shape))
-            return return_data, first_inds
-        
-    """
-    #TODO: make me work for sdcubes. It used to work within hdf
-    def get_data_fill_with_nan(self, group_name, items):
-        ''' Create one data_set out of the multiple data_sets get_data
-        returns. Fill all gaps with NaNs.
-
-        '''
-
-        indices = self.get_all_possible_indices(group_name)
-        for i, index in enumerate(indices):
-            index_label = index[0]
-            if index_label in items:
-                indices[i] = [index_label, [items[index_label]]]
-        start_point = dict(([k, v[0]]) for (k, v) in indices)
-        shape = tuple(len(v) for (k, v) in indices)
-
-        data, inds = self.get_data_and_indices(group_name, items)
-        tmp_name = group_name + '.tmp'
-        self.create_dataset(tmp_name, *indices)
-        nan_array = empty(shape)
-        nan_array[:] = nan
-        self.set_dataset(tmp_name, start_point, nan_array)
-        for i in xrange(len(inds)):
-            self.set_dataset(tmp_name, inds[i], data[i])
-        ret_data = self.get_data(tmp_name, items)
-        self.delete_cube(tmp_name)
-        return ret_data
-    """
+            return data, first_inds
+
+    def to_dense(self, items={}, memmap=None, fill=numpy.nan,
+            block_size=BLOCK_SIZE):
+        ''' Create one array out of all datasets that match items. Fill all
+        gaps with fill (NaN by default).
+        The array spans the sorted union of the index labels of the datasets
+        in every dimension; dimensions fixed by items have length one.
+        If memmap is a filename the array is a numpy.memmap backed by that
+        file, so that it may be larger than the memory. A filename ending
+        with .npy gets the header of the NPY format.
+        Every dataset is read once, block by block, and scattered into place.
+        Return the array and a dictionary {dimension_label: index_labels}.
+
+        '''
+        with self._open('r') as hdf5_file:
+            grp = hdf5_file[self.name]
+            group_mapping = load_mapping(grp)
+            point = dict((group_mapping[dim_label], index_label) for
+                    dim_label, index_label in items.iteritems())
+            names = sorted(extent_index(grp).locate(point))
+            datasets = [grp[name] for name in names]
+            indices = [label_index(dataset) for dataset in datasets]
+
+            # union of the labels of every dimension
+            dim_labels = [set() for dim_label in group_mapping]
+            for dset_index in indices:
+                for dim_index, index_labels in dset_index.mapping.iteritems():
+                    if dim_index in point:
+                        continue
+                    dim_labels[dim_index].update(index_labels)
+            for dim_index, index_label in point.iteritems():
+                dim_labels[dim_index] = set([index_label])
+            dim_labels = [sorted(index_labels) for index_labels in dim_labels]
+            positions = [dict((index_label, position) for position,
+                index_label in enumerate(index_labels)) for index_labels in
+                dim_labels]
+
+            dtype = numpy.result_type(numpy.float64, type(fill),
+                    *[dataset.dtype for dataset in datasets])
+            shape = tuple(len(index_labels) for index_labels in dim_labels)
+            if memmap is None:
+                data = numpy.empty(shape, dtype=dtype)
+            elif memmap.endswith('.npy'):
+                data = numpy.lib.format.open_memmap(memmap, mode='w+',
+                        dtype=dtype, shape=shape)
+            else:
+                data = numpy.memmap(memmap, dtype=dtype, mode='w+',
+                        shape=shape)
+            data.fill(fill)
+
+            for dataset, dset_index in zip(datasets, indices):
+                selection = [slice(0, length) for length in dataset.shape]
+                dset_positions = list()
+                for dim_index, index_labels in sorted(
+                        dset_index.mapping.iteritems()):
+                    if dim_index in point:
+                        position = dset_index.position(dim_index,
+                                point[dim_index])
+                        selection[dim_index] = slice(position, position + 1)
+                        index_labels = [point[dim_index]]
+                    dset_positions.append(numpy.array([positions[dim_index][
+                        index_label] for index_label in index_labels],
+                        dtype=numpy.intp))
+                scatter_blocks(dataset, data, dset_positions,
+                        tuple(selection), block_size)
+            if memmap is not None:
+                data.flush()
+            inverted = dict((dim_index, dim_label) for dim_label, dim_index
+                    in group_mapping.iteritems())
+            return data, dict((inverted[dim_index], index_labels) for
+                    dim_index, index_labels in enumerate(dim_labels))
 
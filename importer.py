@@ -0,0 +1,308 @@
+''' Streaming import of spreadsheets (xls, xlsx) and CSV files into a cube.
+
+The sheet starts with header rows naming the columns. The first columns
+hold the index labels of the independent variables, the remaining columns
+hold measurements. Every other row is one data point:
+
+    TNF  EGF  Time  ERK   MK2   pMEK
+    0    0    0     2.21  1.99  1.23
+    0    0    5     2.15  1.38  1.18
+    0    0    720   1.87  2.10
+    ...
+
+Consecutive rows with the same pattern of empty cells form one block and
+the index labels of a block span a grid, which becomes one dataset of the
+cube. The measurements dimension is labelled with the column numbers of the
+measured values. The rows are read one after another and every block is
+written as soon as it is complete, so the memory needed depends on the size
+of the blocks, not of the sheet. Blocks longer than max_rows are split where
+their outermost variable changes.
+
+'''
+import os
+import csv
+import logging
+from decimal import Decimal, InvalidOperation
+import numpy
+
+# Default number of rows kept in memory before they are written
+MAX_ROWS = 2 ** 16
+
+def _is_empty(cell):
+    return cell is None or cell == ''
+
+def read_rows(filename, sheet=0):
+    ''' Yield the rows of the sheet with the index sheet of the xls or xlsx
+    workbook filename, or of the CSV file filename, as lists of cell values.
+    Empty cells are '' or None.
+
+    '''
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == '.csv':
+        with open(filename, 'rb') as csv_file:
+            for row in csv.reader(csv_file):
+                yield row
+    elif extension == '.xls':
+        import xlrd
+        # xlrd can't stream the rows of a sheet, but loads the other sheets
+        # of the workbook only if they are read
+        book = xlrd.open_workbook(filename, encoding_override='utf8',
+                on_demand=True)
+        try:
+            xls_sheet = book.sheet_by_index(sheet)
+            for row in xrange(xls_sheet.nrows):
+                yield xls_sheet.row_values(row)
+        finally:
+            book.release_resources()
+    elif extension == '.xlsx':
+        import openpyxl
+        book = openpyxl.load_workbook(filename, read_only=True,
+                data_only=True)
+        try:
+            for row in book.worksheets[sheet].iter_rows(values_only=True):
+                yield list(row)
+        finally:
+            book.close()
+    else:
+        logging.error('Unknown file type: %s' % filename)
+        raise ValueError('Unknown file type: %s' % filename)
+
+def _text(cell):
+    ''' Return the cell as unicode, the byte strings of CSV files are UTF-8
+    encoded.
+
+    '''
+    if isinstance(cell, str):
+        return cell.decode('utf-8')
+    return unicode(cell)
+
+def column_labels(header):
+    ''' Return the labels of the columns given by the header rows. The label
+    of a column is its value in the last header row, followed by the values
+    of the rows above in parentheses, e.g. 'ERK (Kinase assay)'.
+
+    '''
+    labels = list()
+    for cells in zip(*header):
+        label = _text(cells[-1])
+        for cell in reversed(cells[:-1]):
+            if not _is_empty(cell):
+                label += ' (' + _text(cell) + ')'
+        labels.append(label)
+    return labels
+
+def index_label(cell):
+    ''' Return the index label of the cell. Numbers become Decimals, text
+    becomes unicode.
+
+    '''
+    if isinstance(cell, basestring):
+        text = _text(cell)
+        try:
+            return Decimal(text.strip())
+        except InvalidOperation:
+            return text
+    return Decimal(str(cell))
+
+class Block(object):
+    ''' The rows of one block read so far. The labels of every independent
+    variable are kept in the order of their first occurence and hashed to
+    their positions.
+
+    '''
+    def __init__(self, pattern, nr_in_vars):
+        self.pattern = pattern
+        self.nr_in_vars = nr_in_vars
+        self.columns = [column for column in xrange(nr_in_vars, len(pattern))
+                if pattern[column]]
+        self.keys = list()
+        self.values = list()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def append(self, row):
+        # the cells are turned into index labels once per distinct cell
+        self.keys.append(tuple(row[:self.nr_in_vars]))
+        self.values.append([float(row[column]) for column in self.columns])
+
+    def _changes(self):
+        ''' Return the rows where the label differs from the row before for
+        every independent variable.
+
+        '''
+        changes = [list() for var in xrange(self.nr_in_vars)]
+        for row in xrange(1, len(self.keys)):
+            for var in xrange(self.nr_in_vars):
+                if self.keys[row][var] != self.keys[row - 1][var]:
+                    changes[var].append(row)
+        return changes
+
+    def _outermost(self, changes):
+        ''' Return the varying variable changing least often (the outermost
+        one of a grid) or None if no variable varies.
+
+        '''
+        varying = [var for var in xrange(self.nr_in_vars) if changes[var]]
+        if not varying:
+            return None
+        return min(varying, key=lambda var: len(changes[var]))
+
+    def _cut(self, row):
+        ''' Return a new block with the rows before row and keep the rest.
+
+        '''
+        head = Block(self.pattern, self.nr_in_vars)
+        head.keys, self.keys = self.keys[:row], self.keys[row:]
+        head.values, self.values = self.values[:row], self.values[row:]
+        return head
+
+    def split(self, max_rows):
+        ''' Return a new block with the first rows, at most max_rows of them
+        if possible, and keep the rest. The rows are cut where the outermost
+        variable changes last, so that the head holds complete grids.
+        Return None if the rows can't be cut.
+
+        '''
+        changes = self._changes()
+        var = self._outermost(changes)
+        if var is None:
+            return None
+        cuts = [row for row in changes[var] if row <= max_rows]
+        return self._cut(cuts[-1] if cuts else changes[var][0])
+
+    def fragments(self):
+        ''' Yield the labels of every independent variable (a list of lists),
+        the measured columns and the data of the grids of index labels the
+        block consists of, arrays of the shape of the grid.
+        A block that does not span one grid (e.g. the rest of a split block)
+        is split where its outermost variable changes.
+
+        '''
+        labels = list()
+        positions = list()
+        for var in xrange(self.nr_in_vars):
+            # cells (e.g. '1' and '1.0') may have the same index label
+            cells = dict()
+            seen = dict()
+            var_labels = list()
+            var_positions = list()
+            for key in self.keys:
+                cell = key[var]
+                if not cell in cells:
+                    label = index_label(cell)
+                    if not label in seen:
+                        seen[label] = len(var_labels)
+                        var_labels.append(label)
+                    cells[cell] = seen[label]
+                var_positions.append(cells[cell])
+            labels.append(var_labels)
+            positions.append(var_positions)
+        shape = tuple(len(var_labels) for var_labels in labels)
+        rows = numpy.ravel_multi_index(positions, shape) if positions else \
+                numpy.zeros(len(self.keys), dtype=int)
+        size = int(numpy.prod(shape))
+        if size == len(self.keys) and len(numpy.unique(rows)) == size:
+            data = numpy.empty((size, len(self.columns)))
+            data[rows] = self.values
+            yield labels, self.columns, data.reshape(shape +
+                    (len(self.columns),))
+            return
+        changes = self._changes()
+        var = self._outermost(changes)
+        if var is None:
+            logging.error('The rows of a block do not span a grid of index'
+                    ' labels')
+            raise ValueError('The rows of a block do not span a grid of index'
+                    ' labels')
+        for start, stop in zip([0] + changes[var], changes[var] +
+                [len(self.keys)]):
+            part = Block(self.pattern, self.nr_in_vars)
+            part.keys = self.keys[start:stop]
+            part.values = self.values[start:stop]
+            for fragment in part.fragments():
+                yield fragment
+
+def iter_fragments(rows, nr_in_vars, max_rows=MAX_ROWS):
+    ''' Yield the fragments (see Block.fragments) of the data rows rows, an
+    iterable of lists of cell values with nr_in_vars independent variables.
+    Empty rows are skipped.
+
+    '''
+    block = None
+    for row in rows:
+        pattern = [not _is_empty(cell) for cell in row]
+        # trailing empty cells may be missing
+        while pattern and not pattern[-1]:
+            pattern.pop()
+        pattern = tuple(pattern)
+        if not any(pattern):
+            continue
+        if not len(pattern) > nr_in_vars or not all(pattern[:nr_in_vars]):
+            logging.error('A row needs all index labels and a measurement')
+            raise ValueError('A row needs all index labels and a measurement')
+        if block is not None and block.pattern != pattern:
+            for fragment in block.fragments():
+                yield fragment
+            block = None
+        if block is None:
+            block = Block(pattern, nr_in_vars)
+        block.append(row)
+        if len(block) > max_rows:
+            head = block.split(max_rows)
+            if head is not None:
+                for fragment in head.fragments():
+                    yield fragment
+    if block is not None:
+        for fragment in block.fragments():
+            yield fragment
+
+def import_rows(sdcube, rows, variables, nr_in_vars, max_rows=MAX_ROWS):
+    ''' Import the data rows rows into the SdCube sdcube with the dimension
+    labels variables (the independent variables followed by the measurements
+    dimension). The fragments are written in batches of about max_rows
+    rows, each with one create_datasets and one set_data_many.
+    Return the number of datasets written.
+
+    '''
+    count = 0
+    datasets = list()
+    blocks = list()
+    size = 0
+    for labels, columns, data in iter_fragments(rows, nr_in_vars,
+            max_rows):
+        dimensions = dict(zip(variables, labels + [columns]))
+        datasets.append(dimensions)
+        blocks.append((dict((var, var_labels[0]) for var, var_labels in
+            dimensions.iteritems()), data))
+        size += data.size
+        if size >= max_rows:
+            sdcube.create_datasets(datasets)
+            sdcube.set_data_many(blocks)
+            count += len(datasets)
+            datasets, blocks, size = list(), list(), 0
+    if datasets:
+        sdcube.create_datasets(datasets)
+        sdcube.set_data_many(blocks)
+        count += len(datasets)
+    return count
+
+def import_file(hdf, filename, nr_in_vars, name=None, header_rows=2,
+        sheet=0, measurements='measurements', max_rows=MAX_ROWS):
+    ''' Import the sheet with the index sheet of the xls, xlsx or CSV file
+    filename into a new cube of the project hdf, using one session of the
+    project file. The first header_rows rows name the columns, the first
+    nr_in_vars columns are the independent variables. The measured columns
+    form the dimension measurements.
+    Return the name of the cube.
+
+    '''
+    rows = read_rows(filename, sheet)
+    header = [next(rows) for row in xrange(header_rows)]
+    variables = column_labels(header)[:nr_in_vars] + [measurements]
+    with hdf.session('a'):
+        name = hdf.add_sdcube(variables, name=name)
+        sdcube = hdf.get_sdcube(name)
+        count = import_rows(sdcube, rows, variables, nr_in_vars, max_rows)
+    logging.info('Imported %d datasets into %s' % (count, name))
+    return name
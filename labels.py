@@ -0,0 +1,629 @@
+''' Index labels of the datasets of a cube.
+
+A dataset mapping is a dictionary {dimension_index: [index_label, ...]}. To
+find the position of an index label the mapping is turned into a LabelIndex
+once and kept in memory, so that every further lookup is a dictionary
+access instead of a list search.
+
+Since format version 2 the index labels of a dataset are not pickled into
+its 'mapping' attribute any more. Every dimension is stored as a typed 1-D
+dataset in the member _labels/<dataset name>/ of the cube:
+
+    int, float  numeric labels
+    str         fixed-length strings
+    unicode     fixed-length utf-8 encoded strings
+    decimal     fixed-length strings of Decimal labels
+    dict        integer codes into the vlen string dataset
+                <dimension index>_vocabulary (for mixed labels)
+
+Files of format version 1 are still readable, migrate() converts them.
+
+The extents of all datasets of a cube (see ExtentIndex) are persisted in the
+member _extents of the cube, so that loading them does not touch the labels
+of every dataset:
+
+    entries             a log of (name, token, present) rows, one per
+                        dataset added (present) or deleted
+    <dimension index>   (entry, label) rows, the index labels of the
+                        entries encoded as tagged strings
+
+The token of an entry identifies the labels of the dataset when it was
+recorded (see _extent_token).
+
+'''
+import cPickle as pickle
+from collections import OrderedDict
+from decimal import Decimal
+import hashlib
+import posixpath
+import uuid
+import h5py
+import numpy
+
+FORMAT_VERSION = 2
+
+# Members of a cube group whose name starts with this prefix hold metadata
+# of the cube and not data.
+RESERVED_PREFIX = '_'
+LABELS = '_labels'
+EXTENTS = '_extents'
+VOCABULARY = '_vocabulary'
+
+# Number of labels decoded at once when iterating over stored labels
+READ_SIZE = 65536
+
+# Number of dataset label indices kept in memory
+CACHE_SIZE = 1024
+
+_cache = OrderedDict()
+
+def format_version(h5_file):
+    ''' Return the format version of the open hdf5 file h5_file.
+
+    '''
+    return int(h5_file.attrs.get('format_version', 1))
+
+def init_format(h5_file):
+    ''' Mark a new (empty) hdf5 file with the current format version.
+
+    '''
+    if not 'format_version' in h5_file.attrs and not len(h5_file):
+        h5_file.attrs['format_version'] = FORMAT_VERSION
+
+def _encode_label(index_label):
+    ''' Encode a single index label as a tagged string.
+
+    '''
+    if isinstance(index_label, Decimal):
+        return 'd' + str(index_label)
+    if type(index_label) is str and not '\0' in index_label:
+        return 's' + index_label
+    if type(index_label) is unicode:
+        return 'u' + index_label.encode('utf-8')
+    if type(index_label) in (int, long):
+        return 'i' + str(index_label)
+    if type(index_label) is float:
+        return 'f' + repr(index_label)
+    return 'p' + pickle.dumps(index_label)
+
+def _decode_label(raw):
+    ''' Decode a tagged string created by _encode_label.
+
+    '''
+    tag, value = raw[0], raw[1:]
+    if tag == 'd':
+        return Decimal(value)
+    if tag == 's':
+        return value
+    if tag == 'u':
+        return value.decode('utf-8')
+    if tag == 'i':
+        return int(value)
+    if tag == 'f':
+        return float(value)
+    return pickle.loads(value)
+
+def _string_array(strings):
+    ''' Return the strings as a fixed-length string array.
+
+    '''
+    return numpy.array(strings, dtype='S%d' % max([1] + [len(x) for x in
+        strings]))
+
+def _encode(index_labels):
+    ''' Return the encoding, the values and the vocabulary (or None) used to
+    store index_labels.
+
+    '''
+    types = set(type(x) for x in index_labels)
+    if types <= set([int, long]) and all(-2**63 <= x < 2**63 for x in
+            index_labels):
+        return 'int', numpy.array(index_labels, dtype=numpy.int64), None
+    if types == set([float]):
+        return 'float', numpy.array(index_labels, dtype=numpy.float64), None
+    if types == set([str]) and not any(x.endswith('\0') for x in
+            index_labels):
+        return 'str', _string_array(index_labels), None
+    if types == set([unicode]):
+        return 'unicode', _string_array([x.encode('utf-8') for x in
+            index_labels]), None
+    if types == set([Decimal]):
+        return 'decimal', _string_array([str(x) for x in index_labels]), None
+    codes = dict()
+    vocabulary = list()
+    values = numpy.empty(len(index_labels), dtype=numpy.int32)
+    for i, index_label in enumerate(index_labels):
+        code = codes.get(index_label)
+        if code is None:
+            code = codes[index_label] = len(vocabulary)
+            vocabulary.append(_encode_label(index_label))
+        values[i] = code
+    return 'dict', values, vocabulary
+
+class Labels(object):
+    ''' The stored index labels of one dimension of a dataset.
+    Labels are read from the file on demand, so indexing and slicing only
+    load the requested part.
+
+    '''
+    def __init__(self, h5_labels, h5_vocabulary=None):
+        self.h5_labels = h5_labels
+        self.h5_vocabulary = h5_vocabulary
+        self.encoding = h5_labels.attrs['encoding']
+        self._vocabulary = None
+
+    def __len__(self):
+        return self.h5_labels.shape[0]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step < 0:
+                return self[:][key]
+            if start >= stop:
+                return []
+            return self._decode(self.h5_labels[start:stop:step])
+        position = key + len(self) if key < 0 else key
+        if not 0 <= position < len(self):
+            raise IndexError('label index out of range')
+        return self._decode(self.h5_labels[position:position + 1])[0]
+
+    def __iter__(self):
+        for start in xrange(0, len(self), READ_SIZE):
+            for index_label in self[start:start + READ_SIZE]:
+                yield index_label
+
+    def _decode(self, values):
+        ''' Turn stored values into index labels.
+
+        '''
+        if self.encoding == 'decimal':
+            return [Decimal(x) for x in values]
+        if self.encoding == 'unicode':
+            return [x.decode('utf-8') for x in values]
+        if self.encoding == 'dict':
+            if self._vocabulary is None:
+                self._vocabulary = [_decode_label(x) for x in
+                        self.h5_vocabulary[...]]
+            return [self._vocabulary[x] for x in values]
+        return values.tolist()
+
+def _labels_group(dset):
+    ''' Return the group holding the stored labels of the dataset dset.
+
+    '''
+    return dset.parent[LABELS][posixpath.basename(dset.name)]
+
+def dataset_labels(dset):
+    ''' Return the mapping of the dataset dset without loading the labels:
+    {dimension_index: Labels}. Datasets of format version 1 return their
+    pickled mapping.
+
+    '''
+    if 'mapping' in dset.attrs:
+        return pickle.loads(str(dset.attrs['mapping']))
+    mapping = dict()
+    dset_labels = _labels_group(dset)
+    for name in dset_labels:
+        if not name.endswith(VOCABULARY):
+            mapping[int(name)] = Labels(dset_labels[name],
+                    dset_labels.get(name + VOCABULARY))
+    return mapping
+
+def load_labels(dset):
+    ''' Load and return the complete mapping of the dataset dset.
+
+    '''
+    return dict((dim_index, list(index_labels[:])) for dim_index,
+            index_labels in dataset_labels(dset).iteritems())
+
+def _touch_labels(grp):
+    ''' Mark that labels of datasets of the cube grp changed.
+
+    '''
+    grp.attrs['labels_generation'] = uuid.uuid4().hex
+
+def store_labels(dset, mapping):
+    ''' Store the mapping of the dataset dset in the format of its file and
+    replace labels stored before.
+
+    '''
+    _touch_labels(dset.parent)
+    if format_version(dset.file) < FORMAT_VERSION:
+        dset.attrs['mapping'] = pickle.dumps(mapping)
+        return
+    if 'mapping' in dset.attrs:
+        del dset.attrs['mapping']
+    all_labels = dset.parent.require_group(LABELS)
+    name = posixpath.basename(dset.name)
+    if name in all_labels:
+        del all_labels[name]
+    dset_labels = all_labels.create_group(name)
+    for dim_index, index_labels in mapping.iteritems():
+        encoding, values, vocabulary = _encode(list(index_labels))
+        h5_labels = dset_labels.create_dataset(str(dim_index), data=values)
+        h5_labels.attrs['encoding'] = encoding
+        if vocabulary is not None:
+            dset_labels.create_dataset(str(dim_index) + VOCABULARY,
+                    data=vocabulary, dtype=h5py.special_dtype(vlen=str))
+    dset_labels.attrs['generation'] = uuid.uuid4().hex
+
+def copy_labels(source, destination):
+    ''' Give the dataset destination the labels of the dataset source.
+    Within one file the stored labels are shared by a hard link instead of
+    being copied. Pickled labels are stored in the format of the file of
+    destination.
+
+    '''
+    _touch_labels(destination.parent)
+    if 'mapping' in source.attrs:
+        if format_version(destination.file) < FORMAT_VERSION:
+            destination.attrs['mapping'] = source.attrs['mapping']
+        else:
+            store_labels(destination, load_labels(source))
+        return
+    all_labels = destination.parent.require_group(LABELS)
+    name = posixpath.basename(destination.name)
+    if name in all_labels:
+        del all_labels[name]
+    if source.file == destination.file:
+        all_labels[name] = _labels_group(source)
+    else:
+        all_labels.copy(_labels_group(source), name)
+
+def delete_labels(grp, name):
+    ''' Delete the stored labels of the dataset name of the cube grp.
+
+    '''
+    _touch_labels(grp)
+    if LABELS in grp and name in grp[LABELS]:
+        del grp[LABELS][name]
+
+def _labels_token(dset):
+    ''' Return a value that changes whenever the labels of dset change.
+
+    '''
+    if 'mapping' in dset.attrs:
+        return str(dset.attrs['mapping'])
+    return _labels_group(dset).attrs['generation']
+
+class LabelIndex(object):
+    ''' Maps the index labels of every dimension of a dataset to their
+    positions.
+
+    '''
+    def __init__(self, mapping):
+        self.mapping = mapping
+        self.positions = dict()
+        for dim_index, index_labels in mapping.iteritems():
+            # iterate backwards so that the first occurence of a label wins
+            self.positions[dim_index] = dict(zip(reversed(index_labels),
+                xrange(len(index_labels) - 1, -1, -1)))
+
+    def position(self, dim_index, index_label):
+        ''' Return the position of index_label in the dimension dim_index or
+        -1 if the dataset does not contain it.
+
+        '''
+        return self.positions[dim_index].get(index_label, -1)
+
+    def label(self, dim_index, position):
+        ''' Return the index label at position in the dimension dim_index.
+
+        '''
+        return self.mapping[dim_index][position]
+
+    def __contains__(self, item):
+        ''' Return whether the (dim_index, index_label) pair item is part of
+        the dataset.
+
+        '''
+        dim_index, index_label = item
+        return index_label in self.positions[dim_index]
+
+def label_index(dset):
+    ''' Return the LabelIndex of the dataset dset.
+    The index is built once per dataset and reused as long as the stored
+    mapping of the dataset does not change.
+
+    '''
+    key = (dset.file.filename, dset.name)
+    token = _labels_token(dset)
+    cached = _cache.pop(key, None)
+    if cached is None or cached[0] != token:
+        cached = (token, LabelIndex(load_labels(dset)))
+    _cache[key] = cached
+    while len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
+    return cached[1]
+
+def clear_cache():
+    ''' Forget all label and extent indices kept in memory.
+
+    '''
+    _cache.clear()
+    _extent_cache.clear()
+
+_extent_cache = dict()
+
+def fragment_names(grp):
+    ''' Return the names of the datasets of the cube grp that hold data.
+
+    '''
+    return [name for name in grp if not name.startswith(RESERVED_PREFIX)]
+
+def fragments(grp):
+    ''' Return the datasets of the cube grp that hold data.
+
+    '''
+    return [grp[name] for name in fragment_names(grp)]
+
+class ExtentIndex(object):
+    ''' Index over the label extents of all datasets of a cube.
+    For every dimension it maps an index label to the names of the datasets
+    containing it, so that the dataset holding a point or the datasets
+    overlapping a new dataset are found without scanning all datasets.
+
+    '''
+    def __init__(self):
+        self.mappings = dict()
+        self.datasets = dict()
+
+    def add(self, name, mapping):
+        ''' Add the dataset name with the dataset mapping to the index.
+
+        '''
+        self.mappings[name] = mapping
+        for dim_index, index_labels in mapping.iteritems():
+            dim_datasets = self.datasets.setdefault(dim_index, dict())
+            for index_label in index_labels:
+                dim_datasets.setdefault(index_label, set()).add(name)
+
+    def remove(self, name):
+        ''' Remove the dataset name from the index.
+
+        '''
+        mapping = self.mappings.pop(name)
+        for dim_index, index_labels in mapping.iteritems():
+            dim_datasets = self.datasets[dim_index]
+            for index_label in index_labels:
+                names = dim_datasets.get(index_label)
+                if names is not None:
+                    names.discard(name)
+                    if not names:
+                        del dim_datasets[index_label]
+
+    def locate(self, point):
+        ''' Return the names of the datasets containing point, a dictionary
+        {dimension_index: index_label}.
+
+        '''
+        candidates = list()
+        for dim_index, index_label in point.iteritems():
+            names = self.datasets.get(dim_index, {}).get(index_label)
+            if not names:
+                return set()
+            candidates.append(names)
+        if not candidates:
+            return set(self.mappings)
+        candidates.sort(key=len)
+        return candidates[0].intersection(*candidates[1:])
+
+    def overlapping(self, mapping):
+        ''' Return the names of the datasets sharing at least one point with
+        a dataset with the dataset mapping.
+
+        '''
+        result = None
+        for dim_index, index_labels in mapping.iteritems():
+            dim_datasets = self.datasets.get(dim_index, {})
+            names = set()
+            for index_label in index_labels:
+                names.update(dim_datasets.get(index_label, ()))
+            result = names if result is None else result & names
+            if not result:
+                return set()
+        return result or set()
+
+    def next_name(self, grp):
+        ''' Return the next free dataset name of the cube grp.
+
+        '''
+        number = len(self.mappings)
+        while str(number) in self.mappings or str(number) in grp:
+            number += 1
+        return str(number)
+
+# A row of the entries of the extent log
+_ENTRY = numpy.dtype([('name', h5py.special_dtype(vlen=str)), ('token',
+    h5py.special_dtype(vlen=str)), ('present', numpy.bool_)])
+
+# A row of the labels of one dimension of the extent log
+_EXTENT = numpy.dtype([('entry', numpy.int64), ('label',
+    h5py.special_dtype(vlen=str))])
+
+def _extent_token(dset):
+    ''' Return a value that changes whenever the labels of dset change.
+
+    '''
+    return hashlib.sha1(_labels_token(dset)).hexdigest()
+
+def _extent_tokens(grp, names):
+    ''' Return a dictionary {name: extent token} of the datasets names of
+    the cube grp.
+
+    '''
+    if format_version(grp.file) < FORMAT_VERSION or not names:
+        return dict((name, _extent_token(grp[name])) for name in names)
+    # the labels of every dataset are stored, read their generations only
+    all_labels = grp[LABELS]
+    return dict((name, hashlib.sha1(all_labels[name].attrs['generation'])
+        .hexdigest()) for name in names)
+
+def _extent_stamp(grp):
+    ''' Return a value that changes whenever a dataset of the cube grp or
+    its labels change through this module or the extent log is changed.
+
+    '''
+    log = grp.get(EXTENTS)
+    if isinstance(log, h5py.Group):
+        log = (log.attrs['generation'], log['entries'].shape[0])
+    else:
+        log = None
+    return log, len(grp), grp.attrs.get('labels_generation')
+
+def _append(dset, rows):
+    ''' Append the array rows to the resizable 1-D dataset dset.
+
+    '''
+    start = dset.shape[0]
+    dset.resize((start + len(rows),))
+    dset[start:] = rows
+
+def _append_extents(log, records):
+    ''' Append the (name, token, mapping) records to the extent log, a
+    mapping of None records a deletion.
+
+    '''
+    entries = log['entries']
+    start = entries.shape[0]
+    _append(entries, numpy.array([(name, token, mapping is not None) for
+        name, token, mapping in records], dtype=_ENTRY))
+    rows = dict()
+    for entry, (name, token, mapping) in enumerate(records, start):
+        for dim_index, index_labels in (mapping or {}).iteritems():
+            rows.setdefault(dim_index, list()).extend((entry,
+                _encode_label(index_label)) for index_label in index_labels)
+    for dim_index, dim_rows in rows.iteritems():
+        if not str(dim_index) in log:
+            log.create_dataset(str(dim_index), (0,), maxshape=(None,),
+                    dtype=_EXTENT)
+        _append(log[str(dim_index)], numpy.array(dim_rows, dtype=_EXTENT))
+
+def _read_extents(grp):
+    ''' Return the persisted extents of the cube grp as a dictionary
+    {name: (token, mapping)} of the datasets present, None if there is no
+    extent log (or one of an older layout).
+
+    '''
+    log = grp.get(EXTENTS)
+    if not isinstance(log, h5py.Group):
+        return None
+    live = dict()
+    tokens = list()
+    if log['entries'].shape[0]:
+        for entry, (name, token, present) in enumerate(log['entries'][...]):
+            tokens.append(token)
+            if present:
+                live[name] = entry
+            else:
+                live.pop(name, None)
+    mappings = dict((entry, dict()) for entry in live.itervalues())
+    decoded = dict()
+    for dim_name in log:
+        if dim_name == 'entries' or not log[dim_name].shape[0]:
+            continue
+        dim_index = int(dim_name)
+        rows = log[dim_name][...]
+        for entry, raw in zip(rows['entry'].tolist(), rows['label']):
+            mapping = mappings.get(entry)
+            if mapping is None:
+                continue
+            if not raw in decoded:
+                decoded[raw] = _decode_label(raw)
+            mapping.setdefault(dim_index, list()).append(decoded[raw])
+    return dict((name, (tokens[entry], mappings[entry])) for name, entry in
+        live.iteritems())
+
+def _write_extents(grp, index, tokens):
+    ''' Persist the whole extent index of the cube grp, tokens maps the
+    names of the datasets to their extent tokens.
+
+    '''
+    if EXTENTS in grp:
+        del grp[EXTENTS]
+    log = grp.create_group(EXTENTS)
+    log.create_dataset('entries', (0,), maxshape=(None,), dtype=_ENTRY)
+    log.attrs['generation'] = uuid.uuid4().hex
+    _append_extents(log, [(name, tokens[name], index.mappings[name]) for name
+        in sorted(index.mappings)])
+
+def extent_index(grp):
+    ''' Return the ExtentIndex of the cube grp.
+    The index is kept in memory and persisted in the member _extents of the
+    group. It is validated when it is loaded: datasets whose labels changed
+    (their extent token differs from the recorded one) or that were added
+    or deleted without updating the log are read from their stored labels
+    and the log is rewritten, if the file is writable.
+
+    '''
+    key = (grp.file.filename, grp.name)
+    stamp = _extent_stamp(grp)
+    cached = _extent_cache.get(key)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    persisted = _read_extents(grp)
+    stale = persisted is None
+    persisted = persisted or dict()
+    index = ExtentIndex()
+    names = fragment_names(grp)
+    tokens = _extent_tokens(grp, names)
+    for name in names:
+        entry = persisted.get(name)
+        if entry is not None and entry[0] == tokens[name]:
+            index.add(name, entry[1])
+        else:
+            index.add(name, load_labels(grp[name]))
+            stale = True
+    if (stale or set(persisted) - set(tokens)) and grp.file.mode != 'r':
+        _write_extents(grp, index, tokens)
+        stamp = _extent_stamp(grp)
+    _extent_cache[key] = (stamp, index)
+    return index
+
+def record_extent(grp, index, name, mapping=None):
+    ''' Add the dataset name with the dataset mapping to the extent index
+    of the cube grp after the dataset was created or remove it if mapping is
+    None after the dataset was deleted. index must be the index returned by
+    extent_index before the group was changed.
+
+    '''
+    record_extents(grp, index, [(name, mapping)])
+
+def record_extents(grp, index, records):
+    ''' Like record_extent for a list of (name, mapping) records, appended to
+    the log of the cube grp at once.
+
+    '''
+    if not records:
+        return
+    for name, mapping in records:
+        if mapping is None:
+            index.remove(name)
+        else:
+            index.add(name, mapping)
+    _append_extents(grp[EXTENTS], [(name, '' if mapping is None else
+        _extent_token(grp[name]), mapping) for name, mapping in records])
+    _extent_cache[(grp.file.filename, grp.name)] = (_extent_stamp(grp),
+            index)
+
+def migrate(filename):
+    ''' Convert the project file filename to the current format version.
+    The pickled mappings of all datasets are replaced by stored labels.
+
+    '''
+    with h5py.File(filename, 'a') as h5_file:
+        if format_version(h5_file) >= FORMAT_VERSION:
+            return
+        h5_file.attrs['format_version'] = FORMAT_VERSION
+        for grp in h5_file.values():
+            if not isinstance(grp, h5py.Group) or not 'mapping' in grp.attrs:
+                continue
+            for dset in fragments(grp):
+                if 'mapping' in dset.attrs:
+                    store_labels(dset, load_labels(dset))
+
+if __name__ == '__main__':
+    import sys
+    for filename in sys.argv[1:]:
+        migrate(filename)
@@ -1,52 +1,461 @@
 import function
+import h5py
 import numpy
 import logging
 import pickle
+import warnings
+import multiprocessing
+from blocks import BLOCK_SIZE, block_shape, iter_blocks, dataset_options
+from scheduler import init_worker
 
-def calc_data(dset, method, collapse_dim):
-    if method == "average":
-        logging.info('Calculation data using average')
-        return numpy.average(dset[...], collapse_dim)
-    elif method == "max":
-        logging.info('Calculation data using max')
-        return numpy.amax(dset[...], collapse_dim)
-    if method == "min":
-        logging.info('Calculation data using min')
-        return numpy.amin(dset[...], collapse_dim)
-    else:
+# Number of values a quantile sketch keeps per level and output element
+SKETCH_SIZE = 256
+
+def _float_dtype(dtype):
+    ''' Return dtype if it is inexact and float64 otherwise.
+
+    '''
+    return dtype if numpy.issubdtype(dtype, numpy.inexact) else \
+            numpy.dtype(numpy.float64)
+
+class Average(object):
+    ''' Running average along an axis, combined block by block.
+
+    '''
+    # number of values kept per output element
+    footprint = 1
+
+    def __init__(self, dtype):
+        self.dtype = _float_dtype(dtype)
+        self.total = None
+        self.count = 0
+
+    def add(self, data, axis):
+        partial = numpy.sum(data, axis, dtype=numpy.float64)
+        self.total = partial if self.total is None else self.total + partial
+        self.count += data.shape[axis]
+
+    def result(self):
+        return (self.total / self.count).astype(self.dtype)
+
+class Sum(Average):
+    ''' Running sum along an axis, combined block by block. With nan NaNs
+    are ignored.
+
+    '''
+    def __init__(self, dtype, nan=False):
+        Average.__init__(self, dtype)
+        self.dtype = dtype if numpy.issubdtype(dtype, numpy.inexact) else \
+                numpy.dtype(numpy.int64)
+        self.nan = nan
+
+    def add(self, data, axis):
+        function = numpy.nansum if self.nan else numpy.sum
+        partial = function(data, axis, dtype=numpy.float64 if
+                numpy.issubdtype(self.dtype, numpy.inexact) else self.dtype)
+        self.total = partial if self.total is None else self.total + partial
+
+    def result(self):
+        return self.total.astype(self.dtype)
+
+class Count(Average):
+    ''' Running number of values that are not NaN along an axis.
+
+    '''
+    def __init__(self, dtype):
+        Average.__init__(self, dtype)
+        self.dtype = numpy.dtype(numpy.int64)
+
+    def add(self, data, axis):
+        partial = numpy.sum(~numpy.isnan(data), axis, dtype=self.dtype) if \
+                numpy.issubdtype(data.dtype, numpy.inexact) else \
+                numpy.full(data.shape[:axis] + data.shape[axis + 1:],
+                        data.shape[axis], dtype=self.dtype)
+        self.total = partial if self.total is None else self.total + partial
+
+    def result(self):
+        return self.total
+
+class Moments(object):
+    ''' Running count, mean and sum of squared deviations along an axis.
+    The statistics of every block are merged with those of the blocks
+    before (Chan et al.), which is numerically stable. statistic is 'mean',
+    'var' or 'std' (of the population), with nan NaNs are ignored.
+
+    '''
+    footprint = 1
+
+    def __init__(self, dtype, statistic='var', nan=False):
+        self.dtype = _float_dtype(dtype)
+        self.statistic = statistic
+        self.nan = nan
+        self.count = None
+        self.mean = None
+        self.squares = None
+
+    def add(self, data, axis):
+        data = numpy.asarray(data, dtype=numpy.float64)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            if self.nan:
+                valid = ~numpy.isnan(data)
+                count = numpy.sum(valid, axis).astype(numpy.float64)
+                # a tile may be 0-d if every dimension is collapsed
+                mean = numpy.where(count > 0, numpy.nansum(data, axis) /
+                        count, 0)
+                deviation = numpy.where(valid, data - numpy.expand_dims(mean,
+                    axis), 0)
+            else:
+                count = numpy.full(data.shape[:axis] + data.shape[axis + 1:],
+                        data.shape[axis], dtype=numpy.float64)
+                mean = numpy.mean(data, axis)
+                deviation = data - numpy.expand_dims(mean, axis)
+            squares = numpy.sum(deviation ** 2, axis)
+            if self.count is None:
+                self.count, self.mean, self.squares = count, mean, squares
+                return
+            total = self.count + count
+            delta = mean - self.mean
+            weight = numpy.where(total > 0, count / total, 0)
+            self.mean = self.mean + delta * weight
+            self.squares = self.squares + squares + delta ** 2 * \
+                    self.count * weight
+            self.count = total
+
+    def result(self):
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            if self.statistic == 'mean':
+                result = numpy.where(self.count > 0, self.mean, numpy.nan)
+            else:
+                result = self.squares / self.count
+                if self.statistic == 'std':
+                    result = numpy.sqrt(result)
+        return result.astype(self.dtype)
+
+class Maximum(object):
+    ''' Running maximum along an axis, combined block by block.
+
+    '''
+    footprint = 1
+    function = staticmethod(numpy.amax)
+    combine = staticmethod(numpy.maximum)
+
+    def __init__(self, dtype):
+        self.dtype = dtype
+        self.partial = None
+
+    def add(self, data, axis):
+        with warnings.catch_warnings():
+            # all NaN slices of the NaN-aware variants
+            warnings.simplefilter('ignore', RuntimeWarning)
+            partial = self.function(data, axis)
+        self.partial = partial if self.partial is None else \
+                self.combine(self.partial, partial)
+
+    def result(self):
+        return self.partial
+
+class Minimum(Maximum):
+    ''' Running minimum along an axis, combined block by block.
+
+    '''
+    function = staticmethod(numpy.amin)
+    combine = staticmethod(numpy.minimum)
+
+class NanMaximum(Maximum):
+    ''' Running maximum along an axis ignoring NaNs.
+
+    '''
+    function = staticmethod(numpy.nanmax)
+    combine = staticmethod(numpy.fmax)
+
+class NanMinimum(Maximum):
+    ''' Running minimum along an axis ignoring NaNs.
+
+    '''
+    function = staticmethod(numpy.nanmin)
+    combine = staticmethod(numpy.fmin)
+
+class Quantile(object):
+    ''' Approximate q-th percentile along an axis from a mergeable sketch.
+    For every output element the sketch keeps levels of at most size values,
+    a value of level i stands for 2**i values of the data. A full level is
+    sorted and every other value moves up one level (KLL-style compaction),
+    so the memory needed grows only with the logarithm of the length of the
+    axis. As long as no level was compacted the result is exact.
+
+    '''
+    footprint = 4 * SKETCH_SIZE
+
+    def __init__(self, dtype, q=50, size=SKETCH_SIZE):
+        if not 0 <= q <= 100:
+            logging.error('Percentiles must be between 0 and 100')
+            raise ValueError('Percentiles must be between 0 and 100')
+        self.dtype = _float_dtype(dtype)
+        self.q = q
+        self.size = size
+        self.levels = []
+        self.random = numpy.random.RandomState(0)
+
+    def add(self, data, axis):
+        data = numpy.moveaxis(numpy.asarray(data, dtype=numpy.float64), axis,
+                0)
+        if not self.levels:
+            self.levels.append(data)
+        else:
+            self.levels[0] = numpy.concatenate((self.levels[0], data))
+        level = 0
+        while level < len(self.levels):
+            values = self.levels[level]
+            if len(values) > self.size:
+                values = numpy.sort(values, axis=0)
+                # an odd value stays on the level
+                keep = len(values) % 2
+                compacted = values[keep + self.random.randint(2)::2]
+                self.levels[level] = values[:keep]
+                if level + 1 == len(self.levels):
+                    self.levels.append(compacted)
+                else:
+                    self.levels[level + 1] = numpy.concatenate(
+                            (self.levels[level + 1], compacted))
+            level += 1
+
+    def result(self):
+        if len(self.levels) == 1:
+            return numpy.percentile(self.levels[0], self.q,
+                    axis=0).astype(self.dtype)
+        values = numpy.concatenate(self.levels)
+        weights = numpy.concatenate([numpy.full(len(kept), 2 ** level,
+            dtype=numpy.float64) for level, kept in enumerate(self.levels)])
+        order = numpy.argsort(values, axis=0)
+        values = numpy.take_along_axis(values, order, axis=0)
+        weights = numpy.cumsum(weights[order], axis=0)
+        # the first value whose cumulated weight reaches the rank
+        rank = self.q / 100.0 * weights[-1]
+        index = numpy.minimum(numpy.sum(weights < rank, axis=0),
+                len(values) - 1)
+        return numpy.take_along_axis(values, index[numpy.newaxis],
+                axis=0)[0].astype(self.dtype)
+
+METHODS = {'average': Average, 'max': Maximum, 'min': Minimum,
+        'sum': Sum, 'count': Count,
+        'mean': lambda dtype: Moments(dtype, 'mean'),
+        'var': lambda dtype: Moments(dtype, 'var'),
+        'std': lambda dtype: Moments(dtype, 'std'),
+        'nansum': lambda dtype: Sum(dtype, nan=True),
+        'nanaverage': lambda dtype: Moments(dtype, 'mean', nan=True),
+        'nanmean': lambda dtype: Moments(dtype, 'mean', nan=True),
+        'nanvar': lambda dtype: Moments(dtype, 'var', nan=True),
+        'nanstd': lambda dtype: Moments(dtype, 'std', nan=True),
+        'nanmax': NanMaximum, 'nanmin': NanMinimum,
+        'median': Quantile}
+
+# prefix of methods computing a percentile, e.g. 'percentile_90'
+PERCENTILE = 'percentile_'
+
+def get_reduction(method, dtype):
+    ''' Return a new reduction for method on data of the type dtype.
+
+    '''
+    if isinstance(method, basestring) and method.startswith(PERCENTILE):
+        try:
+            q = float(method[len(PERCENTILE):])
+        except ValueError:
+            logging.error('Unknown method')
+            raise ValueError('Unknown method')
+        return Quantile(dtype, q)
+    if not method in METHODS:
         logging.error('Unknown method')
         raise ValueError('Unknown method')
+    return METHODS[method](dtype)
+
+def _axes(collapse_dim):
+    ''' Return the sorted list of the dimensions collapse_dim, an index or a
+    sequence of indices.
+
+    '''
+    if isinstance(collapse_dim, (list, tuple)):
+        return sorted(collapse_dim)
+    return [collapse_dim]
+
+def _split(values, axes):
+    ''' Split the tuple values (one per dimension) into the values of the
+    dimensions kept and the values of the dimensions axes.
+
+    '''
+    return (tuple(value for dim, value in enumerate(values) if not dim in
+        axes), tuple(values[dim] for dim in axes))
+
+def _tiles(dset, method, axes, block_size):
+    ''' Return the shape of the output tiles and the shape of the blocks
+    read within the dimensions axes for collapsing them in the dataset dset
+    with method.
 
-class CollapseDimension(function.Function):
     '''
+    block = block_shape(dset.shape, block_size, dset.chunks)
+    out_block, collapsed_block = _split(block, axes)
+    footprint = get_reduction(method, dset.dtype).footprint
+    if footprint > 1:
+        # keep the state of all output elements of a tile within block_size
+        out_shape, collapsed_shape = _split(dset.shape, axes)
+        out_block = block_shape(out_shape, max(1, block_size // footprint))
+        size = int(numpy.prod(out_block))
+        collapsed_block = block_shape(collapsed_shape, max(1, block_size //
+            size))
+    return out_block, collapsed_block
+
+def _reduce(dset, method, axes, out_selection, collapsed_block):
+    ''' Return the result of method within the dimensions axes for the tile
+    out_selection of the output, reading blocks of the shape collapsed_block
+    within these dimensions. The data of every block is rearranged so that
+    all collapsed dimensions become one last dimension.
+
+    '''
+    reduction = get_reduction(method, dset.dtype)
+    kept = [dim for dim in xrange(len(dset.shape)) if not dim in axes]
+    tile_shape = tuple(part.stop - part.start for part in out_selection)
+    for part in iter_blocks(_split(dset.shape, axes)[1], collapsed_block):
+        selection = [None] * len(dset.shape)
+        for dim, value in zip(kept + axes, out_selection + part):
+            selection[dim] = value
+        data = numpy.transpose(dset[tuple(selection)], kept + axes)
+        reduction.add(data.reshape(tile_shape + (-1,)), len(tile_shape))
+    return reduction.result()
+
+# files opened read-only by a worker process, by filename
+_files = dict()
+
+def _reduce_tile(args):
+    ''' Collapse one tile in a worker process. args are the index of the
+    output, the filename and the name of the dataset followed by the
+    arguments of _reduce. Return the index, the tile and its result.
+
+    '''
+    index, filename, name, method, axes, out_selection, collapsed_block = args
+    if not filename in _files:
+        _files[filename] = h5py.File(filename, 'r')
+    return index, out_selection, _reduce(_files[filename][name], method,
+            axes, out_selection, collapsed_block)
+
+def calc_many(pairs, method, collapse_dim, block_size=BLOCK_SIZE,
+        workers=1):
+    ''' Collapse the dimension collapse_dim (an index or a sequence of
+    indices) of every dataset of the list pairs of (dataset, out) pairs with
+    method and write the result into out (a dataset or an array). See
+    calc_data. With more than one worker the output tiles of all datasets
+    are reduced in one pool of workers processes which open the files of
+    the datasets read-only, this process writes the results.
+
+    '''
+    logging.info('Calculation data using %s' % method)
+    axes = _axes(collapse_dim)
+    jobs = list()
+    for index, (dset, out) in enumerate(pairs):
+        out_block, collapsed_block = _tiles(dset, method, axes, block_size)
+        jobs.append((index, dset, iter_blocks(_split(dset.shape, axes)[0],
+            out_block), collapsed_block))
+    # the workers of a parallel recompute can't start processes of their own
+    if workers > 1 and not multiprocessing.current_process().daemon:
+        # the workers have to see everything written so far
+        for h5_file in set(dset.file for dset, out in pairs):
+            h5_file.flush()
+        pool = multiprocessing.Pool(workers, init_worker)
+        try:
+            for index, out_selection, result in pool.imap_unordered(
+                    _reduce_tile, ((index, dset.file.filename, dset.name,
+                        method, axes, out_selection, collapsed_block) for
+                        index, dset, tiles, collapsed_block in jobs for
+                        out_selection in tiles)):
+                pairs[index][1][out_selection] = result
+        except:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+        return
+    for index, dset, tiles, collapsed_block in jobs:
+        for out_selection in tiles:
+            pairs[index][1][out_selection] = _reduce(dset, method, axes,
+                    out_selection, collapsed_block)
+
+def calc_data(dset, method, collapse_dim, out=None, block_size=BLOCK_SIZE,
+        workers=1):
+    ''' Collapse the dimension collapse_dim (an index or a sequence of
+    indices) of the dataset dset with method. The dataset is read in blocks
+    of at most block_size elements and the partial results of all blocks
+    along collapse_dim are combined, so the memory needed does not depend
+    on the size of dset. The result is written block by block into out (a
+    dataset or an array) if given and returned as an array otherwise.
+    With more than one worker the output tiles are reduced in a pool of
+    workers processes (see calc_many).
+
+    '''
+    if out is None:
+        out = numpy.empty(_split(dset.shape, _axes(collapse_dim))[0],
+                dtype=result_dtype(method, dset.dtype))
+    calc_many([(dset, out)], method, collapse_dim, block_size, workers)
+    return out
+
+def result_dtype(method, dtype):
+    ''' Return the type of the result of method on data of the type dtype.
+
+    '''
+    return get_reduction(method, dtype).dtype
+
+def collapse_dims(mapping, collapse_dim):
+    ''' Return the sorted indices of the dimensions collapse_dim of a cube
+    with the mapping. collapse_dim is a dimension (an index or a label) or
+    a list of dimensions.
+
+    '''
+    if not isinstance(collapse_dim, (list, tuple)):
+        collapse_dim = [collapse_dim]
+    axes = [mapping[dim] if dim in mapping else dim for dim in collapse_dim]
+    if not collapse_dim or not set(axes) <= set(mapping.values()):
+        logging.error('The collapse dimension is not in the input cube')
+        raise ValueError('The collapse dimension is not in the input cube')
+    if len(set(axes)) < len(axes):
+        logging.error('The collapse dimensions must differ')
+        raise ValueError('The collapse dimensions must differ')
+    return sorted(axes)
+
+class CollapseDimension(function.Function):
+    ''' Collapse dimensions of a cube. params are the dimension (an index or
+    a label) or a list of dimensions, collapsed in one pass, the method and
+    optionally a dictionary of options ('block_size', 'workers': the number
+    of processes to reduce the output tiles with). The methods are
+    'average', 'sum', 'count', 'max', 'min', 'var', 'std', their NaN
+    ignoring variants ('nansum', 'nanaverage', ...), 'median' and
+    'percentile_<q>'. The data is read block by block, median and
+    percentiles are approximated once the collapsed dimensions hold more
+    than SKETCH_SIZE values per tile.
 
     '''
     def __call__(self, input_cubes, output_cube_names, params):
-        ''' Collapse one dimension of the input cube with a method given by
+        ''' Collapse dimensions of the input cube with a method given by
         params. Store the output cube in the correct hdf project.
 
         '''
-        if not len(params) == 2:
+        if not len(params) in (2, 3):
             logging.error('Please give a dimension to collapse and a method')
             raise ValueError('Please give a dimension to collapse and a method')
         if not len(input_cubes) == 1:
             logging.error('Please give exactly one cube!')
             raise ValueError('Please give exactly one cube!')
 
-        collapse_dim, method = params
+        collapse_dim, method = params[:2]
+        options = params[2] if len(params) == 3 else {}
+        block_size = options.get('block_size', BLOCK_SIZE)
+        workers = options.get('workers', 1)
         cube = input_cubes[0]
         mapping = function.get_mapping(cube)
-        if not collapse_dim in mapping.values():
-            logging.error('The collapse dimension is not in the input cube')
-            raise ValueError('The collapse dimension is not in the input cube')
-
-        out_mapping = dict()
-        for key, value in mapping.items():
-            if value < collapse_dim:     
-                out_mapping[key] = value
-            elif value > collapse_dim:
-                out_mapping[key] = value - 1 # no gaps please 
-
+        axes = collapse_dims(mapping, collapse_dim)
+        # the dimensions kept are numbered without gaps
+        remap = dict((dim, dim - sum(1 for axis in axes if axis < dim)) for
+                dim in mapping.values() if not dim in axes)
+        out_mapping = dict((key, remap[value]) for key, value in
+                mapping.items() if value in remap)
 
         logging.info('Creating new group: %s', output_cube_names[0])
         out_cube = cube.parent.create_group(output_cube_names[0])
@@ -57,18 +466,17 @@ class CollapseDimension(function.Function):
         out_cube.attrs['mapping'] = pickle.dumps(out_mapping)
 
         logging.debug('Create new datasets')
-        for i in xrange(len(cube)):
-            name = str(i)
+        pairs = list()
+        for name in function.fragment_names(cube):
             dset = cube[name]
-            data = calc_data(dset, method, collapse_dim)
-            ds = out_cube.create_dataset(name, shape=data.shape,
-                    dtype=data.dtype)
-            ds[...] = data
-            ds_mapping = dict()
-            for key, value in function.get_mapping(dset).items():
-                if key < collapse_dim:     
-                    ds_mapping[key] = value
-                elif key > collapse_dim:     
-                    ds_mapping[key-1] = value # no gaps please
-            ds.attrs['mapping'] = pickle.dumps(ds_mapping)
+            shape = _split(dset.shape, axes)[0]
+            ds = out_cube.create_dataset(name, shape=shape,
+                    **dataset_options(out_cube, shape,
+                        result_dtype(method, dset.dtype)))
+            ds_mapping = dict((remap[key], value) for key, value in
+                    function.get_mapping(dset).items() if key in remap)
+            function.store_labels(ds, ds_mapping)
+            pairs.append((dset, ds))
+        # one pool of workers for the tiles of all datasets
+        calc_many(pairs, method, axes, block_size, workers)
 
@@ -1,6 +1,7 @@
 import pickle
 import logging
 import function
+from blocks import dataset_options, gather_blocks, virtual_selection
 
 class Create_subcube(function.Function):
     def __call__(self, input_cubes, output_cubes, params):
@@ -9,6 +10,16 @@ class Create_subcube(function.Function):
         The dictionary keys should match valid indexlabels.
         The dictionary values should be a tuple of two values if you
         want to have a range or a list of any number of values.
+        Every dataset of the input cube yields at most one dataset of the
+        subcube holding the selected labels of every dimension (in the order
+        of the input dataset), copied block by block.
+        A second dictionary may hold options: with {'view': True} the
+        subcube consists of HDF5 virtual datasets that map onto the selected
+        elements of the input cube instead of copies, so creating it only
+        writes metadata. Such a view reflects later changes of its input and
+        can be turned into real storage with SdCube.materialize. Datasets
+        whose selected labels are too scattered to be mapped with at most
+        blocks.MAX_MAPPINGS strided selections are copied nevertheless.
             
         '''
         if not input_cubes or len(input_cubes) != 1:
@@ -20,24 +31,32 @@ class Create_subcube(function.Function):
         items = {}
         if len(params) > 0:
             items = params[0]
+        options = params[1] if len(params) > 1 else {}
         in_group = input_cubes[0]
         in_group_mapping = pickle.loads(str(in_group.attrs['mapping'])) 
-        logging.info('Get splitted data')
-        data, indices = function.get_data_and_indices(in_group, items)
 
         logging.info('Create new group')
         group = in_group.parent.create_group(output_cubes[0])
         group.attrs['mapping'] = pickle.dumps(in_group_mapping)
+        if 'storage' in in_group.attrs:
+            group.attrs['storage'] = in_group.attrs['storage']
         logging.debug('Create new datasets')
-        for i in xrange(len(data)):
-            if data[i] == []:
+        i = 0
+        for name in function.overlapping_names(in_group, items):
+            dset = in_group[name]
+            selection = function.get_selection(in_group_mapping, dset, items)
+            if selection is None:
                 continue
-            name = str(i)
-            ds = group.create_dataset(name, shape=data[i].shape,
-                    dtype=data[i].dtype)
-            ds[...] = data[i][...]
-            dset_mapping = indices[i]
-            ds.attrs['mapping'] = pickle.dumps(dset_mapping)
+            positions, dset_mapping = selection
+            if options.get('view', False):
+                ds = virtual_selection(dset, group, str(i), positions)
+            else:
+                shape = tuple(len(dim_positions) for dim_positions in
+                        positions)
+                ds = group.create_dataset(str(i), shape=shape,
+                        **dataset_options(group, shape, dset.dtype))
+                gather_blocks(dset, ds, positions)
+            function.store_labels(ds, dset_mapping)
+            i += 1
 
         logging.debug('Subcubes created.')
-
@@ -1,101 +1,134 @@
 #import pickle
 import logging
+import h5py
 import function
-import pickle
-from numpy import concatenate
-from itertools import combinations 
+from blocks import copy_blocks, virtual_source, dataset_options
+from itertools import combinations
 
-def join_cubes(out_cube, cubes):
+class Fragment(object):
+    ''' A dataset of the joined cube before it is written.
+    It consists of pieces, (source dataset, offset) pairs, which are placed
+    at offset within the joined dataset.
+
+    '''
+    def __init__(self, dataset):
+        self.mapping = function.get_mapping(dataset)
+        self.shape = dataset.shape
+        self.dtype = dataset.dtype
+        self.attrs = dataset.attrs.items()
+        self.pieces = [(dataset, (0,) * len(dataset.shape))]
+        self.name = dataset.name
+
+    def append(self, other, key):
+        ''' Append the fragment other along the dimension key.
+
+        '''
+        for value in other.mapping[key]:
+            self.mapping[key].append(value)
+        length = self.shape[key]
+        for dataset, offset in other.pieces:
+            offset = list(offset)
+            offset[key] += length
+            self.pieces.append((dataset, tuple(offset)))
+        shape = list(self.shape)
+        shape[key] += other.shape[key]
+        self.shape = tuple(shape)
+
+def write(out_cube, name, fragment, virtual=False):
+    ''' Write the fragment as the dataset name of the out_cube. If virtual is
+    True the dataset is a virtual dataset mapping onto the source datasets,
+    otherwise every source is copied block by block exactly once.
+
+    '''
+    if name in out_cube:
+        del out_cube[name]
+    if virtual:
+        layout = h5py.VirtualLayout(shape=fragment.shape,
+                dtype=fragment.dtype)
+        for dataset, offset in fragment.pieces:
+            layout[tuple(slice(start, start + length) for start, length in
+                zip(offset, dataset.shape))] = virtual_source(dataset,
+                        out_cube)
+        ds = out_cube.create_virtual_dataset(name, layout)
+    else:
+        ds = out_cube.create_dataset(name, shape=fragment.shape,
+                **dataset_options(out_cube, fragment.shape, fragment.dtype))
+        for dataset, offset in fragment.pieces:
+            copy_blocks(dataset, ds, offset)
+    for key, value in fragment.attrs:
+        ds.attrs[key] = value
+    function.store_labels(ds, fragment.mapping)
+    return ds
+
+def join_cubes(out_cube, cubes, virtual=False):
     ''' Join the given cubes in the group
-    
+
     '''
+    names = [cube.name for cube in cubes]
+    cubes = [[Fragment(ds) for ds in function.fragments(cube)] for cube in
+            cubes]
     while len(cubes) > 1:
         #common elements
-        logging.info('Joining cubes: %s and %s' % (cubes[-1].name,
-            cubes[-2].name))
-        for i, (ds1, ds2) in enumerate(zip(cubes[-2].values(),
-            cubes[-1].values())):
+        logging.info('Joining cubes: %s and %s' % (names[-1], names[-2]))
+        joined = list()
+        for ds1, ds2 in zip(cubes[-2], cubes[-1]):
             logging.debug('Concatenating datasets: %s and %s' % (ds1.name,
                 ds2.name))
-            ds1_map = function.get_mapping(ds1)
-            ds2_map = function.get_mapping(ds2)
-            keys = function.compare(ds1_map, ds2_map)
+            keys = function.compare(ds1.mapping, ds2.mapping)
             if not len(keys) == 1:
                 logging.error('Only one dimension can be different. Different'
                         ' dimensions are %s' % keys)
                 raise ValueError
-            key = keys[0]
-            outmap = ds1_map
-            for value in ds2_map[key]:
-                outmap[key].append(value)
-            combined_data = concatenate((ds1[...], ds2[...]), key)
-            try:
-                del out_cube[str(i)]
-            except KeyError:
-                pass
-
-            ds = out_cube.create_dataset(str(i), shape=combined_data.shape,
-                    dtype=ds1.dtype)
-            ds[...] = combined_data
-            for key, value in ds1.attrs.items():
-                ds.attrs[key] = value
-            ds.attrs['mapping'] = pickle.dumps(outmap)
+            ds1.append(ds2, keys[0])
+            joined.append(ds1)
 
         #append non common elements
-        (len_a, cube_a), (len_b, cube_b) = sorted((len(c), c) for c in
-                cubes[-2:])
-        for i in xrange(len_a, len_b):
-            name = str(i)
-            out_cube.copy(cube_b[name].name, name)
+        cube_a, cube_b = sorted(cubes[-2:], key=len)
+        joined.extend(cube_b[len(cube_a):])
 
-        cubes[-2] = out_cube
+        cubes[-2] = joined
         cubes.pop()
-    for combination in set(combinations(cubes[0].values(), 2)):
-        cube1, cube2 = combination
-        merge(cube1, cube2)
+        names[-2] = out_cube.name
+        names.pop()
+
+    fragments = cubes[0]
+    for i, j in combinations(xrange(len(fragments)), 2):
+        if fragments[i] is not None and fragments[j] is not None:
+            if merge(fragments[i], fragments[j]):
+                fragments[j] = None
+    fragments = [fragment for fragment in fragments if fragment is not None]
+    for i, fragment in enumerate(fragments):
+        write(out_cube, str(i), fragment, virtual)
 
 def merge(dataset1, dataset2):
-    ''' Try to merge the given dataset into one
+    ''' Try to merge the given dataset into one.
+    Return whether dataset2 was merged into dataset1.
 
     '''
-    ds1_map = function.get_mapping(dataset1)
-    ds2_map = function.get_mapping(dataset2)
-    keys = function.compare(ds1_map, ds2_map)
+    keys = function.compare(dataset1.mapping, dataset2.mapping)
     if not len(keys) == 1:
         logging.warning('Only one dimension can be different. Did not merge')
-        return
+        return False
     logging.info('Merging datasets: %s and %s' % (dataset1.name,
         dataset2.name))
-    key = keys[0]
-    outmap = ds1_map
-    for value in ds2_map[key]:
-        outmap[key].append(value)
-    combined_data = concatenate((dataset1[...], dataset2[...]), key)
-    
-    # copy doesn't work (because of changed shape)
-    group = dataset1.parent
-    name = dataset1.name
-    dtype = dataset1.dtype
-    attrs = dataset1.attrs.items()
-    del group[dataset1.name]
-    ds = group.create_dataset(name, shape=combined_data.shape,
-            dtype=dtype)
-    ds[...] = combined_data
-    for key, value in attrs:
-        ds.attrs[key] = value
-    ds.attrs['mapping'] = pickle.dumps(outmap)
-    del group[dataset2.name]
+    dataset1.append(dataset2, keys[0])
+    return True
 
 class JoinCubes(function.Function):
     ''' This function joins several cubes into one.
-    It will try to merge the datasets if it is possible (only one 
+    It will try to merge the datasets if it is possible (only one
     dimension has different index labels (and those labels must _not_
     overlap).
+    params may hold one dictionary of options: with {'virtual': True} the
+    joined cube consists of HDF5 virtual datasets that map onto the datasets
+    of the input cubes instead of copies, so joining only writes metadata.
+    Such a cube reflects later changes of its inputs and can be turned into
+    real storage with SdCube.materialize.
 
     '''
     def __call__(self, input_cubes, output_cubes, params):
-        ''' 
-            
+        '''
+
         '''
         if not input_cubes or len(input_cubes) < 2:
             logging.error('input_cubes must be a list of at least two input'
@@ -107,9 +140,9 @@ class JoinCubes(function.Function):
             if not first_grp_mapping == function.get_mapping(cube):
                 logging.error('All cubes must have the same dimension_labels.')
                 raise ValueError
-       
+
+        options = params[0] if params else {}
         out_cube = input_cubes[0].parent.create_group(output_cubes[0])
         for key in input_cubes[0].attrs.keys():
             out_cube.attrs[key] = input_cubes[0].attrs[key]
-        join_cubes(out_cube, input_cubes)
-
+        join_cubes(out_cube, input_cubes, options.get('virtual', False))
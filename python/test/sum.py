@@ -1,19 +1,23 @@
 import pickle
 import logging
-from function import Function
+from function import Function, fragment_names, copy_labels
+from blocks import BLOCK_SIZE, block_shape, iter_blocks, dataset_options
 
 class Sum(Function):
     def __call__(self, input_cubes, output_cubes, params):
         '''Sum up input cubes that have identical indices.
+        params may hold one dictionary of options: {'block_size': number of
+        elements summed up at once}. Every block of the output is read from
+        all inputs and written exactly once.
 
         '''
         if not input_cubes or len(input_cubes) < 2:
             logging.error('input_cubes must be a list of at least two'
                     ' input_cubes.')
             raise ValueError
-        for i in xrange(len(input_cubes[0])):
+        for name in fragment_names(input_cubes[0]):
             for cube in input_cubes[1:]:
-                if not input_cubes[0][str(i)].shape == cube[str(i)].shape:
+                if not input_cubes[0][name].shape == cube[name].shape:
                     logging.error('input_cubes must have the same dimensions')
                     raise ValueError
         for cube in input_cubes[1:]:
@@ -27,24 +31,29 @@ class Sum(Function):
             raise ValueError
 
 
+        options = params[0] if params else {}
+        block_size = options.get('block_size', BLOCK_SIZE)
         in_one = input_cubes[0]
         logging.info('Creating cube: %s' % output_cubes[0])
         group = in_one.parent.create_group(output_cubes[0])
-        for i in xrange(len(in_one)):
-            name = str(i)
+        logging.debug('Setting attributes for group')
+        for key in in_one.attrs.keys():
+            group.attrs[key] = in_one.attrs[key]
+        for name in fragment_names(in_one):
             logging.debug('Creating ds: %s' % name)
             ds = group.create_dataset(name, shape=in_one[name].shape,
-                    dtype=in_one[name].dtype)
+                    **dataset_options(group, in_one[name].shape,
+                        in_one[name].dtype))
             for key, value in in_one[name].attrs.items():
                 ds.attrs[key] = value
+            copy_labels(in_one[name], ds)
 
             # set the data
-            ds[...] = in_one[name][...]
             logging.debug('Setting data in ds: %s' % name)
-            logging.debug('data: %s' % ds[...])
-            for cube in input_cubes[1:]:
-                ds[...] = ds[...] + cube[name][...]
-        logging.debug('Setting attributes for group')
-        for key in in_one.attrs.keys():
-            group.attrs[key] = in_one.attrs[key]
+            for selection in iter_blocks(ds.shape, block_shape(ds.shape,
+                block_size, in_one[name].chunks)):
+                data = in_one[name][selection]
+                for cube in input_cubes[1:]:
+                    data = data + cube[name][selection]
+                ds[selection] = data
 
@@ -0,0 +1,193 @@
+''' The function registry of a project.
+
+The functions of a project are kept in the group _functions of the project
+file instead of a pickled list:
+
+    records   one pickled function per row, the row number is the stable id
+              of the function; the row of a deleted function is empty
+    inputs    (id, cube name) rows, the input cubes of every function
+    outputs   (id, cube name) rows, the output cubes of every function
+
+Adding a function appends rows and deleting one clears its record, so
+neither has to read or rewrite the other functions. The inputs and outputs
+index the functions by cube name: they are turned into a dictionary {cube
+name: ids} once and kept in memory until the 'generation' attribute of the
+registry, renewed by every change, differs.
+
+Projects created before keep their functions in the pickled attribute
+'functions' of the file. They are read from there and moved into the
+registry on the first change.
+
+'''
+import cPickle as pickle
+import uuid
+import h5py
+import numpy
+
+REGISTRY = '_functions'
+
+# {filename: (generation, {'inputs': {cube: ids}, 'outputs': {cube: ids}})}
+_index_cache = dict()
+
+_EDGE = numpy.dtype([('id', numpy.int64), ('cube',
+    h5py.special_dtype(vlen=str))])
+
+def init_registry(h5_file):
+    ''' Create the empty registry in the file h5_file and move the functions
+    of a pickled 'functions' attribute into it.
+
+    '''
+    if REGISTRY in h5_file:
+        return h5_file[REGISTRY]
+    registry = h5_file.create_group(REGISTRY)
+    registry.create_dataset('records', (0,), maxshape=(None,),
+            dtype=h5py.special_dtype(vlen=str))
+    for name in ['inputs', 'outputs']:
+        registry.create_dataset(name, (0,), maxshape=(None,), dtype=_EDGE)
+    registry.attrs['generation'] = uuid.uuid4().hex
+    if 'functions' in h5_file.attrs:
+        for func in pickle.loads(str(h5_file.attrs['functions'])):
+            add(h5_file, func)
+        del h5_file.attrs['functions']
+    return registry
+
+def _append(dset, rows):
+    ''' Append the rows to the resizable 1-D dataset dset.
+
+    '''
+    start = dset.shape[0]
+    dset.resize((start + len(rows),))
+    if len(rows):
+        dset[start:] = rows
+    return start
+
+def add(h5_file, func):
+    ''' Add the function func to the registry. Return its id.
+
+    '''
+    registry = init_registry(h5_file)
+    func_id = _append(registry['records'], [pickle.dumps(func)])
+    for name, cubes in [('inputs', func.input_cube_names), ('outputs',
+        func.output_cube_names)]:
+        _append(registry[name], numpy.array([(func_id, cube) for cube in
+            cubes], dtype=_EDGE))
+    registry.attrs['generation'] = uuid.uuid4().hex
+    return func_id
+
+def delete(h5_file, func_id):
+    ''' Delete the function with the id func_id from the registry.
+
+    '''
+    registry = init_registry(h5_file)
+    records = registry['records']
+    if not 0 <= func_id < records.shape[0] or not records[func_id]:
+        raise KeyError('No function with the id %s' % func_id)
+    records[func_id] = ''
+    registry.attrs['generation'] = uuid.uuid4().hex
+
+def get(h5_file, func_id):
+    ''' Return the function with the id func_id.
+
+    '''
+    if not REGISTRY in h5_file:
+        functions = pickle.loads(str(h5_file.attrs['functions']))
+        if not 0 <= func_id < len(functions):
+            raise KeyError('No function with the id %s' % func_id)
+        return functions[func_id]
+    records = h5_file[REGISTRY]['records']
+    if not 0 <= func_id < records.shape[0] or not records[func_id]:
+        raise KeyError('No function with the id %s' % func_id)
+    return pickle.loads(records[func_id])
+
+def get_many(h5_file, func_ids):
+    ''' Return the functions with the ids func_ids, read at once.
+
+    '''
+    if not func_ids:
+        return []
+    if not REGISTRY in h5_file:
+        return [get(h5_file, func_id) for func_id in func_ids]
+    records = h5_file[REGISTRY]['records']
+    start = min(func_ids)
+    if start < 0 or max(func_ids) >= records.shape[0]:
+        raise KeyError('No function with the ids %s' % func_ids)
+    rows = records[start:max(func_ids) + 1]
+    result = list()
+    for func_id in func_ids:
+        if not rows[func_id - start]:
+            raise KeyError('No function with the id %s' % func_id)
+        result.append(pickle.loads(rows[func_id - start]))
+    return result
+
+def functions(h5_file):
+    ''' Return a list of (id, function) pairs of all functions, sorted by
+    id.
+
+    '''
+    if not REGISTRY in h5_file:
+        if not 'functions' in h5_file.attrs:
+            return []
+        return list(enumerate(pickle.loads(str(h5_file.attrs['functions']))))
+    records = h5_file[REGISTRY]['records']
+    if not records.shape[0]:
+        return []
+    return [(func_id, pickle.loads(record)) for func_id, record in
+            enumerate(records[...]) if record]
+
+def _index(h5_file):
+    ''' Return the dictionary {'inputs': {cube: ids}, 'outputs': {cube:
+    ids}} of the live functions of the registry, ids are sorted lists.
+
+    '''
+    registry = h5_file[REGISTRY]
+    generation = registry.attrs.get('generation')
+    cached = _index_cache.get(h5_file.filename)
+    if generation is not None and cached is not None and cached[0] == \
+            generation:
+        return cached[1]
+    records = registry['records']
+    # the tombstones of deleted functions, read at once
+    live = [bool(record) for record in records[...]] if records.shape[0] \
+            else []
+    index = dict()
+    for name in ['inputs', 'outputs']:
+        cubes = dict()
+        edges = registry[name]
+        if edges.shape[0]:
+            edges = edges[...]
+            for func_id, cube in zip(edges['id'].tolist(), edges['cube']):
+                if live[func_id]:
+                    cubes.setdefault(cube, set()).add(func_id)
+        index[name] = dict((cube, sorted(ids)) for cube, ids in
+                cubes.iteritems())
+    if generation is None:
+        # registries of older versions get a generation once writable
+        if h5_file.mode == 'r':
+            return index
+        generation = registry.attrs['generation'] = uuid.uuid4().hex
+    _index_cache[h5_file.filename] = (generation, index)
+    return index
+
+def _ids(h5_file, name, cube):
+    ''' Return the sorted ids of the live functions with the cube among
+    their name ('inputs' or 'outputs').
+
+    '''
+    if not REGISTRY in h5_file:
+        attribute = 'input_cube_names' if name == 'inputs' else \
+                'output_cube_names'
+        return [func_id for func_id, func in functions(h5_file) if cube in
+                getattr(func, attribute)]
+    return list(_index(h5_file)[name].get(cube, []))
+
+def consumers(h5_file, cube):
+    ''' Return the ids of the functions with the input cube cube.
+
+    '''
+    return _ids(h5_file, 'inputs', cube)
+
+def producers(h5_file, cube):
+    ''' Return the ids of the functions with the output cube cube.
+
+    '''
+    return _ids(h5_file, 'outputs', cube)
@@ -0,0 +1,184 @@
+''' Scheduling of the functions of a project.
+
+The functions of a project form a dependency graph: a function depends on
+every function producing one of its input cubes. Independent functions
+may run concurrently. HDF5 files can't be written by several processes at
+once, so every function run by a worker process gets a scratch file of its
+own. The input cubes are staged into it as virtual datasets that map onto
+the datasets of the cubes (no data is copied) and the function writes its
+output cubes there. Downstream functions stage their inputs from the scratch
+files of the functions producing them. Once all functions are done the
+output cubes are copied into the project file in topological order.
+
+'''
+import os
+import time
+import logging
+import tempfile
+import multiprocessing
+import h5py
+from labels import format_version, RESERVED_PREFIX, FORMAT_VERSION
+
+def dependencies(functions):
+    ''' Return a list holding for every function of the list functions the
+    set of the indices of the functions it depends on.
+
+    '''
+    producers = dict()
+    for index, func in enumerate(functions):
+        for name in func.output_cube_names:
+            producers.setdefault(name, set()).add(index)
+    return [set(producer for name in func.input_cube_names for producer in
+        producers.get(name, ())) - set([index]) for index, func in
+        enumerate(functions)]
+
+def downstream(functions, selected):
+    ''' Return the indices of the functions selected (a collection of
+    indices of the list functions) and of all functions depending on them,
+    directly or transitively.
+
+    '''
+    depends = dependencies(functions)
+    result = set(selected)
+    changed = True
+    while changed:
+        changed = False
+        for index, producers in enumerate(depends):
+            if not index in result and producers & result:
+                result.add(index)
+                changed = True
+    return result
+
+def topological_order(functions, selected=None):
+    ''' Return the indices of the functions selected (default: all) of the
+    list functions in an order in which every function comes after the
+    functions it depends on. Ties are broken by the order of the list.
+    Raise a ValueError if the functions depend on each other in a cycle.
+
+    '''
+    if selected is None:
+        selected = xrange(len(functions))
+    selected = set(selected)
+    depends = [producers & selected for producers in
+            dependencies(functions)]
+    order = list()
+    done = set()
+    while len(order) < len(selected):
+        ready = [index for index in sorted(selected - done) if
+                depends[index] <= done]
+        if not ready:
+            logging.error('The functions depend on each other in a cycle.')
+            raise ValueError('The functions depend on each other in a cycle.')
+        order.extend(ready)
+        done.update(ready)
+    return order
+
+def stage_cube(grp, h5_file):
+    ''' Create the cube grp in the file h5_file. Datasets of the cube become
+    virtual datasets mapping onto the original ones, the reserved members
+    holding the labels and the extent index are copied.
+
+    '''
+    name = grp.name.split('/')[-1]
+    staged = h5_file.create_group(name)
+    for key, value in grp.attrs.items():
+        staged.attrs[key] = value
+    filename = os.path.abspath(grp.file.filename)
+    for key, member in grp.items():
+        if key.startswith(RESERVED_PREFIX):
+            grp.copy(member, staged, name=key)
+            continue
+        layout = h5py.VirtualLayout(shape=member.shape, dtype=member.dtype)
+        layout[...] = h5py.VirtualSource(filename, member.name,
+                shape=member.shape, dtype=member.dtype)
+        dset = staged.create_virtual_dataset(key, layout)
+        for attr_key, value in member.attrs.items():
+            dset.attrs[attr_key] = value
+    return staged
+
+def init_worker():
+    ''' Prepare a worker process.
+    HDF5 opens the source files of virtual datasets with the access mode of
+    the file holding them, so every worker opens the files of its inputs
+    for writing, and the locks of concurrent workers on a shared input file
+    would collide (reading fill values instead of data). The workers only
+    read these files and the project is not written while they run, so they
+    don't lock files. The same holds for workers reading a file another
+    process keeps open for writing.
+
+    '''
+    os.environ['HDF5_USE_FILE_LOCKING'] = 'FALSE'
+
+def run_function(func, locations, filename):
+    ''' Run the function func in the scratch file filename. locations maps
+    the names of the input cubes to the files holding them.
+    Return filename.
+
+    '''
+    with h5py.File(filename, 'w') as h5_file:
+        input_cubes = []
+        version = FORMAT_VERSION
+        for name in func.input_cube_names:
+            if not name in h5_file:
+                with h5py.File(locations[name], 'r') as source:
+                    version = format_version(source)
+                    stage_cube(source[name], h5_file)
+            input_cubes.append(h5_file[name])
+        # write the labels the way the project does
+        h5_file.attrs['format_version'] = version
+        logging.info('Executing the function: %s' % func)
+        func(input_cubes, func.output_cube_names, func.params)
+    return filename
+
+def run_parallel(functions, order, locations, workers, directory=None):
+    ''' Run the functions with the indices order (a topological order) of
+    the list functions in a pool of workers processes.
+    locations maps the names of the existing cubes to their files.
+    Return a dictionary mapping the name of every output cube to the
+    scratch file holding it. The caller has to remove the scratch files.
+
+    '''
+    depends = dependencies(functions)
+    locations = dict(locations)
+    outputs = dict()
+    pending = list(order)
+    running = dict()
+    done = set(xrange(len(functions))) - set(order)
+    pool = multiprocessing.Pool(workers, init_worker)
+    try:
+        while pending or running:
+            for index in list(pending):
+                if not depends[index] <= done:
+                    continue
+                pending.remove(index)
+                func = functions[index]
+                handle, filename = tempfile.mkstemp(suffix='.hdf5',
+                        dir=directory)
+                os.close(handle)
+                for name in func.output_cube_names:
+                    outputs[name] = filename
+                logging.info('Scheduling the function: %s' % func)
+                running[index] = pool.apply_async(run_function, (func,
+                    locations, filename))
+            finished = [index for index, result in running.iteritems() if
+                    result.ready()]
+            if not finished:
+                time.sleep(0.01)
+                continue
+            for index in finished:
+                # re-raises the exception of a failed function
+                running.pop(index).get()
+                for name in functions[index].output_cube_names:
+                    locations[name] = outputs[name]
+                done.add(index)
+    except:
+        pool.terminate()
+        for filename in set(outputs.values()):
+            if os.path.exists(filename):
+                os.remove(filename)
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+    return outputs
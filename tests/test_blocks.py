@@ -0,0 +1,60 @@
+import os
+import h5py
+from numpy import arange, zeros, array, ix_
+from blocks import block_shape, iter_blocks, gather_blocks, \
+        virtual_selection
+
+def test_block_shape():
+    assert block_shape((10, 20, 30), 10 * 20 * 30) == (10, 20, 30)
+    assert block_shape((10, 20, 30), 600) == (1, 20, 30)
+    assert block_shape((10, 20, 30), 1200) == (2, 20, 30)
+    assert block_shape((10, 20, 30), 100) == (1, 3, 30)
+    assert block_shape((10, 20, 30), 1) == (1, 1, 1)
+    # aligned to the chunks
+    assert block_shape((100, 30), 900, chunks=(4, 30)) == (28, 30)
+
+def test_iter_blocks_cover_everything():
+    shape = (7, 5, 3)
+    covered = zeros(shape)
+    for selection in iter_blocks(shape, block_shape(shape, 10)):
+        covered[selection] += 1
+    assert (covered == 1).all()
+
+def test_iter_empty_dimension():
+    assert list(iter_blocks((0, 3), (1, 3))) == []
+    assert list(iter_blocks((), ())) == [()]
+
+def test_gather_blocks():
+    h5_file = h5py.File('gather.hdf5', 'w', driver='core',
+            backing_store=False)
+    data = arange(20 * 30).reshape((20, 30))
+    source = h5_file.create_dataset('source', data=data, chunks=(4, 5))
+    positions = [array([1, 2, 3, 11, 19]), arange(30)[::7]]
+    for block_size in (1, 20, 10 ** 6):
+        destination = zeros((5, 5), dtype=data.dtype)
+        gather_blocks(source, destination, positions, block_size)
+        assert (destination == data[ix_(*positions)]).all()
+    h5_file.close()
+
+def test_virtual_selection():
+    if os.path.exists('virtual.hdf5'):
+        os.remove('virtual.hdf5')
+    h5_file = h5py.File('virtual.hdf5', 'w')
+    data = arange(400 * 400).reshape((400, 400))
+    source = h5_file.create_dataset('source', data=data)
+    # every other label maps onto one strided selection
+    positions = [arange(0, 400, 2), arange(1, 400, 2)]
+    view = virtual_selection(source, h5_file, 'view', positions)
+    assert view.is_virtual
+    assert view.id.get_create_plist().get_virtual_count() == 1
+    assert (view[...] == data[ix_(*positions)]).all()
+    positions = [array([0, 1, 2, 5, 8, 9]), array([3, 7, 8, 20, 30])]
+    view = virtual_selection(source, h5_file, 'mixed', positions)
+    assert view.id.get_create_plist().get_virtual_count() == 3 * 3
+    assert (view[...] == data[ix_(*positions)]).all()
+    # too many mappings, copied
+    copy = virtual_selection(source, h5_file, 'copy', positions,
+            max_mappings=4)
+    assert not copy.is_virtual
+    assert (copy[...] == data[ix_(*positions)]).all()
+    h5_file.close()
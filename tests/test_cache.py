@@ -0,0 +1,131 @@
+from __future__ import with_statement
+from decimal import Decimal as d
+from numpy import arange
+import os
+import h5py
+from hdf import Hdf5
+from sum import Sum
+from cache import CACHE, cube_hash
+
+class CountingSum(Sum):
+    ''' A Sum counting its calls.
+
+    '''
+    calls = 0
+
+    def __call__(self, input_cubes, output_cubes, params):
+        CountingSum.calls += 1
+        Sum.__call__(self, input_cubes, output_cubes, params)
+
+def pytest_funcarg__hdf_project(request):
+    ''' Set up a project with the two alike cubes a and b.
+
+    '''
+    if os.path.exists('cache.hdf5'):
+        os.remove('cache.hdf5')
+    hdf = Hdf5('cache')
+    for name in ['a', 'b']:
+        hdf.add_sdcube(['x', 'y'], name=name)
+        sdcube = hdf.get_sdcube(name)
+        sdcube.create_dataset({'x':[d('1'), d('2')], 'y':['a', 'b', 'c']})
+        sdcube.set_data({'x':d('1'), 'y':'a'}, arange(2*3).reshape((2, 3)))
+    CountingSum.calls = 0
+    return hdf
+
+def test_cube_hash(hdf_project):
+    with h5py.File(hdf_project.filename, 'r') as h5_file:
+        assert cube_hash(h5_file['a']) == cube_hash(h5_file['b'])
+    hdf_project.get_sdcube('b').set_data({'x':d('1'), 'y':'a'},
+            arange(1).reshape((1, 1)))
+    with h5py.File(hdf_project.filename, 'r') as h5_file:
+        assert not cube_hash(h5_file['a']) == cube_hash(h5_file['b'])
+
+def test_cache_hit(hdf_project):
+    hdf_project.execute_function(CountingSum('sum', [], ['a', 'b'], ['s']))
+    assert CountingSum.calls == 1
+    version = hdf_project.get_sdcube('s').version
+    hdf_project.execute_function(CountingSum('sum', [], ['a', 'b'], ['s']))
+    assert CountingSum.calls == 1
+    assert hdf_project.get_sdcube('s').version == version
+    # another output name, the same content
+    hdf_project.execute_function(CountingSum('sum', [], ['a', 'b'], ['t']))
+    assert CountingSum.calls == 1
+    data = hdf_project.get_sdcube('t').get_data()[0]
+    assert (data == 2 * arange(2*3).reshape((2, 3))).all()
+    # other params
+    hdf_project.execute_function(CountingSum('sum', [{'block_size':2}],
+        ['a', 'b'], ['s']))
+    assert CountingSum.calls == 2
+
+def test_cache_hit_alias(hdf_project):
+    s_sum = CountingSum('sum', [], ['a', 'b'], ['s'])
+    t_sum = CountingSum('sum', [], ['a', 'b'], ['t'])
+    hdf_project.add_function(s_sum)
+    hdf_project.add_function(t_sum)
+    hdf_project.recompute()
+    assert CountingSum.calls == 1
+    # the alias is a copy, writing to it leaves the cached cube alone
+    hdf_project.get_sdcube('t').set_data({'x':d('1'), 'y':'a'},
+            arange(1).reshape((1, 1)) - 1)
+    assert hdf_project.get_sdcube('s').get_data()[0][0, 0] == 0
+    assert hdf_project.get_sdcube('t').get_data()[0][0, 0] == -1
+    assert not hdf_project.is_stale(s_sum)
+    # re-running under the same names settles
+    hdf_project.recompute()
+    hdf_project.recompute()
+    assert not hdf_project.is_stale(s_sum)
+    assert not hdf_project.is_stale(t_sum)
+    assert hdf_project.get_sdcube('t').get_data()[0][0, 0] == -1
+    # the changed copy is replaced, an unchanged one kept
+    hdf_project.execute_function(t_sum)
+    assert hdf_project.get_sdcube('t').get_data()[0][0, 0] == 0
+    assert CountingSum.calls == 1
+    version = hdf_project.get_sdcube('t').version
+    hdf_project.execute_function(t_sum)
+    assert hdf_project.get_sdcube('t').version == version
+
+def test_changed_input(hdf_project):
+    hdf_project.execute_function(CountingSum('sum', [], ['a', 'b'], ['s']))
+    sdcube = hdf_project.get_sdcube('a')
+    sdcube.set_data({'x':d('1'), 'y':'a'}, arange(1).reshape((1, 1)))
+    hdf_project.execute_function(CountingSum('sum', [], ['a', 'b'], ['s']))
+    assert CountingSum.calls == 2
+    data = hdf_project.get_sdcube('s').get_data()[0]
+    assert data[0, 0] == 0 and data[1, 2] == 10
+
+def test_changed_output(hdf_project):
+    hdf_project.execute_function(CountingSum('sum', [], ['a', 'b'], ['s']))
+    hdf_project.get_sdcube('s').set_data({'x':d('1'), 'y':'a'},
+            arange(1).reshape((1, 1)) - 1)
+    with h5py.File(hdf_project.filename, 'r') as h5_file:
+        assert not len(h5_file[CACHE])
+    hdf_project.execute_function(CountingSum('sum', [], ['a', 'b'], ['s']))
+    assert CountingSum.calls == 2
+    data = hdf_project.get_sdcube('s').get_data()[0]
+    assert (data == 2 * arange(2*3).reshape((2, 3))).all()
+
+def test_eviction(hdf_project):
+    hdf_project.get_sdcube('b').set_data({'x':d('1'), 'y':'a'},
+            arange(1).reshape((1, 1)) + 7)
+    hdf_project.execute_function(CountingSum('sum', [], ['a', 'b'], ['s']))
+    hdf_project.execute_function(CountingSum('sum', [], ['a', 'a'], ['t']))
+    with h5py.File(hdf_project.filename, 'r') as h5_file:
+        assert len(h5_file[CACHE]) == 2
+        size = h5_file[CACHE].values()[0].attrs['size']
+    hdf_project.set_cache_limit(size)
+    assert hdf_project.get_cache_limit() == size
+    with h5py.File(hdf_project.filename, 'r') as h5_file:
+        assert len(h5_file[CACHE]) == 1
+        # the least recently used entry is evicted, the cube stays
+        assert not 'cache_key' in h5_file['s'].attrs
+        assert h5_file['s']['0'][1, 2] == 10
+    hdf_project.set_cache_limit(0)
+    with h5py.File(hdf_project.filename, 'r') as h5_file:
+        assert not len(h5_file[CACHE])
+
+def test_reserved_name(hdf_project):
+    try:
+        hdf_project.add_sdcube(['x'], name=CACHE)
+        assert False
+    except ValueError:
+        assert True
@@ -1,6 +1,8 @@
 from hdf import Hdf5
 from decimal import Decimal as d
-from numpy import arange, array
+from numpy import arange, array, random, average, amax, amin, allclose, \
+        nan, isnan, nan_to_num, var, std, nansum, nanmean, nanvar, nanstd, \
+        nanmax, nanmin, percentile, int64
 import os
 from collapse_dimension import CollapseDimension
 
@@ -149,3 +151,194 @@ def test_test(hdf_project):
     if not cube_mapping == {'x':0}:
         assert False
 
+
+def test_blockwise_matches_in_memory():
+    if os.path.exists('collapse.hdf5'):
+        os.remove('collapse.hdf5')
+    hdf = Hdf5('collapse')
+    name = hdf.add_sdcube(['x', 'y', 'z'], name='3D')
+    sdcube = hdf.get_sdcube(name)
+    sdcube.create_dataset({'x':range(7), 'y':range(5), 'z':range(6)})
+    data = random.RandomState(0).random_sample((7, 5, 6))
+    sdcube.set_data({'x':0, 'y':0, 'z':0}, data)
+    for collapse_dim in xrange(3):
+        for method, numpy_function in (('average', average), ('max', amax),
+                ('min', amin)):
+            out_name = 'collapsed_%s_%s' % (collapse_dim, method)
+            hdf.execute_function(CollapseDimension('Collapse', [collapse_dim,
+                method, {'block_size':4}], ['3D'], [out_name]))
+            result = hdf.get_sdcube(out_name).get_data()[0]
+            assert allclose(result, numpy_function(data, collapse_dim))
+
+def pytest_funcarg__random_hdf_project(request):
+    ''' Set up a project with one 3-D cube of random numbers, some of them
+    NaN.
+
+    '''
+    if os.path.exists('collapse.hdf5'):
+        os.remove('collapse.hdf5')
+    hdf = Hdf5('collapse')
+    name = hdf.add_sdcube(['x', 'y', 'z'], name='3D')
+    sdcube = hdf.get_sdcube(name)
+    sdcube.create_dataset({'x':range(7), 'y':range(5), 'z':range(6)})
+    data = random.RandomState(0).random_sample((7, 5, 6))
+    data[random.RandomState(1).random_sample(data.shape) < 0.2] = nan
+    sdcube.set_data({'x':0, 'y':0, 'z':0}, data)
+    return hdf, data
+
+def test_streaming_reductions(random_hdf_project):
+    hdf, data = random_hdf_project
+    clean = nan_to_num(data)
+    cases = [('sum', clean, lambda values, axis: values.sum(axis)),
+            ('var', clean, var), ('std', clean, std),
+            ('nansum', data, nansum), ('nanaverage', data, nanmean),
+            ('nanvar', data, nanvar), ('nanstd', data, nanstd),
+            ('nanmax', data, nanmax), ('nanmin', data, nanmin),
+            ('count', data, lambda values, axis: (~isnan(values)).sum(axis))]
+    for collapse_dim in xrange(3):
+        for method, values, numpy_function in cases:
+            hdf.get_sdcube('3D').set_data({'x':0, 'y':0, 'z':0}, values)
+            out_name = 'collapsed_%s_%s' % (collapse_dim, method)
+            hdf.execute_function(CollapseDimension('Collapse', [collapse_dim,
+                method, {'block_size':4}], ['3D'], [out_name]))
+            result = hdf.get_sdcube(out_name).get_data()[0]
+            assert allclose(result, numpy_function(values, collapse_dim))
+
+def test_count_dtype(simple_hdf_project):
+    simple_hdf_project.execute_function(CollapseDimension('Collapse', [0,
+        'count'], ['2D_1'], ['counted']))
+    result = simple_hdf_project.get_sdcube('counted').get_data()[0]
+    assert result.dtype == int64
+    assert (result == 4).all()
+
+def test_exact_percentiles(simple_hdf_project):
+    for method, q in (('median', 50), ('percentile_25', 25)):
+        simple_hdf_project.execute_function(CollapseDimension('Collapse', [1,
+            method, {'block_size':2}], ['2D_1'], [method]))
+        result = simple_hdf_project.get_sdcube(method).get_data()[0]
+        assert allclose(result, percentile(arange(16).reshape((4, 4)), q, 1))
+
+def test_approximate_percentiles():
+    if os.path.exists('collapse.hdf5'):
+        os.remove('collapse.hdf5')
+    hdf = Hdf5('collapse')
+    name = hdf.add_sdcube(['x', 'y'], name='long')
+    sdcube = hdf.get_sdcube(name)
+    sdcube.create_dataset({'x':range(5000), 'y':range(3)})
+    data = random.RandomState(0).random_sample((5000, 3))
+    sdcube.set_data({'x':0, 'y':0}, data)
+    for method, q in (('median', 50), ('percentile_90', 90)):
+        hdf.execute_function(CollapseDimension('Collapse', [0, method,
+            {'block_size':2 ** 10}], ['long'], [method]))
+        result = hdf.get_sdcube(method).get_data()[0]
+        # uniform data, so the rank error equals the error of the value
+        assert abs(result - percentile(data, q, 0)).max() < 0.05
+
+def test_unknown_method(simple_hdf_project):
+    for method in ('mode', 'percentile_x', 'percentile_101'):
+        try:
+            simple_hdf_project.execute_function(CollapseDimension('Collapse',
+                [0, method], ['2D_1'], ['collapsed_' + method]))
+        except ValueError:
+            pass
+        else:
+            assert False
+
+def test_parallel_matches_serial(random_hdf_project):
+    hdf, data = random_hdf_project
+    for method in ('max', 'min', 'average', 'nanstd', 'median'):
+        results = []
+        for workers in (1, 3):
+            out_name = 'collapsed_%s_%s' % (method, workers)
+            hdf.execute_function(CollapseDimension('Collapse', [1, method,
+                {'block_size':4, 'workers':workers}], ['3D'], [out_name]))
+            results.append(hdf.get_sdcube(out_name).get_data()[0])
+        if method in ('max', 'min'):
+            assert ((results[0] == results[1]) | (isnan(results[0]) &
+                isnan(results[1]))).all()
+        else:
+            assert allclose(results[0], results[1], equal_nan=True)
+
+def test_parallel_several_datasets(hdf_project):
+    for workers in (1, 2):
+        hdf_project.execute_function(CollapseDimension('Collapse', [0,
+            'average', {'block_size':4, 'workers':workers}], ['2D_1'],
+            ['averaged_%s' % workers]))
+    serial = hdf_project.get_sdcube('averaged_1').get_data()
+    parallel = hdf_project.get_sdcube('averaged_2').get_data()
+    assert len(parallel) == 2
+    for array1, array2 in zip(serial, parallel):
+        assert allclose(array1, array2)
+
+def test_collapse_several_dimensions(random_hdf_project):
+    hdf, data = random_hdf_project
+    for collapse_dims, axes in (([0, 2], (0, 2)), (['z', 'x'], (0, 2)),
+            (['y', 2], (1, 2))):
+        for method, numpy_function in (('nansum', nansum), ('nanmax', nanmax),
+                ('nanvar', nanvar), ('median', lambda values, axis:
+                    percentile(values, 50, axis))):
+            out_name = 'collapsed_%s_%s' % (axes, method)
+            hdf.execute_function(CollapseDimension('Collapse', [collapse_dims,
+                method, {'block_size':8}], ['3D'], [out_name]))
+            outcube = hdf.get_sdcube(out_name)
+            result = outcube.get_data()[0]
+            assert allclose(result, numpy_function(data, axes),
+                    equal_nan=True)
+    mapping = hdf.get_sdcube('collapsed_(0, 2)_nansum').mapping
+    if not mapping == {'y':0}:
+        assert False
+    mapping = hdf.get_sdcube('collapsed_(1, 2)_nansum').mapping
+    if not mapping == {'x':0}:
+        assert False
+
+def test_collapse_several_dimensions_labels(hdf_project):
+    hdf_project.execute_function(CollapseDimension('Collapse', [['x', 'y'],
+        'sum'], ['2D_1'], ['total']))
+    data = hdf_project.get_sdcube('total').get_data()
+    assert [int(values) for values in data] == [120, 0]
+    if not hdf_project.get_sdcube('total').mapping == {}:
+        assert False
+
+def test_collapse_every_dimension(hdf_project):
+    data = arange(4*4).reshape((4, 4))
+    for method, numpy_function in (('nanvar', nanvar), ('nanaverage',
+            nanmean), ('nanstd', nanstd), ('var', var), ('nansum', nansum)):
+        hdf_project.execute_function(CollapseDimension('Collapse', [['x',
+            'y'], method, {'block_size':4}], ['2D_1'], [method]))
+        result = hdf_project.get_sdcube(method).get_data()
+        assert allclose(result[0], numpy_function(data))
+        assert allclose(result[1], 0)
+    # a 1-D cube
+    name = hdf_project.add_sdcube(['x'], name='1D')
+    sdcube = hdf_project.get_sdcube(name)
+    sdcube.create_dataset({'x':range(5)})
+    sdcube.set_data({'x':0}, array([1, nan, 3, 4, nan]))
+    hdf_project.execute_function(CollapseDimension('Collapse', ['x',
+        'nanvar'], ['1D'], ['1D_nanvar']))
+    result = hdf_project.get_sdcube('1D_nanvar').get_data()[0]
+    assert allclose(result, nanvar([1, 3, 4]))
+
+def test_collapse_same_dimension_twice(simple_hdf_project):
+    try:
+        simple_hdf_project.execute_function(CollapseDimension('Collapse',
+            [[0, 'x'], 'sum'], ['2D_1'], ['collapsed']))
+    except ValueError:
+        pass
+    else:
+        assert False
+
+def test_integer_storage_promoted():
+    if os.path.exists('collapse.hdf5'):
+        os.remove('collapse.hdf5')
+    hdf = Hdf5('collapse')
+    name = hdf.add_sdcube(['x', 'y'], name='ints', storage={'dtype':'i4',
+        'chunks':'auto', 'scaleoffset':True})
+    sdcube = hdf.get_sdcube(name)
+    sdcube.create_dataset({'x':range(2), 'y':range(2)})
+    sdcube.set_data({'x':0, 'y':0}, array([[1, 2], [3, 4]]))
+    for method, expected in (('average', [1.5, 3.5]), ('std', [0.5, 0.5]),
+            ('sum', [3, 7])):
+        hdf.execute_function(CollapseDimension('Collapse', [1, method],
+            ['ints'], [method]))
+        assert allclose(hdf.get_sdcube(method).get_data()[0], expected)
+    assert hdf.get_sdcube('sum').get_data()[0].dtype.kind == 'i'
@@ -1,4 +1,7 @@
+import h5py
+import function
 from hdf import Hdf5
+from labels import dataset_labels
 from create_subcube import Create_subcube
 from decimal import Decimal as d
 from numpy import arange, array
@@ -46,7 +49,8 @@ def test_create_subcube_range_and_non_range(hdf_project):
     hdf.recompute()
     cube = hdf_project.get_sdcube('subcube1')
     data = cube.get_data()
-    expected = [array([[0, 4, 8, 12]]), array([[3, 7, 11, 15]])]
+    expected = [array([[0, 3], [4, 7], [8, 11], [12, 15]])]
+    assert len(data) == len(expected)
     for array1, array2 in zip(data, expected):
         assert all((x == y) for x, y in zip(array1.flat, array2.flat))
 
@@ -80,3 +84,46 @@ def test_create_subecube_mixed_range_and_non_range(hdf_project):
     for array1, array2 in zip(data, expected):
         assert all((x == y) for x, y in zip(array1.flat, array2.flat))
 
+
+def test_create_subcube_labels(hdf_project):
+    hdf = hdf_project
+    hdf.execute_function(Create_subcube('Function 4', [{'y':['d', 'b', 'e',
+        'f']}], ['2D_1'], ['subcube4']))
+    cube = hdf_project.get_sdcube('subcube4')
+    data = cube.get_data()
+    expected = [array([[1, 3], [5, 7], [9, 11], [13, 15]]), array([[1]])]
+    assert len(data) == len(expected)
+    for array1, array2 in zip(data, expected):
+        assert (array1 == array2).all()
+    with h5py.File('subcube.hdf5', 'r') as h5_file:
+        labels = dict((dim_index, list(values)) for dim_index, values in
+                dataset_labels(h5_file['subcube4']['0']).items())
+    assert labels == {0:[d('1'), d('2'), d('3'), d('4')], 1:['b', 'd']}
+
+def test_create_subcube_view(hdf_project):
+    hdf = hdf_project
+    hdf.add_function(Create_subcube('Function 5', [{'x':[d('1'), (d('3'),
+        d('4')), d('10')], 'y':['a', 'c', 'd', 'e']}, {'view':True}],
+        ['2D_1'], ['view']))
+    hdf.recompute()
+    cube = hdf.get_sdcube('view')
+    with h5py.File('subcube.hdf5', 'r') as h5_file:
+        assert all(ds.is_virtual for ds in function.fragments(
+            h5_file['view']))
+    expected = [array([[0, 2, 3], [8, 10, 11], [12, 14, 15]]), array([[1]])]
+    data = cube.get_data()
+    assert len(data) == len(expected)
+    for array1, array2 in zip(data, expected):
+        assert (array1 == array2).all()
+
+    # the view shows changes of its input until it is materialized
+    hdf.get_sdcube('2D_1').set_data({'x':d('3'), 'y':'c'},
+            array(20).reshape((1, 1)))
+    assert cube.get_data({'x':d('3'), 'y':'c'})[0][0, 0] == 20
+    cube.materialize()
+    with h5py.File('subcube.hdf5', 'r') as h5_file:
+        assert not any(ds.is_virtual for ds in function.fragments(
+            h5_file['view']))
+    hdf.get_sdcube('2D_1').set_data({'x':d('3'), 'y':'c'},
+            array(10).reshape((1, 1)))
+    assert cube.get_data({'x':d('3'), 'y':'c'})[0][0, 0] == 20
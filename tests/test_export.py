@@ -0,0 +1,74 @@
+import os
+import csv
+from decimal import Decimal as d
+from numpy import arange, array, nan, isnan, load, memmap
+from hdf import SdCube
+from export import to_csv, to_memmap, to_npy, to_npz, read_labels
+
+def pytest_funcarg__filled_sdcube(request):
+    ''' A cube with two datasets, 2x3 (0 to 5) and 2x2 (10 to 13).
+
+    '''
+    filename = 'export.hdf5'
+    if os.path.exists(filename):
+        os.remove(filename)
+    sdcube = SdCube('filled', filename, ['x', 'y'])
+    sdcube.create_dataset({'x':[d('1'), d('2')], 'y':['a', 'b', 'c']})
+    sdcube.set_data({'x':d('1'), 'y':'a'}, arange(2*3).reshape((2, 3)))
+    sdcube.create_dataset({'x':[d('3'), d('1')], 'y':['d', 'e']})
+    sdcube.set_data({'x':d('3'), 'y':'d'}, arange(10, 14).reshape((2, 2)))
+    return sdcube
+
+def test_to_csv(filled_sdcube):
+    for block_size in (1, 4, 1000):
+        assert to_csv(filled_sdcube, 'export.csv',
+                block_size=block_size) == 10
+        with open('export.csv', 'rb') as csv_file:
+            rows = list(csv.reader(csv_file))
+        assert rows[0] == ['x', 'y', 'value']
+        assert sorted([x, y, float(value)] for x, y, value in rows[1:]) == \
+                sorted([['1', 'a', 0], ['1', 'b', 1], ['1', 'c', 2], ['2',
+                    'a', 3], ['2', 'b', 4], ['2', 'c', 5], ['3', 'd', 10],
+                    ['3', 'e', 11], ['1', 'd', 12], ['1', 'e', 13]])
+    assert to_csv(filled_sdcube, 'export.csv', {'x':d('1')}, 'v', 1) == 5
+    with open('export.csv', 'rb') as csv_file:
+        rows = list(csv.reader(csv_file))
+    assert rows[0] == ['x', 'y', 'v']
+    assert [[x, y, float(value)] for x, y, value in rows[1:]] == [['1', 'a',
+        0], ['1', 'b', 1], ['1', 'c', 2], ['1', 'd', 12], ['1', 'e', 13]]
+
+def test_to_npy_and_memmap(filled_sdcube):
+    expected = array([[0, 1, 2, 12, 13], [3, 4, 5, nan, nan], [nan, nan, nan,
+        10, 11]])
+    to_npy(filled_sdcube, 'export', block_size=2)
+    data = load('export.npy')
+    assert ((data == expected) | (isnan(data) & isnan(expected))).all()
+    labels = read_labels('export.npy')
+    assert labels['dimensions'] == ['x', 'y']
+    assert labels['labels'] == {'x':[d('1'), d('2'), d('3')], 'y':['a', 'b',
+        'c', 'd', 'e']}
+
+    to_memmap(filled_sdcube, 'export.dat', {'y':'d'}, fill=-1)
+    labels = read_labels('export.dat')
+    data = memmap('export.dat', dtype=labels['dtype'], mode='r',
+            shape=labels['shape'])
+    assert labels['labels'] == {'x':[d('1'), d('3')], 'y':['d']}
+    assert (data == array([[12], [10]])).all()
+    del data
+
+def test_to_npz(filled_sdcube):
+    assert to_npz(filled_sdcube, 'export.npz', block_size=1) == ['0', '1']
+    archive = load('export.npz')
+    assert (archive['0'] == arange(6).reshape((2, 3))).all()
+    assert (archive['1'] == arange(10, 14).reshape((2, 2))).all()
+    archive.close()
+    labels = read_labels('export.npz')
+    assert labels['fragments']['1'] == {'x':[d('3'), d('1')], 'y':['d', 'e']}
+
+    assert to_npz(filled_sdcube, 'export.npz', {'y':'b'}, compress=True) == \
+            ['0']
+    archive = load('export.npz')
+    assert (archive['0'] == array([[1], [4]])).all()
+    archive.close()
+    assert read_labels('export.npz')['fragments'] == {'0':{'x':[d('1'),
+        d('2')], 'y':['b']}}
@@ -3,6 +3,7 @@ from numpy import arange
 import h5py
 from hdf import Hdf5
 from sum import Sum
+from join_cubes import JoinCubes
 from decimal import Decimal as d
 import os
 
@@ -166,6 +167,35 @@ def test_execute_function(hdf_project, function):
     expected = 2 * arange(3*3*3*4) #the sum should be double the amount
     assert all(x == y for x, y in zip(data, expected))
 
+class FailingSum(Sum):
+    ''' A Sum failing after it wrote its output cube.
+
+    '''
+    def __call__(self, input_cubes, output_cubes, params):
+        Sum.__call__(self, input_cubes, output_cubes, params)
+        raise ValueError('Failed')
+
+def test_execute_failing_function(hdf_project, function):
+    hdf_project.execute_function(function)
+    version = hdf_project.get_sdcube('sum').version
+    for output_cube_names in (['sum'], ['other']):
+        failing = FailingSum('python.test.sum', [], ['Project Data', 'ds'],
+                output_cube_names)
+        try:
+            hdf_project.execute_function(failing)
+            assert False
+        except ValueError:
+            assert True
+    # the earlier output is kept, the new one is not created
+    assert hdf_project.get_sdcube('Project Data').get_data()
+    sdcube = hdf_project.get_sdcube('sum')
+    assert sdcube.version == version
+    data = sdcube.get_data()[0].flat
+    assert all(x == y for x, y in zip(data, 2 * arange(3*3*3*4)))
+    with h5py.File(hdf_project.filename, 'r') as h5_file:
+        assert sorted(name for name in h5_file if not name.startswith('_'))\
+                == ['Project Data', 'ds', 'sum']
+
 def test_recompute(hdf_project, function):
     h, mysum = hdf_project, function
     h.add_function(mysum)
@@ -189,3 +219,172 @@ def test_execute_fail_index_labels(hdf_project, function):
     except ValueError:
         assert True
 
+
+def test_session(hdf_project):
+    group_name = 'Project Data'
+    indices = {'first':d('1'), 'second':'a', 'test':d('1.0'), 'another':d('1')}
+    with hdf_project.session('a') as project:
+        sdcube = project.get_sdcube(group_name)
+        sdcube.set_data(indices, 2 * arange(3*3*3*4).reshape((3, 3, 3, 4)))
+        data = sdcube.get_data()[0].flat
+        assert hdf_project._h5_file
+    assert not hdf_project._h5_file
+    assert all(x == y for x, y in zip(data, 2 * arange(3*3*3*4)))
+    # the cube falls back to opening the file on every call
+    data = sdcube.get_data()[0].flat
+    assert all(x == y for x, y in zip(data, 2 * arange(3*3*3*4)))
+
+def test_read_only_session(hdf_project):
+    group_name = 'Project Data'
+    indices = {'first':d('1'), 'second':'a', 'test':d('1.0'), 'another':d('1')}
+    with hdf_project.session() as project:
+        sdcube = project.get_sdcube(group_name)
+        assert sdcube.get_data()[0][0, 0, 0, 0] == 0
+        try:
+            sdcube.set_data(indices, arange(3*3*3*4).reshape((3, 3, 3, 4)))
+            assert False
+        except IOError:
+            assert True
+
+def test_recompute_order(hdf_project):
+    ''' The functions are added in reverse order of their dependencies.
+
+    '''
+    h = hdf_project
+    h.add_function(Sum('python.test.sum', [], ['sum', 'ds'], ['sum2']))
+    h.add_function(Sum('python.test.sum', [], ['Project Data', 'ds'],
+        ['sum']))
+    h.recompute()
+    data = h.get_sdcube('sum2').get_data()[0].flat
+    assert all(x == y for x, y in zip(data, 3 * arange(3*3*3*4)))
+
+def test_recompute_cycle(hdf_project):
+    h = hdf_project
+    h.add_function(Sum('python.test.sum', [], ['Project Data', 'ds'],
+        ['sum']))
+    h.add_function(Sum('python.test.sum', [], ['sum', 'ds'], ['Project Data']))
+    try:
+        h.recompute()
+        assert False
+    except ValueError:
+        assert True
+
+def test_parallel_recompute(hdf_project):
+    h = hdf_project
+    h.add_function(Sum('python.test.sum', [], ['sum', 'ds'], ['sum2']))
+    h.add_function(Sum('python.test.sum', [], ['Project Data', 'ds'],
+        ['sum']))
+    name = h.add_sdcube(['first', 'second', 'test', 'another'], name='other')
+    sdcube = h.get_sdcube(name)
+    sdcube.create_dataset({'first':[d('8')], 'second':['a', 'b', 'c'],
+        'test':[d('1.0'), d('2.0'), d('3.0')], 'another':[d('1'), d('2.0'),
+            '3', d('4')]})
+    sdcube.set_data({'first':d('8'), 'second':'a', 'test':d('1.0'),
+        'another':d('1')}, arange(3*3*4).reshape((1, 3, 3, 4)))
+    h.add_function(Sum('python.test.sum', [], ['other', 'other'], ['double']))
+    h.add_function(JoinCubes('Join', [{'virtual':True}], ['sum', 'double'],
+        ['joined']))
+    h.recompute(workers=3)
+    expected = arange(3*3*3*4)
+    for name, factor in [('sum', 2), ('sum2', 3)]:
+        data = h.get_sdcube(name).get_data()[0].flatten()
+        assert (data == factor * expected).all()
+    data = h.get_sdcube('joined').get_data()
+    assert len(data) == 1
+    assert (data[0][:3].flatten() == 2 * expected).all()
+    assert (data[0][3:].flatten() == 2 * arange(3*3*4)).all()
+    with h5py.File(h.filename, 'r') as f:
+        assert f['joined']['0'].is_virtual
+        for name in ['sum', 'sum2', 'double', 'joined']:
+            assert f[name].attrs['dirty'] == False
+    assert not [name for name in os.listdir('.') if name.startswith('tmp')]
+
+    # change an input, everything depending on it is recomputed
+    h.get_sdcube('ds').set_data({'first':d('1'), 'second':'a',
+        'test':d('1.0'), 'another':d('1')}, 0 * arange(3*3*3*4).reshape((3,
+            3, 3, 4)))
+    h.recompute(workers=2)
+    for name, factor in [('sum', 1), ('sum2', 1)]:
+        data = h.get_sdcube(name).get_data()[0].flatten()
+        assert (data == factor * expected).all()
+    assert (h.get_sdcube('joined').get_data()[0][:3].flatten() ==
+            expected).all()
+
+def test_incremental_recompute(hdf_project):
+    h = hdf_project
+    indices = {'first':d('1'), 'second':'a', 'test':d('1.0'), 'another':d('1')}
+    h.add_function(Sum('python.test.sum', [], ['sum', 'ds'], ['sum2']))
+    h.add_function(Sum('python.test.sum', [], ['Project Data', 'ds'],
+        ['sum']))
+    h.add_function(Sum('python.test.sum', [], ['ds', 'ds'], ['double']))
+    h.recompute()
+    versions = dict((name, h.get_sdcube(name).version) for name in ['sum',
+        'sum2', 'double'])
+    assert not any(h.is_stale(func) for func in h.get_functions())
+
+    # nothing changed, nothing is executed
+    h.recompute()
+    for name, version in versions.iteritems():
+        assert h.get_sdcube(name).version == version
+
+    # only the chain depending on the changed cube is executed, each once
+    sdcube = h.get_sdcube('Project Data')
+    version = sdcube.version
+    sdcube.set_data(indices, 0 * arange(3*3*3*4).reshape((3, 3, 3, 4)))
+    assert sdcube.version > version
+    h.recompute()
+    assert h.get_sdcube('double').version == versions['double']
+    assert h.get_sdcube('sum').version > versions['sum']
+    assert h.get_sdcube('sum2').version > h.get_sdcube('sum').version
+    with h5py.File(h.filename, 'r') as f:
+        assert (f['sum2']['0'][...].flatten() == 2 *
+                arange(3*3*3*4)).all()
+
+    # a new cube never gets the version of a deleted one
+    version = h.get_sdcube('double').version
+    h.delete_cube('double')
+    h.recompute()
+    assert h.get_sdcube('double').version > version
+
+def test_catalog(hdf_project):
+    import hdf
+    catalog = hdf_project.get_catalog()
+    assert sorted(catalog) == ['Project Data', 'ds']
+    assert catalog['ds'] == (hdf_project.filename, {'first':0, 'second':1,
+        'test':2, 'another':3})
+    h5py_file = hdf.h5py.File
+    def no_open(*args, **kwargs):
+        assert False
+    hdf.h5py.File = no_open
+    try:
+        sdcube = hdf_project.get_sdcube('ds')
+    finally:
+        hdf.h5py.File = h5py_file
+    assert sdcube.get_data()[0].shape == (3, 3, 3, 4)
+
+    # changes of another project object are seen
+    other = Hdf5('project')
+    other.add_sdcube(['x'], name='new')
+    assert hdf_project.get_sdcube('new').mapping == {'x':0}
+    other.delete_cube('new')
+    try:
+        hdf_project.get_sdcube('new')
+        assert False
+    except KeyError:
+        assert True
+
+def test_catalog_stale_entry(hdf_project):
+    import hdf
+    with h5py.File(hdf_project.filename, 'a') as h5_file:
+        sdcubes = hdf.load_attribute(h5_file, 'sdcubes')
+        sdcubes['ghost'] = hdf_project.filename
+        sdcubes['elsewhere'] = 'missing.hdf5'
+        hdf.store_attribute(h5_file, 'sdcubes', sdcubes)
+    project = Hdf5('project')
+    assert sorted(project.get_catalog()) == ['Project Data', 'ds']
+    assert project.get_sdcube('ds').get_data()[0].shape == (3, 3, 3, 4)
+    try:
+        project.get_sdcube('ghost')
+        assert False
+    except KeyError:
+        assert True
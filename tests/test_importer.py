@@ -0,0 +1,93 @@
+from hdf import Hdf5
+from importer import import_file, import_rows, iter_fragments, column_labels
+from decimal import Decimal as d
+from numpy import array
+import os
+
+def pytest_funcarg__csv_file(request):
+    ''' Write a small sheet with two independent variables, three
+    measurements and two blocks (the third measurement is missing in the
+    second one).
+
+    '''
+    rows = [',,Kinase assay,,Immunoblot', 'TNF,Time,ERK,MK2,pMEK']
+    for tnf in (0, 100):
+        for time in (0, 5, 15):
+            rows.append('%s,%s,%s,%s,%s' % (tnf, time, tnf + time, 1, 2))
+    for time in (30, 60):
+        rows.append('%s,%s,%s,%s,' % (0, time, time, 1))
+    with open('import.csv', 'w') as csv_file:
+        csv_file.write('\n'.join(rows) + '\n')
+    if os.path.exists('import.hdf5'):
+        os.remove('import.hdf5')
+    return 'import.csv'
+
+def test_column_labels():
+    assert column_labels([['', 'Kinase assay'], ['TNF', 'ERK']]) == ['TNF',
+            'ERK (Kinase assay)']
+
+def test_import_utf8_csv():
+    with open('import.csv', 'w') as csv_file:
+        csv_file.write(u'Prot\xe4in,Zeit,Menge\n\xc4rger,0,1\nFreude,0,2\n'
+                .encode('utf-8'))
+    if os.path.exists('import.hdf5'):
+        os.remove('import.hdf5')
+    hdf = Hdf5('import')
+    name = import_file(hdf, 'import.csv', 2, header_rows=1)
+    cube = hdf.get_sdcube(name)
+    if not cube.mapping == {u'Prot\xe4in':0, u'Zeit':1, 'measurements':2}:
+        assert False
+    data = cube.get_data(items={u'Prot\xe4in':u'\xc4rger'})
+    assert [x.flatten().tolist() for x in data] == [[1]]
+
+def test_import_csv(csv_file):
+    hdf = Hdf5('import')
+    name = import_file(hdf, csv_file, 2, name='imported')
+    cube = hdf.get_sdcube(name)
+    if not cube.mapping == {'TNF':0, 'Time':1, 'measurements':2}:
+        assert False
+    data = cube.get_data()
+    expected = [array([[[0, 1, 2], [5, 1, 2], [15, 1, 2]], [[100, 1, 2], [105,
+        1, 2], [115, 1, 2]]]), array([[[30, 1], [60, 1]]])]
+    assert len(data) == len(expected)
+    for array1, array2 in zip(data, expected):
+        assert (array1 == array2).all()
+    assert cube.get_data({'TNF':d('100'), 'Time':d('5'),
+        'measurements':2})[0].flat[0] == 105
+
+def test_split_long_blocks():
+    rows = [[outer, inner, outer * 10 + inner] for outer in xrange(7) for
+            inner in xrange(10)]
+    for max_rows in (5, 25, 1000):
+        fragments = list(iter_fragments(rows, 2, max_rows))
+        assert sum(data.size for labels, columns, data in fragments) == 70
+        assert sorted(value for labels, columns, data in fragments for value
+                in data.flat) == range(70)
+        if max_rows >= 10:
+            # whole grids of the inner variable
+            assert all(data.shape[1:] == (10, 1) for labels, columns, data in
+                    fragments)
+            assert len(fragments) == (1 if max_rows > 70 else 7 // (max_rows
+                // 10) + 1)
+
+def test_import_split_blocks():
+    if os.path.exists('import.hdf5'):
+        os.remove('import.hdf5')
+    hdf = Hdf5('import')
+    name = hdf.add_sdcube(['outer', 'inner', 'measurements'], name='split')
+    cube = hdf.get_sdcube(name)
+    rows = ([outer, inner, outer * 10 + inner] for outer in xrange(7) for
+            inner in xrange(10))
+    assert import_rows(cube, rows, ['outer', 'inner', 'measurements'], 2,
+            max_rows=25) > 1
+    values = sorted(value for data in cube.get_data() for value in data.flat)
+    assert values == range(70)
+
+def test_import_no_grid():
+    rows = [[0, 0, 1], [0, 1, 1], [0, 1, 2]]
+    try:
+        list(iter_fragments(rows, 2))
+    except ValueError:
+        pass
+    else:
+        assert False
@@ -1,4 +1,6 @@
 from hdf import Hdf5
+import function
+import h5py
 from join_cubes import JoinCubes
 from decimal import Decimal as d
 from numpy import arange, array
@@ -207,3 +209,41 @@ def test_merge(hdf_project):
     for array1, array2 in zip(data, expected):
         assert all((x == y) for x, y in zip(array1.flat, array2.flat))
 
+
+def test_virtual_join(hdf_project):
+    ''' Join the two existing cubes without copying the data and
+    materialize the result later.
+
+    '''
+    my_join_functions = JoinCubes('Join', [{'virtual':True}], ['2D_1',
+        '2D_2'], ['joined_cube'])
+    hdf_project.add_function(my_join_functions)
+    hdf_project.recompute()
+    cube = hdf_project.get_sdcube('joined_cube')
+    with h5py.File(hdf_project.filename, 'r') as h5_file:
+        assert all(ds.is_virtual for ds in
+                function.fragments(h5_file['joined_cube']))
+    expected = [array([
+        [ 0,  1,  2,  3],
+        [ 4,  5,  6,  7],
+        [ 8,  9, 10, 11],
+        [12, 13, 14, 15],
+        [ 0,  1,  2,  3]]),
+        array([[1], [0], [1], [2], [3]])]
+    for array1, array2 in zip(cube.get_data(), expected):
+        assert (array1 == array2).all()
+
+    # the virtual cube shows changes of its input
+    hdf_project.get_sdcube('2D_1').set_data({'x':d('10'), 'y':'e'},
+            array(5).reshape((1, 1)))
+    assert cube.get_data({'x':d('10'), 'y':'e'})[0][0, 0] == 5
+
+    cube.materialize()
+    with h5py.File(hdf_project.filename, 'r') as h5_file:
+        assert not any(ds.is_virtual for ds in
+                function.fragments(h5_file['joined_cube']))
+    hdf_project.get_sdcube('2D_1').set_data({'x':d('10'), 'y':'e'},
+            array(1).reshape((1, 1)))
+    expected[1][0, 0] = 5
+    for array1, array2 in zip(cube.get_data(), expected):
+        assert (array1 == array2).all()
@@ -0,0 +1,152 @@
+from __future__ import with_statement
+from decimal import Decimal as d
+import cPickle as pickle
+import os
+import h5py
+from labels import LabelIndex, label_index, ExtentIndex, extent_index, \
+        record_extent, fragment_names, clear_cache, dataset_labels, \
+        load_labels, store_labels, init_format, migrate, EXTENTS, LABELS
+
+def pytest_funcarg__h5_file(request):
+    filename = 'labels.hdf5'
+    if os.path.exists(filename):
+        os.remove(filename)
+    h5_file = h5py.File(filename, 'w')
+    request.addfinalizer(h5_file.close)
+    return h5_file
+
+def test_position():
+    index = LabelIndex({0:[d('1'), d('2'), d('7.0')], 1:['a', 'b', 'a']})
+    assert index.position(0, d('7.0')) == 2
+    assert index.position(0, '1') == -1
+    # the first occurence wins like list.index
+    assert index.position(1, 'a') == 0
+    assert index.label(1, 1) == 'b'
+    assert (1, 'b') in index
+    assert not (1, 'c') in index
+
+def test_many_labels():
+    labels = range(100000)
+    index = LabelIndex({0:labels})
+    assert all(index.position(0, label) == label for label in labels)
+
+def test_cached_index(h5_file):
+    dset = h5_file.create_dataset('0', (2, 2))
+    dset.attrs['mapping'] = pickle.dumps({0:['a', 'b'], 1:['c', 'd']})
+    index = label_index(dset)
+    assert label_index(dset) is index
+    assert index.position(1, 'd') == 1
+
+    # a changed mapping invalidates the index
+    dset.attrs['mapping'] = pickle.dumps({0:['a', 'b'], 1:['d', 'c']})
+    assert not label_index(dset) is index
+    assert label_index(dset).position(1, 'd') == 0
+
+def test_extent_index():
+    index = ExtentIndex()
+    index.add('0', {0:['a', 'b'], 1:[1, 2, 3]})
+    index.add('1', {0:['c'], 1:[1, 2, 3]})
+    assert index.locate({0:'b', 1:3}) == set(['0'])
+    assert index.locate({0:'c', 1:4}) == set()
+    assert index.overlapping({0:['b', 'c'], 1:[3]}) == set(['0', '1'])
+    assert index.overlapping({0:['b', 'c'], 1:[4]}) == set()
+    index.remove('0')
+    assert index.locate({0:'b', 1:3}) == set()
+    assert index.overlapping({0:['b', 'c'], 1:[3]}) == set(['1'])
+
+def test_persisted_extent_index(h5_file):
+    import labels
+    grp = h5_file.create_group('cube')
+    dset = grp.create_dataset('0', (2, 2))
+    store_labels(dset, {0:['a', 'b'], 1:['c', 'd']})
+    index = extent_index(grp)
+    assert EXTENTS in grp
+    assert fragment_names(grp) == ['0']
+    dset = grp.create_dataset('1', (1, 1))
+    store_labels(dset, {0:['e'], 1:[d('1.5')]})
+    record_extent(grp, index, '1', {0:['e'], 1:[d('1.5')]})
+
+    # a cold load reads the persisted extents, not the labels
+    clear_cache()
+    load_labels = labels.load_labels
+    def no_load(dset):
+        assert False
+    labels.load_labels = no_load
+    try:
+        index = extent_index(grp)
+    finally:
+        labels.load_labels = load_labels
+    assert index.locate({0:'e', 1:d('1.5')}) == set(['1'])
+    assert index.mappings['0'] == {0:['a', 'b'], 1:['c', 'd']}
+
+    # a dataset recreated with other labels is found although the number
+    # of members stays the same
+    del grp['0']
+    dset = grp.create_dataset('0', (1, 1))
+    store_labels(dset, {0:['f'], 1:['c']})
+    assert extent_index(grp).locate({0:'a', 1:'c'}) == set()
+    assert extent_index(grp).locate({0:'f', 1:'c'}) == set(['0'])
+    clear_cache()
+    assert extent_index(grp).locate({0:'f', 1:'c'}) == set(['0'])
+
+    # changes that bypass the log cause a rebuild
+    del grp['1']
+    assert extent_index(grp).locate({0:'e', 1:d('1.5')}) == set()
+
+def test_read_only_extent_index(h5_file):
+    init_format(h5_file)
+    grp = h5_file.create_group('cube')
+    store_labels(grp.create_dataset('0', (2, 2)), {0:['a', 'b'], 1:['c',
+        'd']})
+    filename = h5_file.filename
+    h5_file.close()
+    clear_cache()
+    with h5py.File(filename, 'r') as read_only:
+        # no log can be written, the index is kept in memory nevertheless
+        index = extent_index(read_only['cube'])
+        assert not EXTENTS in read_only['cube']
+        assert extent_index(read_only['cube']) is index
+        assert index.locate({0:'b', 1:'c'}) == set(['0'])
+
+def test_store_labels(h5_file):
+    init_format(h5_file)
+    grp = h5_file.create_group('cube')
+    dset = grp.create_dataset('0', (3, 2, 2, 2, 3))
+    mapping = {0:[3, 1, 2], 1:[0.5, 1.5], 2:['a', 'b'], 3:[d('1'), d('1.0')],
+            4:[d('1'), '1', u'\xe9']}
+    store_labels(dset, mapping)
+    assert not 'mapping' in dset.attrs
+    assert [grp[LABELS]['0'][str(i)].attrs['encoding'] for i in xrange(5)] \
+            == ['int', 'float', 'str', 'decimal', 'dict']
+    loaded = load_labels(dset)
+    assert loaded == mapping
+    assert [str(x) for x in loaded[3]] == ['1', '1.0']
+    assert [type(x) for x in loaded[4]] == [d, str, unicode]
+
+def test_lazy_labels(h5_file):
+    init_format(h5_file)
+    grp = h5_file.create_group('cube')
+    dset = grp.create_dataset('0', (100000,))
+    store_labels(dset, {0:range(100000)})
+    labels = dataset_labels(dset)[0]
+    assert len(labels) == 100000
+    assert labels[-1] == 99999
+    assert labels[10:13] == [10, 11, 12]
+    assert sum(1 for x in labels) == 100000
+
+def test_migrate(h5_file):
+    grp = h5_file.create_group('cube')
+    grp.attrs['mapping'] = pickle.dumps({'x':0})
+    dset = grp.create_dataset('0', (2,))
+    # format version 1 pickles the mapping
+    store_labels(dset, {0:[d('1'), 'a']})
+    assert 'mapping' in dset.attrs
+    assert label_index(dset).position(0, 'a') == 1
+    filename = h5_file.filename
+    h5_file.close()
+    migrate(filename)
+    with h5py.File(filename, 'r') as h5_file:
+        dset = h5_file['cube']['0']
+        assert not 'mapping' in dset.attrs
+        assert load_labels(dset) == {0:[d('1'), 'a']}
+        assert label_index(dset).position(0, 'a') == 1
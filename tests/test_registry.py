@@ -0,0 +1,83 @@
+from __future__ import with_statement
+import cPickle as pickle
+import os
+import h5py
+from hdf import Hdf5
+from sum import Sum
+from registry import REGISTRY
+
+def pytest_funcarg__hdf_project(request):
+    if os.path.exists('registry.hdf5'):
+        os.remove('registry.hdf5')
+    return Hdf5('registry')
+
+def test_ids(hdf_project):
+    h = hdf_project
+    assert h.add_function(Sum('sum', [], ['a', 'b'], ['c'])) == 0
+    assert h.add_function(Sum('sum', [], ['c', 'b'], ['d'])) == 1
+    assert h.add_function(Sum('sum', [], ['a', 'a'], ['e'])) == 2
+    assert h.get_function_ids('b') == [0, 1]
+    assert h.get_function_ids('c') == [1]
+    assert h.get_function_ids('c', 'producers') == [0]
+    assert h.get_function(1).output_cube_names == ['d']
+    h.del_function(1)
+    assert h.get_function_ids('b') == [0]
+    assert [func.output_cube_names for func in h.get_functions()] == [['c'],
+            ['e']]
+    # ids stay stable
+    assert h.add_function(Sum('sum', [], ['c', 'b'], ['d'])) == 3
+    assert h.get_function(2).output_cube_names == ['e']
+    try:
+        h.get_function(1)
+        assert False
+    except KeyError:
+        assert True
+
+def test_del_function(hdf_project):
+    h = hdf_project
+    h.add_function(Sum('sum', [], ['a', 'b'], ['c']))
+    h.add_function(Sum('sum', [{'block_size':2}], ['a', 'b'], ['c']))
+    h.del_function(Sum('sum', [], ['a', 'b'], ['c']))
+    assert [func.params for func in h.get_functions()] == [[{'block_size':
+        2}]]
+
+def test_legacy_functions(hdf_project):
+    h = hdf_project
+    functions = [Sum('sum', [], ['a', 'b'], ['c']), Sum('sum', [], ['c',
+        'b'], ['d'])]
+    with h5py.File(h.filename, 'a') as h5_file:
+        del h5_file[REGISTRY]
+        h5_file.attrs['functions'] = pickle.dumps(functions)
+    assert [str(func) for func in h.get_functions()] == [str(func) for func
+            in functions]
+    assert h.get_function_ids('c', 'producers') == [0]
+    h.add_function(Sum('sum', [], ['a', 'a'], ['e']))
+    with h5py.File(h.filename, 'r') as h5_file:
+        assert not 'functions' in h5_file.attrs
+    assert h.get_function_ids('a') == [0, 2]
+
+def test_cached_index(hdf_project):
+    import registry
+    h = hdf_project
+    h.add_function(Sum('sum', [], ['a', 'b'], ['c']))
+    h.add_function(Sum('sum', [], ['c', 'b'], ['d']))
+    assert h.get_function_ids('b') == [0, 1]
+    with h5py.File(h.filename, 'r') as h5_file:
+        records = h5_file[REGISTRY]['records']
+        # lookups are answered from memory
+        h5py_get = h5py.Dataset.__getitem__
+        def no_read(*args):
+            assert False
+        h5py.Dataset.__getitem__ = no_read
+        try:
+            assert registry.consumers(h5_file, 'c') == [1]
+            assert registry.producers(h5_file, 'c') == [0]
+        finally:
+            h5py.Dataset.__getitem__ = h5py_get
+        assert [func.output_cube_names for func in registry.get_many(h5_file,
+            [1, 0])] == [['d'], ['c']]
+    # changes of another project object are seen
+    other = Hdf5('registry')
+    other.del_function(0)
+    other.add_function(Sum('sum', [], ['b', 'b'], ['f']))
+    assert h.get_function_ids('b') == [1, 2]
@@ -0,0 +1,30 @@
+from function import Function
+from scheduler import dependencies, downstream, topological_order
+
+def pytest_funcarg__functions(request):
+    ''' a -> b -> c, a -> d and the independent e -> f
+
+    '''
+    return [Function('c', [], ['b'], ['c']),
+            Function('b', [], ['a'], ['b']),
+            Function('f', [], ['e'], ['f']),
+            Function('d', [], ['a', 'b'], ['d'])]
+
+def test_dependencies(functions):
+    assert dependencies(functions) == [set([1]), set(), set(), set([1])]
+
+def test_downstream(functions):
+    assert downstream(functions, [1]) == set([0, 1, 3])
+    assert downstream(functions, [2]) == set([2])
+
+def test_topological_order(functions):
+    assert topological_order(functions) == [1, 2, 0, 3]
+    assert topological_order(functions, [0, 3]) == [0, 3]
+
+def test_cycle(functions):
+    functions.append(Function('a', [], ['c'], ['a']))
+    try:
+        topological_order(functions)
+        assert False
+    except ValueError:
+        assert True
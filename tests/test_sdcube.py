@@ -1,7 +1,9 @@
 import os
+import h5py
 from decimal import Decimal as d
-from numpy import arange, array
-from hdf import SdCube
+from numpy import arange, array, nan, isnan, memmap, zeros
+from hdf import Hdf5, SdCube
+from labels import fragment_names
 
 def pytest_funcarg__simple_sdcube(request):
     filename = 'myfile.hdf5'
@@ -177,3 +179,219 @@ def test_loading(simple_sdcube):
     if not simple_sdcube.mapping == {'x':0, 'y':1, 'z':2}:
         assert False
 
+
+def test_session(filled_sdcube):
+    data = arange(3*3*3).reshape((3,3,3))
+    with filled_sdcube.session('a') as cube:
+        cube.set_data({'x':d('1'), 'y':'a', 'z':d('1.0')}, data)
+        cube.create_dataset({'x':[d('10')], 'y':['a'], 'z':[d('1.0')]})
+        stored_data = cube.get_data(items={'x':d('1')})[0].flat
+    assert all(x == y for x, y in zip(data[0,:,:].flat, stored_data))
+    assert len(filled_sdcube.get_data()) == 2
+
+def test_overlap_with_any_dataset(filled_complicated_sdcube):
+    cube = filled_complicated_sdcube
+    # overlaps the first of the four datasets only
+    try:
+        cube.create_dataset({'x':[d('2'), d('4')], 'y':['b', 'z']})
+        assert False
+    except ValueError:
+        assert True
+    cube.create_dataset({'x':[d('4')], 'y':['a', 'b', 'c']})
+
+def test_delete_dataset(filled_complicated_sdcube):
+    cube = filled_complicated_sdcube
+    cube.delete_dataset('1')
+    assert len(cube.get_data()) == 3
+    try:
+        cube.delete_dataset('1')
+        assert False
+    except KeyError:
+        assert True
+    # the deleted extent is free again
+    cube.create_dataset({'x':[d('3')], 'y':['a', 'b']})
+    cube.set_data({'x':d('3'), 'y':'a'}, array([[1, 2]]))
+    data = cube.get_data(items={'x':d('3'), 'y':'b'})
+    assert [x[0, 0] for x in data] == [2]
+
+def test_extent_index_reloaded(filled_complicated_sdcube):
+    import labels
+    cube = filled_complicated_sdcube
+    labels.clear_cache()
+    cube.set_data({'x':d('3'), 'y':'d'}, array([[1, 2, 3]]))
+    data = cube.get_data(items={'x':d('3'), 'y':'f'})
+    assert [x[0, 0] for x in data] == [3]
+
+def test_get_data_without_match(filled_complicated_sdcube):
+    cube = filled_complicated_sdcube
+    assert cube.get_data(items={'y':'z'}) == []
+    data, first_inds = cube.get_data_and_indices(items={'x':d('5'), 'y':'e'})
+    assert [x.shape for x in data] == [(1, 1)]
+    assert data[0][0, 0] == 20
+    assert first_inds == [{'x':d('5'), 'y':'e'}]
+
+def test_storage_options():
+    filename = 'storage.hdf5'
+    if os.path.exists(filename):
+        os.remove(filename)
+    try:
+        SdCube('myName', filename, ['x', 'y'], storage={'compresion':'gzip'})
+        assert False
+    except ValueError:
+        assert True
+    cube = SdCube('myName', filename, ['x', 'y'], storage={'compression':
+        'gzip', 'shuffle':True, 'dtype':'f4'})
+    cube.create_dataset({'x':range(100), 'y':range(50)})
+    cube.create_dataset({'x':[100], 'y':[100]})
+    cube.set_data({'x':0, 'y':0}, arange(100*50).reshape((100, 50)))
+    with h5py.File(filename, 'r') as h5_file:
+        dset = h5_file['myName']['0']
+        assert dset.compression == 'gzip'
+        assert dset.shuffle
+        assert dset.chunks is not None
+        assert dset.dtype == 'f4'
+    assert (cube.get_data()[0] ==
+            arange(100*50).reshape((100, 50))).all()
+    cube.storage_options = {'chunks':(10, 10)}
+    cube.create_dataset({'x':range(200, 230), 'y':range(50)})
+    with h5py.File(filename, 'r') as h5_file:
+        assert h5_file['myName']['2'].chunks == (10, 10)
+        assert h5_file['myName']['2'].compression is None
+
+def test_set_data_many(filled_complicated_sdcube):
+    cube = filled_complicated_sdcube
+    cube.set_data_many([({'x':d('3'), 'y':'d'}, array([[1, 2, 3]])),
+        ({'x':d('1'), 'y':'a'}, -arange(2*3).reshape((2, 3))),
+        ({'x':d('5'), 'y':'d'}, array([[4, 5]]))])
+    data = cube.get_data()
+    assert (data[0] == -arange(2*3).reshape((2, 3))).all()
+    assert (data[2] == array([[1, 2, 3]])).all()
+    assert (data[3] == array([[15, 16], [17, 18], [4, 5]])).all()
+    try:
+        cube.set_data_many([({'x':d('3'), 'y':'a'}, array([[0, 0, 0]])),
+            ({'x':d('100'), 'y':'a'}, array([[1]]))])
+        assert False
+    except ValueError:
+        assert True
+    # nothing is written if one of the blocks does not fit
+    assert (cube.get_data()[1] == 7 + arange(1*3).reshape((1,3))).all()
+    # a block overlapping the end of its dataset does not fit either
+    try:
+        cube.set_data_many([({'x':d('1'), 'y':'d'}, array([[0, 0]])),
+            ({'x':d('5'), 'y':'d'}, array([[0, 0], [0, 0]]))])
+        assert False
+    except ValueError:
+        assert True
+    assert (cube.get_data()[3] == array([[15, 16], [17, 18], [4, 5]])).all()
+
+def test_set_data_iter(filled_sdcube):
+    def blocks():
+        for x in [d('1'), d('2'), d('7.0')]:
+            yield {'x':x, 'y':'a', 'z':d('1.0')}, array([[[x]]], dtype=float)
+    assert filled_sdcube.set_data_iter(blocks(), batch_size=2) == 3
+    data = filled_sdcube.get_data({'y':'a', 'z':d('1.0')})[0]
+    assert list(data.flatten()) == [1, 2, 7]
+
+def test_create_datasets(simple_sdcube):
+    names = simple_sdcube.create_datasets([{'x':[1, 2], 'y':['a'], 'z':[1]},
+        {'x':[3], 'y':['a'], 'z':[1]}, {'x':[1, 2], 'y':['b'], 'z':[1]}])
+    assert names == ['0', '1', '2']
+    simple_sdcube.set_data({'x':3, 'y':'a', 'z':1}, array([[[5]]]))
+    assert simple_sdcube.get_data({'x':3})[0][0, 0, 0] == 5
+    # the new datasets overlap each other
+    try:
+        simple_sdcube.create_datasets([{'x':[4], 'y':['a'], 'z':[1]},
+            {'x':[4, 5], 'y':['a', 'c'], 'z':[1]}])
+        assert False
+    except ValueError:
+        assert True
+    # one of the new datasets overlaps an existing one
+    try:
+        simple_sdcube.create_datasets([{'x':[4], 'y':['a'], 'z':[1]},
+            {'x':[3], 'y':['a'], 'z':[1]}])
+        assert False
+    except ValueError:
+        assert True
+    assert len(simple_sdcube.get_data()) == 3
+    assert simple_sdcube.create_datasets([{'x':[4], 'y':['a'], 'z':[1]}]) \
+            == ['3']
+
+def test_to_dense(filled_complicated_sdcube):
+    data, labels = filled_complicated_sdcube.to_dense()
+    assert labels == {'x':[d('1'), d('2'), d('3'), d('5')],
+            'y':['a', 'b', 'c', 'd', 'e', 'f']}
+    expected = array([[0, 1, 2, 15, 16, nan],
+        [3, 4, 5, 17, 18, nan],
+        [7, 8, 9, 11, 12, 13],
+        [nan, nan, nan, 19, 20, nan]])
+    assert data.shape == expected.shape
+    assert ((data == expected) | (isnan(data) & isnan(expected))).all()
+
+    data, labels = filled_complicated_sdcube.to_dense({'y':'d'},
+            block_size=1)
+    assert labels == {'x':[d('1'), d('2'), d('3'), d('5')], 'y':['d']}
+    assert (data == array([[15], [17], [11], [19]])).all()
+
+def test_to_dense_memmap(filled_complicated_sdcube):
+    filename = 'dense.dat'
+    if os.path.exists(filename):
+        os.remove(filename)
+    data, labels = filled_complicated_sdcube.to_dense({'y':'a'},
+            memmap=filename, fill=-1)
+    assert isinstance(data, memmap)
+    assert (data == array([[0], [3], [7]])).all()
+    data, labels = filled_complicated_sdcube.to_dense({'x':d('3')},
+            memmap=filename, fill=-1)
+    assert isinstance(data, memmap)
+    assert (data == array([[7, 8, 9, 11, 12, 13]])).all()
+    data, labels = filled_complicated_sdcube.to_dense({'x':d('5')},
+            memmap=filename, fill=-1)
+    assert labels == {'x':[d('5')], 'y':['d', 'e']}
+    assert (data == array([[19, 20]])).all()
+
+def test_from_records():
+    if os.path.exists('records.hdf5'):
+        os.remove('records.hdf5')
+    hdf = Hdf5('records')
+    records = {'x':[3, 1, 2, 1, 3, 2], 'y':['b', 'a', 'a', 'b', 'a', 'b'],
+            'value':arange(6)}
+    cube = SdCube.from_records(hdf, records, ['x', 'y'], name='dense',
+            block_size=1)
+    assert hdf.get_sdcube('dense').mapping == {'x':0, 'y':1}
+    data, labels = cube.to_dense()
+    assert labels == {'x':[1, 2, 3], 'y':['a', 'b']}
+    assert (data == array([[1, 3], [2, 5], [4, 0]])).all()
+    assert cube.get_data()[0].dtype == arange(6).dtype
+    assert cube.storage_options == {}
+
+    # missing data points
+    records = zeros(4, dtype=[('x', 'i4'), ('y', 'S1'), ('value', 'f8')])
+    records['x'] = [1, 1, 2, 3]
+    records['y'] = ['a', 'b', 'a', 'b']
+    records['value'] = [1.5, 2.5, 3.5, 4.5]
+    cube = SdCube.from_records(hdf, records, name='sparse', block_size=1)
+    with h5py.File('records.hdf5', 'r') as h5_file:
+        assert len(fragment_names(h5_file['sparse'])) == 1
+    data, labels = cube.to_dense()
+    expected = array([[1.5, 2.5], [3.5, nan], [nan, 4.5]])
+    assert ((data == expected) | (isnan(data) & isnan(expected))).all()
+
+    # one dataset per label of x, holding the labels of y occurring with it
+    cube = SdCube.from_records(hdf, records, name='split', split='x')
+    with h5py.File('records.hdf5', 'r') as h5_file:
+        assert len(fragment_names(h5_file['split'])) == 3
+    assert sorted(data.shape for data in cube.get_data()) == [(1, 1), (1, 1),
+            (1, 2)]
+    data, labels = cube.to_dense()
+    assert ((data == expected) | (isnan(data) & isnan(expected))).all()
+
+def test_from_records_twice():
+    if os.path.exists('records.hdf5'):
+        os.remove('records.hdf5')
+    hdf = Hdf5('records')
+    try:
+        SdCube.from_records(hdf, {'x':[1, 2, 1], 'value':[1, 2, 3]})
+    except ValueError:
+        pass
+    else:
+        assert False
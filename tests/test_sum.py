@@ -4,6 +4,7 @@ from decimal import Decimal as d
 from numpy import arange, array
 from sum import Sum
 import os
+import h5py
 
 def pytest_funcarg__hdf_project(request):
     ''' Set up a project, create two datasets with alike dimensions (4x4
@@ -81,3 +82,29 @@ def test_four_cubes(hdf_project):
     for array1, array2 in zip(data, expected):
         assert all((x == y) for x,y in zip(array1.flat, array2.flat))
 
+
+def test_block_size(hdf_project):
+    my_sum = Sum('python.test.sum', [{'block_size':3}], ['2D_1', '2D_2'],
+            ['sum'])
+    hdf_project.execute_function(my_sum)
+    data = hdf_project.get_sdcube('sum').get_data()
+    expected = [2 * arange(4*4).reshape((4, 4)), array([[2]])]
+    for array1, array2 in zip(data, expected):
+        assert (array1 == array2).all()
+
+def test_inherited_storage_options():
+    if os.path.exists('sum_storage.hdf5'):
+        os.remove('sum_storage.hdf5')
+    hdf = Hdf5('sum_storage')
+    for name in ['a', 'b']:
+        hdf.add_sdcube(['x', 'y'], name=name, storage={'compression':'gzip',
+            'chunks':'auto'})
+        sdcube = hdf.get_sdcube(name)
+        sdcube.create_dataset({'x':range(8), 'y':range(8)})
+        sdcube.set_data({'x':0, 'y':0}, arange(8*8).reshape((8, 8)))
+    hdf.execute_function(Sum('python.test.sum', [], ['a', 'b'], ['sum']))
+    sdcube = hdf.get_sdcube('sum')
+    assert sdcube.storage_options == {'compression':'gzip', 'chunks':'auto'}
+    with h5py.File('sum_storage.hdf5', 'r') as h5_file:
+        assert h5_file['sum']['0'].compression == 'gzip'
+    assert (sdcube.get_data()[0] == 2 * arange(8*8).reshape((8, 8))).all()